@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import zipfile
+import numpy as np
+from BimTopology import BimTopology
+from BimLoader import load_compact
+
+CACHE_VERSION = 1  # увеличивается при изменении BimTopology.ARRAYS
+CACHE_DIR = os.environ.get("EVACATTACK_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "evacattack"))
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_file(digest, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, "bim-%s-v%d.npz" % (digest, CACHE_VERSION))
+
+
+def save_topology(topo, path):
+    ''' Записывает топологию в несжатый .npz (запись во временный файл, затем переименование) '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **topo.to_arrays())
+    os.replace(tmp, path)
+
+
+def load_topology(path):
+    with np.load(path, allow_pickle=False) as f:
+        return BimTopology.from_arrays({name: f[name] for name in f.files})
+
+
+def compile_building(bim, digest, cache_dir=None):
+    ''' Топология здания из кэша по хэшу содержимого, или построенная и сохранённая в кэш '''
+    path = cache_file(digest, cache_dir)
+    if os.path.exists(path):
+        try:
+            return load_topology(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass  # повреждённый (в том числе недописанный) или устаревший файл кэша строим заново
+    topo = BimTopology(bim)
+    try:
+        save_topology(topo, path)
+    except OSError:
+        pass  # кэш недоступен для записи, работаем без него
+    return topo
+
+
+def load_building(file, cache_dir=None, compact=False):
+    ''' Читает BIM JSON (путь или открытый файл) и возвращает (bim, BimTopology).
+    Площади, ширины проёмов, центры, смежность, этажи и уровни обхода от каждого входа
+    берутся из кэша, ключ которого - sha256 содержимого файла.
+    compact - читать по частям только нужные модели поля (BimLoader.load_compact) '''
+    if compact:
+        digest = hashlib.sha256()
+        bim = load_compact(file, digest=digest)
+        return bim, compile_building(bim, digest.hexdigest(), cache_dir)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            data = f.read()
+    else:
+        data = file.read()
+        data = data.encode("utf-8") if isinstance(data, str) else data
+    bim = json.loads(data)
+    return bim, compile_building(bim, content_hash(data), cache_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Precompile BIM JSON files into the building cache')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+    for name in args.files:
+        bim, topo = load_building(name, args.cache_dir)
+        print(name, "zones", topo.nz, "transits", topo.nt, "exits", topo.ns)
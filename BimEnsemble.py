@@ -0,0 +1,259 @@
+import heapq
+import itertools
+import math
+import numpy as np
+from BimEvac import Moving, PeopleFlowVelocity, ArrayKernel
+from BimTopology import BimTopology
+
+
+class EnsembleMoving(object):
+    ''' K сценариев эвакуации из одного здания, которые шагают вместе.
+    Топология общая, состояние хранится в массивах (K, ...): сценарии различаются
+    начальной плотностью, заблокированными зонами и т.п.
+
+    Сценарии с одинаковыми заблокированными зонами обходятся вместе: очередь зон ведёт
+    первый сценарий группы, а арифметика считается сразу для всей группы. Если у какого-то
+    сценария порядок зон по потенциалу расходится с ведущим, его шаг пересчитывается
+    отдельной группой, так что результат совпадает с последовательным ArrayMoving
+    (с точностью до 1 ulp из-за np.log) '''
+
+    MODELLING_STEP = Moving.MODELLING_STEP
+    MIN_DENSIY = Moving.MIN_DENSIY
+    MAX_DENSIY = Moving.MAX_DENSIY
+    MAX_BATCH_ATTEMPTS = 2
+
+    def __init__(self, bim, k, topology=None, min_batch=16) -> None:
+        self.bim = bim
+        self.topo = topo = topology or BimTopology(bim)
+        self.k = k
+        self.pfv = PeopleFlowVelocity(projection_area=0.1)
+        self.kernel = ArrayKernel(topo, self.pfv)
+        self._step_counter = [0, 0, 0]
+        self.min_batch = min_batch  # группы меньше этого считаются по одному сценарию
+        self.rerun_steps = 0  # сколько раз сценарии пересчитывались из-за другого порядка обхода
+        nz, ns, nt = topo.nz, topo.ns, topo.nt
+        self.num_people = np.zeros((k, nz + ns))
+        self.potential = np.zeros((k, nz + ns))
+        self.color = np.full((k, nz + ns), -1, dtype=np.int64)
+        self.color[:, nz:] = np.arange(ns)
+        self.density = np.zeros((k, nz))
+        self.zone_visited = np.zeros((k, nz), dtype=bool)
+        self.zone_blocked = np.zeros((k, nz), dtype=bool)
+        self.transit_flow = np.zeros((k, nt))
+        self.transit_visited = np.zeros((k, nt), dtype=bool)
+        self.transit_blocked = np.zeros((k, nt), dtype=bool)
+        self.transit_color = np.full((k, nt), -1, dtype=np.int64)
+        self._sqrt_area = np.sqrt(topo.zone_area).tolist()
+        self.time = 0.0
+
+    def set_density(self, density):
+        ''' density - число, массив (K,) по сценариям или (K, nz) по сценариям и зонам '''
+        density = np.asarray(density, dtype=np.float64)
+        self.density[:] = density[:, None] if density.ndim == 1 else density
+
+    def set_people_by_density(self):
+        self.num_people[:, :self.topo.nz] = self.density * self.topo.zone_area
+
+    def block_zone(self, k, zone_id, blocked=True):
+        self.zone_blocked[k, self.topo.zone_index[zone_id]] = blocked
+
+    def take_people(self, k, zone_id):
+        i = self.topo.zone_index[zone_id]
+        people = self.num_people[k, i].item()
+        self.num_people[k, i] = 0
+        self.density[k, i] = 0
+        return people
+
+    def people_remaining(self):
+        ''' Людей в зонах, посещённых на последнем шаге, по сценариям '''
+        return (self.num_people[:, :self.topo.nz] * self.zone_visited).sum(axis=1)
+
+    def sync(self, k):
+        ''' Записывает состояние сценария k в словари BIM '''
+        topo = self.topo
+        zones = {el["Id"]: el for lvl in self.bim['Level'] for el in lvl['BuildElement']}
+        for i, zid in enumerate(topo.zone_ids):
+            z = zones[zid]
+            z["NumPeople"] = self.num_people[k, i].item()
+            z["Density"] = self.density[k, i].item()
+            z["Potential"] = self.potential[k, i].item()
+            z["IsVisited"] = bool(self.zone_visited[k, i])
+            z["IsBlocked"] = bool(self.zone_blocked[k, i])
+        for i, tid in enumerate(topo.transit_ids):
+            t = zones[tid]
+            t["NumPeople"] = self.transit_flow[k, i].item()
+            t["IsVisited"] = bool(self.transit_visited[k, i])
+
+    def step(self):
+        self._step_counter[0] += 1
+        structure = np.packbits(np.concatenate((self.zone_blocked, self.transit_blocked), axis=1), axis=1)
+        groups = {}
+        for k, key in enumerate(map(bytes, structure)):
+            groups.setdefault(key, []).append(k)
+        groups = [np.array(rows) for rows in groups.values()]
+        for rows in groups:
+            # Разошедшиеся с ведущим сценарии пробуем ещё раз вместе, а затем по одному
+            for attempt in range(self.MAX_BATCH_ATTEMPTS):
+                rows = self._step_rows(rows)
+            for k in rows:
+                self._step_single(k)
+        self.time += self.MODELLING_STEP
+
+    def _step_single(self, k):
+        num = self.num_people[k].tolist()
+        dens = self.density[k].tolist()
+        pot, color, zvis, tvis, tflow, tcolor, _ = self.kernel.traverse(
+            num, dens, self.zone_blocked[k].tolist(), self.transit_blocked[k].tolist(),
+            self.MODELLING_STEP, self.MIN_DENSIY, self.MAX_DENSIY, self._step_counter)
+        self.num_people[k] = num
+        self.density[k] = dens
+        self.potential[k] = pot
+        self.color[k] = color
+        self.zone_visited[k] = zvis
+        self.transit_visited[k] = tvis
+        self.transit_flow[k] = tflow
+        self.transit_color[k] = tcolor
+
+    def _exit_speeds(self, d, w, dh, to_stair):
+        ''' PeopleFlowVelocity.speeds_at_exit для одной пары зон и массива плотностей
+        отдающей зоны, с минимумом вызовов NumPy. При d <= d0 логарифм равен нулю,
+        поэтому скорость равна v0 без отдельной ветки '''
+        pfv = self.pfv
+        if abs(dh) > 1e-3 and to_stair:
+            v0, a, d0 = pfv.PATH_VALUE[pfv.STAIR_DOWN if dh > 0 else pfv.STAIR_UP]
+        else:
+            v0, a, d0 = pfv.PATH_VALUE[pfv.ROOM]
+        v0t, at, d0t = pfv.PATH_VALUE[pfv.TRANSIT]
+        if d.max() <= min(d0, d0t):
+            # Свободное движение во всех сценариях группы
+            return float(min(v0, v0t))
+        v_zone = v0 * (1.0 - a * np.log(np.maximum(np.minimum(d, pfv.D09), d0) / d0))
+        v0, a, d0 = v0t, at, d0t
+        D = d * pfv.projection_area
+        q = v0 * (1.0 - a * np.log(np.maximum(d, d0) / d0)) * D * np.minimum(1.0, 1.25 - 0.5 * D)
+        q = np.where(D >= 0.9, 2.5 + 3.75 * w if w < 1.6 else 8.5, q)
+        return np.minimum(v_zone, np.where(d > d0, q / D, float(v0)))
+
+    def _step_rows(self, rows):
+        ''' Шаг группы сценариев с одинаковой структурой. Возвращает сценарии,
+        разошедшиеся с ведущим по порядку обхода: их состояние не изменено '''
+        if rows.size < self.min_batch:
+            # На малых группах накладные расходы NumPy больше выигрыша
+            for k in rows:
+                self._step_single(k)
+            return rows[:0]
+
+        topo, kernel, pfv = self.topo, self.kernel, self.pfv
+        nz, ns, nt = topo.nz, topo.ns, topo.nt
+        area, sqrt_area, width, zlevel, nout = kernel.area, self._sqrt_area, kernel.width, kernel.zlevel, kernel.nout
+        is_stair, outputs, transit_zones = kernel.is_stair, kernel.outputs, kernel.transit_zones
+        min_density, max_density, dt = self.MIN_DENSIY, self.MAX_DENSIY, self.MODELLING_STEP
+        zblocked = self.zone_blocked[rows[0]].tolist()
+        tblocked = self.transit_blocked[rows[0]].tolist()
+
+        num = self.num_people[rows]
+        dens = self.density[rows]
+        pot = np.full((rows.size, nz + ns), math.inf)
+        pot[:, nz:] = 0.0
+        color = np.full((rows.size, nz + ns), -1, dtype=np.int64)
+        color[:, nz:] = np.arange(ns)
+        order = np.zeros((rows.size, nz + ns), dtype=np.int64)  # номер последнего изменения потенциала
+        tflow = np.zeros((rows.size, nt))
+        tcolor = np.full((rows.size, nt), -1, dtype=np.int64)
+        zvis = [False] * nz
+        tvis = [False] * nt
+        alive = np.ones(rows.size, dtype=bool)
+
+        # Очередь ведущего сценария (строка 0), как в ArrayKernel.traverse
+        seq = itertools.count()
+        queued = [-1] * (nz + ns)
+        members = set()
+        zones_to_process = []
+        for r in range(nz, nz + ns):
+            queued[r] = n = next(seq)
+            order[:, r] = n
+            members.add(r)
+            zones_to_process.append((0.0, n, r))
+        self._step_counter[1] = 0
+
+        with np.errstate(all='ignore'):
+            while zones_to_process:
+                _, n, r = heapq.heappop(zones_to_process)
+                if queued[r] != n:
+                    continue
+                if len(members) > 1:
+                    # r должна быть первой в очереди каждого сценария: наименьший потенциал,
+                    # а при равенстве - самое раннее изменение потенциала
+                    q = np.fromiter(members, dtype=np.int64, count=len(members))
+                    sub = pot[:, q]
+                    first = sub.min(axis=1)
+                    ok = pot[:, r] == first
+                    ok &= ~((sub == first[:, None]) & (order[:, q] < order[:, r][:, None])).any(axis=1)
+                    alive &= ok
+                queued[r] = -1
+                members.discard(r)
+                self._step_counter[2] = 0
+                for t in outputs[r]:
+                    if tvis[t] or tblocked[t]:
+                        continue
+
+                    g, transit_dir = transit_zones[t][0], 1
+                    if g == r:
+                        g, transit_dir = transit_zones[t][1], -1
+                        if g < 0:
+                            continue
+                    if zblocked[g]:
+                        continue
+
+                    w, dh, to_stair = width[t], zlevel[r] - zlevel[g], is_stair[r]
+                    moved = dens[:, g] * self._exit_speeds(dens[:, g], w, dh, to_stair) * w * dt
+                    moved = np.where(dens[:, g] <= min_density, num[:, g], moved)
+                    if r < nz:
+                        capacity = max_density * area[r] - num[:, r]
+                        moved = np.where(capacity < 0, 0.0, np.where(capacity > moved, moved, capacity))
+                    moved = np.where(num[:, g] < moved, num[:, g], moved)
+                    num[:, r] += moved
+                    num[:, g] -= moved
+                    tflow[:, t] = moved * transit_dir
+
+                    if r < nz:
+                        dens[:, r] = num[:, r] / area[r]
+                    dens[:, g] = num[:, g] / area[g]
+
+                    zvis[g] = True
+                    tvis[t] = True
+
+                    new_pot = pot[:, r] + sqrt_area[g] / self._exit_speeds(dens[:, g], w, dh, to_stair)
+                    better = new_pot < pot[:, g]
+                    pot[:, g] = np.where(better, new_pot, pot[:, g])
+                    color[:, g] = np.where(better, color[:, r], color[:, g])
+                    tcolor[:, t] = np.where(better, color[:, r], -1)
+                    # отсекаем помещения, в которых одна дверь
+                    if nout[g] > 1 and queued[g] < 0:
+                        queued[g] = n = next(seq)
+                        order[:, g] = n
+                        members.add(g)
+                        heapq.heappush(zones_to_process, (pot[0, g].item(), n, g))
+                    elif queued[g] >= 0 and better.any():
+                        n = next(seq)
+                        order[better, g] = n
+                        if better[0]:
+                            queued[g] = n
+                            heapq.heappush(zones_to_process, (pot[0, g].item(), n, g))
+
+                    self._step_counter[2] += 1
+
+                self._step_counter[1] += 1
+
+        done = rows[alive]
+        self.num_people[done] = num[alive]
+        self.density[done] = dens[alive]
+        self.potential[done] = pot[alive]
+        self.color[done] = color[alive]
+        self.zone_visited[done] = zvis
+        self.transit_visited[done] = tvis
+        self.transit_flow[done] = tflow[alive]
+        self.transit_color[done] = tcolor[alive]
+        if not alive.all():
+            self.rerun_steps += 1
+        return rows[~alive]
@@ -1,7 +1,13 @@
 import math
-import json
-from EvacAttackShared import points, room_area, cntr_real
+import heapq
+import itertools
+from collections import deque
+import numpy as np
+from EvacAttackShared import room_area, door_width, state_copy
+from BimTopology import BimTopology, Building
+from BimMetrics import metrics
 from math import exp
+from time import perf_counter
 
 class PeopleFlowVelocity(object):
     ROOM, TRANSIT, STAIR_UP, STAIR_DOWN = range(4)
@@ -118,6 +124,106 @@ class PeopleFlowVelocity(object):
 
         return self.velocity(v0, a, d0, d) if d > d0 else v0
 
+    # Векторные варианты: массив плотностей на входе, массив скоростей на выходе.
+    # Совпадают со скалярными функциями с точностью до 1 ulp (np.log вместо math.log)
+
+    def _velocities(self, path, d):
+        v0, a, d0 = self.PATH_VALUE[path]
+        d = np.asarray(d, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            return np.where(d > d0, v0 * (1.0 - a * np.log(np.maximum(d, d0) / d0)), float(v0))
+
+    def speeds_in_room(self, d):
+        ''' Векторный speed_in_room '''
+        return self._velocities(self.ROOM, np.minimum(d, self.D09))
+
+    def speeds_on_stair(self, direction, d):
+        ''' Векторный speed_on_stair, direction - скаляр или массив STAIR_UP/STAIR_DOWN '''
+        d = np.minimum(d, self.D09)
+        direction = np.asarray(direction)
+        if not np.isin(direction, (self.STAIR_DOWN, self.STAIR_UP)).all():
+            raise ValueError(f"Некорректный индекс направления движеия по лестнице: {direction}")
+        return np.where(direction == self.STAIR_DOWN, self._velocities(self.STAIR_DOWN, d), self._velocities(self.STAIR_UP, d))
+
+    def speeds_through_transit(self, width, d):
+        ''' Векторный speed_through_transit '''
+        v0, a, d0 = self.PATH_VALUE[self.TRANSIT]
+        d = np.asarray(d, dtype=np.float64)
+        D = d * self.projection_area
+        m = np.where(D <= 0.5, 1.0, 1.25 - 0.5 * D)
+        q = self._velocities(self.TRANSIT, d) * D * m
+        q = np.where(D >= 0.9, np.where(np.asarray(width) < 1.6, 2.5 + 3.75 * np.asarray(width), 8.5), q)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(d > d0, q / D, float(v0))
+
+    def speeds_at_exit(self, width, d, dh, to_stair):
+        ''' Векторный Moving.speed_at_exit: скорость выхода из отдающих зон с плотностью d
+        через проёмы ширины width; dh - перепад высот до принимающей зоны,
+        to_stair - является ли принимающая зона лестницей '''
+        v_zone = self.speeds_in_room(d)
+        on_stair = (np.abs(dh) > 1e-3) & to_stair
+        if np.any(on_stair):
+            v_zone = np.where(on_stair, self.speeds_on_stair(np.where(np.asarray(dh) > 0, self.STAIR_DOWN, self.STAIR_UP), d), v_zone)
+        return np.minimum(v_zone, self.speeds_through_transit(width, d))
+
+
+class VelocityTable(PeopleFlowVelocity):
+    ''' PeopleFlowVelocity, в котором векторные функции берут скорость из таблицы: значения
+    заранее посчитаны на равномерной сетке плотностей и линейно интерполируются. Сетка сгущается,
+    пока ошибка интерполяции не станет меньше tolerance, м/мин.
+    Скалярные функции остаются точными '''
+
+    def __init__(self, projection_area: float = 0.1, tolerance: float = 1e-3) -> None:
+        super().__init__(projection_area)
+        self.tolerance = tolerance
+        self.max_error = 0.0
+        exact = PeopleFlowVelocity
+        self.tables = {
+            self.ROOM: self._build(lambda d: exact.speeds_in_room(self, d), self.ROOM, self.D09),
+            self.STAIR_UP: self._build(lambda d: exact.speeds_on_stair(self, self.STAIR_UP, d), self.STAIR_UP, self.D09),
+            self.STAIR_DOWN: self._build(lambda d: exact.speeds_on_stair(self, self.STAIR_DOWN, d), self.STAIR_DOWN, self.D09),
+            # Начиная с D = 0.9 скорость в проёме зависит от ширины и считается напрямую
+            self.TRANSIT: self._build(lambda d: exact.speeds_through_transit(self, 0.0, d), self.TRANSIT,
+                                      np.nextafter(self.to_pm2(0.9), 0)),
+        }
+
+    def _build(self, f, path, d_max):
+        ''' Равномерная сетка на [d0, d_max]; ниже d0 скорость постоянна.
+        Ошибка проверяется по четырём точкам внутри каждого интервала '''
+        d0 = self.PATH_VALUE[path][self.D0]
+        n = 16
+        while True:
+            grid = np.linspace(d0, d_max, n + 1)
+            values = f(grid)
+            probe = (grid[:-1, None] + np.diff(grid)[:, None] * np.array([0.2, 0.4, 0.6, 0.8])).ravel()
+            err = np.max(np.abs(np.interp(probe, grid, values) - f(probe)))
+            if err <= self.tolerance:
+                self.max_error = max(self.max_error, err)
+                return d0, n / (d_max - d0), values, np.append(np.diff(values), 0.0)
+            n *= 2
+
+    def _lookup(self, path, d):
+        # Индекс интервала считается напрямую, без двоичного поиска
+        d0, inv_h, values, slopes = self.tables[path]
+        x = np.clip((np.asarray(d, dtype=np.float64) - d0) * inv_h, 0, len(values) - 1)
+        i = x.astype(np.int64)
+        return values[i] + (x - i) * slopes[i]
+
+    def speeds_in_room(self, d):
+        return self._lookup(self.ROOM, np.minimum(d, self.D09))
+
+    def speeds_on_stair(self, direction, d):
+        d = np.minimum(d, self.D09)
+        return np.where(np.asarray(direction) == self.STAIR_DOWN, self._lookup(self.STAIR_DOWN, d), self._lookup(self.STAIR_UP, d))
+
+    def speeds_through_transit(self, width, d):
+        d = np.asarray(d, dtype=np.float64)
+        v = self._lookup(self.TRANSIT, d)
+        high = d * self.projection_area >= 0.9
+        if np.any(high):
+            v = np.where(high, super().speeds_through_transit(width, d), v)
+        return v
+
 
 class Moving(object):
     MODELLING_STEP = 0.008  # мин.
@@ -143,15 +249,23 @@ class Moving(object):
             t["IsBlocked"] = False
             t["IsVisited"] = False
             t["NumPeople"] = 0.0
-            t_points = points(t)
-            t["Width"] = max(math.dist(p1,p2) for p1, p2 in zip(t_points, t_points[1:]+t_points[:1]))
+            t["Width"] = self.transit_width(t)
         for z in self.zones.values():
             z["IsBlocked"] = False
             z["IsVisited"] = False
-            z["Area"] = room_area(z)
+            z["Area"] = self.zone_area(z)
         self.time = 0.0
 
+    def zone_area(self, z):
+        return room_area(z)
+
+    def transit_width(self, t):
+        return door_width(t)
+
     def step(self):
+        timed = metrics.enabled
+        if timed:
+            t0 = perf_counter()
         self._step_counter[0] += 1
         for t in self.transits.values():
             t["IsVisited"] = False
@@ -162,11 +276,25 @@ class Moving(object):
             z["Potential"] = math.inf
             z["Color"] = ""
 
-        zones_to_process = self.safety_zones.copy()
+        # Очередь зон по возрастанию потенциала. Порядок при равных потенциалах тот же,
+        # что давала устойчивая сортировка списка: по времени последнего изменения потенциала.
+        # Устаревшие записи кучи пропускаются (ленивое удаление), членство - по id() зоны.
+        seq = itertools.count()
+        zones_to_process = []
+        queued = {}
+        for sz in self.safety_zones:
+            queued[id(sz)] = n = next(seq)
+            zones_to_process.append((sz["Potential"], n, sz))
         self._step_counter[1] = 0
-
-        while len(zones_to_process) > 0:
-            receiving_zone = zones_to_process.pop(0)
+        if timed:
+            t1 = perf_counter()
+            zones = transits = 0
+
+        while zones_to_process:
+            _, n, receiving_zone = heapq.heappop(zones_to_process)
+            if queued.get(id(receiving_zone)) != n:
+                continue
+            del queued[id(receiving_zone)]
             self._step_counter[2] = 0
             for transit in (self.transits[tid] for tid in receiving_zone["Output"]):
                 if transit["IsVisited"] or transit["IsBlocked"]:
@@ -174,7 +302,7 @@ class Moving(object):
 
                 giving_zone = self.zones[transit["Output"][0]]
                 transit_dir = 1
-                if giving_zone == receiving_zone:
+                if giving_zone is receiving_zone:
                     if len(transit["Output"]) < 2:
                         # TODO: do something?
                         continue
@@ -187,34 +315,48 @@ class Moving(object):
                 # print(giving_zone.num_of_people, receiving_zone.num_of_people, moved_people)
 
                 if giving_zone["NumPeople"] < moved_people:
-                    print("Cut", moved_people, "to", giving_zone["NumPeople"])
+                    metrics.event("flow_cut", moved_people, "to", giving_zone["NumPeople"])
                     moved_people = giving_zone["NumPeople"]
                 receiving_zone["NumPeople"] += moved_people
                 giving_zone["NumPeople"] -= moved_people
                 transit["NumPeople"] = moved_people * transit_dir
                 # self.direction_pairs[transit.id] = (giving_zone, receiving_zone)
 
-                if receiving_zone not in self.safety_zones:
+                if receiving_zone["Sign"] != "SZ":
                     receiving_zone["Density"] = receiving_zone["NumPeople"] / receiving_zone["Area"]
                 giving_zone["Density"] = giving_zone["NumPeople"] / giving_zone["Area"]
 
                 giving_zone["IsVisited"] = True
                 transit["IsVisited"] = True
 
-                if len(giving_zone["Output"]) > 1 and giving_zone not in zones_to_process:  # отсекаем помещения, в которых одна дверь
-                    zones_to_process.append(giving_zone)
+                # отсекаем помещения, в которых одна дверь
+                enqueue = len(giving_zone["Output"]) > 1 and id(giving_zone) not in queued
 
                 new_pot = self.potential(receiving_zone, giving_zone, transit["Width"])
                 if new_pot < giving_zone["Potential"]:
                     giving_zone["Potential"] = new_pot
                     giving_zone["Color"] = receiving_zone.get("Color")
                     transit["Color"] = receiving_zone.get("Color")
-                zones_to_process.sort(key=lambda d: d["Potential"])
+                    enqueue = enqueue or id(giving_zone) in queued
+                if enqueue:
+                    queued[id(giving_zone)] = n = next(seq)
+                    heapq.heappush(zones_to_process, (giving_zone["Potential"], n, giving_zone))
 
                 self._step_counter[2] += 1
 
             self._step_counter[1] += 1
+            if timed:
+                zones += 1
+                transits += self._step_counter[2]
         self.time += self.MODELLING_STEP
+        if timed:
+            pushes = next(seq)
+            metrics.add_time("step.reset", t1 - t0)
+            metrics.add_time("step.traverse", perf_counter() - t1)
+            metrics.count("zones_processed", zones)
+            metrics.count("transits_processed", transits)
+            metrics.count("heap_pushes", pushes)
+            metrics.count("heap_pops", pushes - len(zones_to_process))
 
     def potential(self, rzone, gzone, twidth):
         p = math.sqrt(gzone["Area"]) / self.speed_at_exit(rzone, gzone, twidth)
@@ -262,7 +404,7 @@ class Moving(object):
         part_of_people_flow = self.change_numofpeople(gzone, transit["Width"], speedatexit)
         if gzone["Density"] <= min_density_gzone:
             if part_of_people_flow > gzone["NumPeople"]:
-                print("===WTF!===")
+                metrics.event("min_density_overflow", part_of_people_flow, "to", gzone["NumPeople"])
             part_of_people_flow = gzone["NumPeople"]
 
         # Т.к. зона вне здания принята безразмерной,
@@ -273,16 +415,22 @@ class Moving(object):
         # вместиться до достижения максимальной плотности
         # => если может вместить больше, чем может выйти, то вмещает всех вышедших,
         # иначе вмещает только возможное количество.
-        if rzone in self.safety_zones:
+        if rzone["Sign"] == "SZ":
             return part_of_people_flow
         max_numofpeople = self.MAX_DENSIY * rzone["Area"]
         capacity_reciving_zone = max_numofpeople - rzone["NumPeople"]
         # Такая ситуация возникает при плотности в принимающем помещении более Dmax чел./м2
         # Фактически capacity_reciving_zone < 0 означает, что помещение не может принять людей
         if capacity_reciving_zone < 0:
+            if metrics.enabled:
+                metrics.count("capacity_cuts")
             return 0.0
+        elif capacity_reciving_zone > part_of_people_flow:
+            return part_of_people_flow
         else:
-            return part_of_people_flow if (capacity_reciving_zone > part_of_people_flow) else capacity_reciving_zone
+            if metrics.enabled:
+                metrics.count("capacity_cuts")
+            return capacity_reciving_zone
 
     def change_numofpeople(self, gzone, twidth, speed_at_exit):
         # Величина людского потока, через проем шириной twidth, чел./мин
@@ -299,6 +447,485 @@ class Moving(object):
         for z in self.zones.values():
             z["NumPeople"] = z["Density"] * z["Area"]
 
+    def block_zone(self, zone_id, blocked=True):
+        self.zones[zone_id]["IsBlocked"] = blocked
+
+    def take_people(self, zone_id):
+        ''' Забирает всех людей из зоны, возвращает их количество '''
+        z = self.zones[zone_id]
+        people = z["NumPeople"]
+        z["NumPeople"] = 0
+        z["Density"] = 0
+        return people
+
+    def people_remaining(self):
+        ''' Людей в зонах, посещённых на последнем шаге. Ноль - эвакуация закончена '''
+        return sum(z["NumPeople"] for z in self.zones.values() if z["IsVisited"])
+
+    ZONE_STATE = ("NumPeople", "Density", "Potential", "IsVisited", "IsBlocked", "Color")
+    TRANSIT_STATE = ("NumPeople", "IsVisited", "IsBlocked", "Color")
+    SZ_STATE = ("NumPeople", "Potential", "Color")
+
+    def snapshot(self):
+        ''' Копия изменяемого состояния (без геометрии): поля зон, проёмов и безопасных зон и время '''
+        def fields(els, names):
+            return [tuple(el.get(name) for name in names) for el in els]
+        return {"zones": fields(self.zones.values(), self.ZONE_STATE),
+                "transits": fields(self.transits.values(), self.TRANSIT_STATE),
+                "safety_zones": fields(self.safety_zones, self.SZ_STATE),
+                "time": self.time}
+
+    def restore(self, state):
+        ''' Возвращает состояние snapshot этого же здания '''
+        for els, names, values in ((self.zones.values(), self.ZONE_STATE, state["zones"]),
+                                   (self.transits.values(), self.TRANSIT_STATE, state["transits"]),
+                                   (self.safety_zones, self.SZ_STATE, state["safety_zones"])):
+            for el, vals in zip(els, values):
+                el.update(zip(names, vals))
+        self.time = state["time"]
+
+    def sync(self):
+        ''' Состояние хранится прямо в словарях BIM, записывать нечего '''
+        pass
+
+
+class ArrayKernel(object):
+    ''' Внутренний цикл шага Moving над пронумерованной топологией. Состояние передаётся
+    списками и изменяется на месте, неизменяемые величины разобраны в списки один раз '''
+
+    def __init__(self, topo: BimTopology, pfv: PeopleFlowVelocity) -> None:
+        self.topo, self.pfv = topo, pfv
+        self.area = topo.zone_area.tolist()
+        self.width = topo.transit_width.tolist()
+        self.zlevel = topo.node_zlevel.tolist()
+        self.nout = topo.zone_num_outputs.tolist()
+        self.outputs = [topo.outputs(n).tolist() for n in range(topo.nz + topo.ns)]
+        self.transit_zones = topo.transit_zones.tolist()
+        self.is_stair = (topo.zone_sign == topo.STAIRCASE).tolist() + [False] * topo.ns
+
+    def reach(self, zblocked, tblocked):
+        ''' Какие зоны traverse может затронуть при данных блокировках, и номера связных частей
+        для зон и безопасных зон (части не влияют друг на друга в пределах шага) '''
+        nz, ns = self.topo.nz, self.topo.ns
+        nout, outputs, transit_zones = self.nout, self.outputs, self.transit_zones
+        reach = [False] * nz
+        part = list(range(nz + ns))
+
+        def find(v):
+            while part[v] != v:
+                part[v] = part[part[v]]
+                v = part[v]
+            return v
+
+        expanded = [False] * (nz + ns)
+        queue = deque(range(nz, nz + ns))
+        while queue:
+            r = queue.popleft()
+            for t in outputs[r]:
+                if tblocked[t]:
+                    continue
+                g = transit_zones[t][0]
+                if g == r:
+                    g = transit_zones[t][1]
+                    if g < 0:
+                        continue
+                if zblocked[g]:
+                    continue
+                reach[g] = True
+                part[find(g)] = find(r)
+                if nout[g] > 1 and not expanded[g]:
+                    expanded[g] = True
+                    queue.append(g)
+        return reach, [find(v) for v in range(nz + ns)]
+
+    def traverse(self, num, dens, zblocked, tblocked, dt, min_density, max_density, counter, waiting=None, parts=None,
+                 exits=None):
+        ''' Один шаг: num (зоны + безопасные зоны) и dens (зоны) изменяются на месте.
+        Возвращает потенциалы и цвета узлов, посещённость зон и проёмов, потоки и цвета проёмов
+        и список затронутых зон.
+
+        waiting - множество достижимых зон, в которых есть люди, parts - номера частей из reach.
+        Если они заданы, обход идёт только от выходов частей с людьми и заканчивается, как только
+        все такие зоны отдали людей: зона больше не меняется после того, как она извлечена
+        из очереди (или, если у неё одна дверь, после прохода через эту дверь), а оставшиеся
+        в очереди пустые зоны могли бы перемещать только нули. Числа людей получаются такими же,
+        как при полном обходе; у непосещённых пустых зон не считаются потенциалы и цвета.
+
+        exits - (потенциалы, вместимости) безопасных зон, по умолчанию 0 и без ограничения.
+        Так подобласти BimParallel представляют соседние подобласти: безопасная зона с потенциалом
+        больше 0 забирает людей, только если зона по ту сторону проёма ещё не извлечена из очереди,
+        как зона за границей подобласти при обходе всего здания '''
+        topo, pfv = self.topo, self.pfv
+        nz, nt = topo.nz, topo.nt
+        limits = None
+        if exits is None:
+            pot = [math.inf] * nz + [0.0] * topo.ns
+        else:
+            pot = [math.inf] * nz + list(exits[0])
+            limits = exits[1]
+        color = [-1] * nz + list(range(topo.ns))
+        zvis = [False] * nz
+        tvis = [False] * nt
+        tflow = [0.0] * nt
+        tcolor = [-1] * nt
+        area, width, zlevel, nout = self.area, self.width, self.zlevel, self.nout
+        is_stair, outputs, transit_zones = self.is_stair, self.outputs, self.transit_zones
+        speed_in_room, speed_on_stair, speed_through_transit = pfv.speed_in_room, pfv.speed_on_stair, pfv.speed_through_transit
+
+        def speed_at_exit(r, g, w):
+            # Повторяет Moving.speed_at_exit и speed_in_element
+            gd = dens[g]
+            v_zone = speed_in_room(gd)
+            dh = zlevel[r] - zlevel[g]
+            if abs(dh) > 1e-3 and is_stair[r]:
+                v_zone = speed_on_stair(pfv.STAIR_DOWN if dh > 0 else pfv.STAIR_UP, gd)
+            return min(v_zone, speed_through_transit(w, gd))
+
+        # Куча с ленивым удалением, как в Moving.step; queued[узел] - номер живой записи
+        seq = itertools.count()
+        queued = [-1] * (nz + topo.ns)
+        zones_to_process = []
+        touched = []
+        if waiting is not None:
+            active_parts = {parts[z] for z in waiting}
+        for r in range(nz, nz + topo.ns):
+            if waiting is not None and parts[r] not in active_parts:
+                continue
+            queued[r] = n = next(seq)
+            zones_to_process.append((pot[r], n, r))
+        counter[1] = 0
+        capacity_cuts = 0
+
+        while zones_to_process:
+            if waiting is not None and not waiting:
+                break
+            _, n, r = heapq.heappop(zones_to_process)
+            if queued[r] != n:
+                continue
+            queued[r] = -1
+            if waiting is not None:
+                waiting.discard(r)
+            counter[2] = 0
+            for t in outputs[r]:
+                if tvis[t] or tblocked[t]:
+                    continue
+
+                g, transit_dir = transit_zones[t][0], 1
+                if g == r:
+                    g, transit_dir = transit_zones[t][1], -1
+                    if g < 0:
+                        continue
+                if zblocked[g]:
+                    continue
+                if limits is not None and r >= nz and pot[g] < pot[r]:
+                    continue
+
+                # Повторяет Moving.part_of_people_flow
+                w = width[t]
+                moved = dens[g] * speed_at_exit(r, g, w) * w * dt
+                if dens[g] <= min_density:
+                    if moved > num[g]:
+                        metrics.event("min_density_overflow", moved, "to", num[g])
+                    moved = num[g]
+                if r < nz or limits is not None:
+                    capacity = max_density * area[r] - num[r] if r < nz else limits[r - nz] - num[r]
+                    if capacity < 0:
+                        moved = 0.0
+                        capacity_cuts += 1
+                    elif not capacity > moved:
+                        moved = capacity
+                        capacity_cuts += 1
+
+                if num[g] < moved:
+                    metrics.event("flow_cut", moved, "to", num[g])
+                    moved = num[g]
+                num[r] += moved
+                num[g] -= moved
+                tflow[t] = moved * transit_dir
+
+                if r < nz:
+                    dens[r] = num[r] / area[r]
+                dens[g] = num[g] / area[g]
+
+                if not zvis[g]:
+                    zvis[g] = True
+                    touched.append(g)
+                tvis[t] = True
+                if waiting is not None and nout[g] <= 1:
+                    waiting.discard(g)
+
+                # отсекаем помещения, в которых одна дверь
+                enqueue = nout[g] > 1 and queued[g] < 0
+
+                new_pot = pot[r] + math.sqrt(area[g]) / speed_at_exit(r, g, w)
+                if new_pot < pot[g]:
+                    pot[g] = new_pot
+                    color[g] = color[r]
+                    tcolor[t] = color[r]
+                    enqueue = enqueue or queued[g] >= 0
+                if enqueue:
+                    queued[g] = n = next(seq)
+                    heapq.heappush(zones_to_process, (pot[g], n, g))
+
+                counter[2] += 1
+
+            counter[1] += 1
+
+        if metrics.enabled:
+            pushes = next(seq)
+            metrics.count("zones_processed", counter[1])
+            metrics.count("transits_processed", sum(tvis))
+            metrics.count("heap_pushes", pushes)
+            metrics.count("heap_pops", pushes - len(zones_to_process))
+            metrics.count("capacity_cuts", capacity_cuts)
+        return pot, color, zvis, tvis, tflow, tcolor, touched
+
+
+class ArrayMoving(Moving):
+    ''' Тот же алгоритм, что и в Moving, но топология здания пронумерована один раз (BimTopology),
+    а состояние между шагами хранится в массивах NumPy. В словари BIM состояние
+    записывается только по запросу: sync().
+
+    При skip_drained обход идёт только по частям здания, где есть люди, и заканчивается,
+    когда все зоны с людьми отдали их (см. ArrayKernel.traverse): работа шага растёт
+    с занятой частью здания, а не со всем зданием.
+
+    Вместо BIM можно передать BimTopology.Building: тогда модель не пишет в словари здания
+    ничего, ни при создании, ни в sync, и всё её состояние - массивы и безопасные зоны.
+    Словари с состоянием для отображения и экспорта даёт state_bim() '''
+
+    skip_drained = True
+    exits = None  # (потенциалы, вместимости) безопасных зон для ArrayKernel.traverse, см. BimParallel
+
+    def __init__(self, bim, topology=None) -> None:
+        ''' topology - готовая BimTopology этого здания (например, из BimCache) '''
+        if isinstance(bim, Building):
+            self._init_shared(bim)
+        else:
+            self.building = None
+            self.topo = topology or BimTopology(bim)
+            super().__init__(bim)
+        topo = self.topo
+        nz, ns = topo.nz, topo.ns
+        self._zone_dicts = [self.zones[zid] for zid in topo.zone_ids]
+        self._transit_dicts = [self.transits[tid] for tid in topo.transit_ids]
+        # Состояние узлов (зоны + безопасные зоны)
+        self.num_people = np.zeros(nz + ns)
+        self.potential = np.zeros(nz + ns)
+        self.color = np.full(nz + ns, -1, dtype=np.int64)  # номер безопасной зоны, чей цвет унаследован
+        self.color[nz:] = np.arange(ns)
+        # Состояние зон
+        self.density = np.zeros(nz)
+        self.zone_visited = np.zeros(nz, dtype=bool)
+        self.zone_blocked = np.zeros(nz, dtype=bool)
+        # Состояние проёмов
+        self.transit_flow = np.zeros(topo.nt)
+        self.transit_visited = np.zeros(topo.nt, dtype=bool)
+        self.transit_blocked = np.zeros(topo.nt, dtype=bool)
+        self.transit_color = np.full(topo.nt, -1, dtype=np.int64)
+        if self.building is None:
+            self.kernel = ArrayKernel(topo, self.pfv)
+        else:
+            self.kernel = self.building.shared.get("kernel")
+            if self.kernel is None:
+                self.kernel = self.building.shared["kernel"] = ArrayKernel(topo, self.pfv)
+        self._reach_key, self._reach = None, None  # достижимость при текущих блокировках
+        if self.building is None:
+            self.load()
+        else:
+            self._changed()
+
+    def _init_shared(self, building):
+        ''' То, что Moving.__init__ берёт из BIM, без записи в его словари '''
+        self.building = building
+        self.bim = building.bim
+        self.topo = topo = building.topology
+        self.pfv = PeopleFlowVelocity(projection_area=0.1)
+        self._step_counter = [0, 0, 0]
+        self.direction_pairs = {}
+        self.zones = building.zones
+        self.transits = building.transits
+        self.lvlname = building.lvlname
+        self.safety_zones = [{"Output": [topo.transit_ids[t]], "ZLevel": z, "NumPeople": 0.0, "Sign": "SZ", "Potential": 0.0}
+                             for t, z in zip(topo.sz_transit.tolist(), topo.node_zlevel[topo.nz:].tolist())]
+        self.time = 0.0
+
+    def zone_area(self, z):
+        return self.topo.zone_area[self.topo.zone_index[z["Id"]]].item()
+
+    def transit_width(self, t):
+        return self.topo.transit_width[self.topo.transit_index[t["Id"]]].item()
+
+    def load(self):
+        ''' Считывает состояние из словарей BIM, например после их ручного изменения '''
+        self.num_people[:self.topo.nz] = [z.get("NumPeople", 0.0) for z in self._zone_dicts]
+        self.num_people[self.topo.nz:] = [z["NumPeople"] for z in self.safety_zones]
+        self.density[:] = [z.get("Density", 0.0) for z in self._zone_dicts]
+        self.zone_blocked[:] = [z["IsBlocked"] for z in self._zone_dicts]
+        self.transit_blocked[:] = [t["IsBlocked"] for t in self._transit_dicts]
+        self._changed()
+
+    def _changed(self):
+        ''' Состояние изменено помимо step: пересчитать занятые зоны и остаток людей '''
+        self._occupied = None  # зоны, где могут быть люди
+        self._remaining = None  # людей в зонах, посещённых на последнем шаге
+
+    def sync(self):
+        ''' Записывает состояние из массивов в словари BIM (для BimViz, сервера и т.п.).
+        На общем здании (Building) ничего не делает: см. state_bim '''
+        if self.building is None:
+            self._write(self._zone_dicts, self._transit_dicts)
+        for z, n in zip(self.safety_zones, self.num_people[self.topo.nz:].tolist()):
+            z["NumPeople"] = n
+
+    def state_bim(self):
+        ''' BIM с текущим состоянием модели. На общем здании - копия его словарей (EvacAttackShared.state_copy)
+        с теми же полями, что Moving пишет в BIM: ZLevel у всех элементов, Area у зон, Width у проёмов '''
+        if self.building is None:
+            self.sync()
+            return self.bim
+        bim = state_copy(self.bim)
+        elements = {}
+        for lvl in bim['Level']:
+            for el in lvl['BuildElement']:
+                el.setdefault("ZLevel", lvl["ZLevel"])  # как Moving.__init__
+                elements[el["Id"]] = el
+        zone_dicts = [elements[zid] for zid in self.topo.zone_ids]
+        transit_dicts = [elements[tid] for tid in self.topo.transit_ids]
+        for z, area in zip(zone_dicts, self.topo.zone_area.tolist()):
+            z["Area"] = area
+        for t, width in zip(transit_dicts, self.topo.transit_width.tolist()):
+            t["Width"] = width
+        self._write(zone_dicts, transit_dicts)
+        return bim
+
+    def people_getter(self):
+        ''' Функция зона -> людей в ней сейчас (для Intruder на общем здании вместо словарей BIM) '''
+        values, index = self.num_people.tolist(), self.topo.zone_index
+        return lambda el: values[index[el["Id"]]]
+
+    def _write(self, zone_dicts, transit_dicts):
+        colors = [""] + [z.get("Color") for z in self.safety_zones]
+        for z, n, d, p, v, b, c in zip(zone_dicts, self.num_people.tolist(), self.density.tolist(), self.potential.tolist(),
+                                       self.zone_visited.tolist(), self.zone_blocked.tolist(), self.color.tolist()):
+            z["NumPeople"] = n
+            z["Density"] = d
+            z["Potential"] = p
+            z["IsVisited"] = v
+            z["IsBlocked"] = b
+            z["Color"] = colors[c + 1]
+        for t, n, v, b, c in zip(transit_dicts, self.transit_flow.tolist(), self.transit_visited.tolist(),
+                                 self.transit_blocked.tolist(), self.transit_color.tolist()):
+            t["NumPeople"] = n
+            t["IsVisited"] = v
+            t["IsBlocked"] = b
+            t["Color"] = colors[c + 1]
+
+    def set_density(self, density):
+        self.density.fill(density)
+        self._changed()
+        self.sync()
+
+    def set_people_by_density(self):
+        self.num_people[:self.topo.nz] = self.density * self.topo.zone_area
+        self._changed()
+        self.sync()
+
+    def block_zone(self, zone_id, blocked=True):
+        self.zone_blocked[self.topo.zone_index[zone_id]] = blocked
+
+    def take_people(self, zone_id):
+        i = self.topo.zone_index[zone_id]
+        people = self.num_people[i].item()
+        self.num_people[i] = 0
+        self.density[i] = 0
+        self._remaining = None
+        return people
+
+    def people_remaining(self):
+        ''' Считается на шаге по затронутым зонам, заново - только после изменений извне '''
+        if self._remaining is None:
+            self._remaining = (self.num_people[:self.topo.nz] * self.zone_visited).sum().item()
+        return self._remaining
+
+    STATE = ("num_people", "potential", "color", "density", "zone_visited", "zone_blocked",
+             "transit_flow", "transit_visited", "transit_blocked", "transit_color")
+
+    def snapshot(self):
+        ''' Копии массивов состояния и время; словари BIM не копируются '''
+        state = {name: getattr(self, name).copy() for name in self.STATE}
+        state["time"] = self.time
+        return state
+
+    def restore(self, state):
+        ''' Возвращает состояние snapshot этого же здания (или здания с той же топологией).
+        Словари BIM обновляются, так как их читает нарушитель '''
+        for name in self.STATE:
+            getattr(self, name)[:] = state[name]
+        self.time = state["time"]
+        self._changed()
+        self.sync()
+
+    def transit_speeds(self, pfv=None):
+        ''' Скорости выхода людей через все проёмы при текущих плотностях, одним вызовом.
+        Отдающей считается зона, из которой шёл поток на последнем шаге (или первая в Output).
+        pfv - PeopleFlowVelocity или VelocityTable '''
+        pfv, topo = pfv or self.pfv, self.topo
+        reverse = self.transit_flow < 0
+        giver = np.where(reverse, topo.transit_zones[:, 1], topo.transit_zones[:, 0])
+        receiver = np.where(reverse, topo.transit_zones[:, 0], topo.transit_zones[:, 1])
+        receiver = np.where(receiver < 0, topo.transit_sz_node, receiver)
+        has_receiver = receiver >= 0
+        receiver = np.where(has_receiver, receiver, giver)
+        dh = np.where(has_receiver, topo.node_zlevel[receiver] - topo.node_zlevel[giver], 0.0)
+        to_stair = (receiver < topo.nz) & (topo.zone_sign[np.minimum(receiver, topo.nz - 1)] == topo.STAIRCASE)
+        return pfv.speeds_at_exit(topo.transit_width, self.density[giver], dh, to_stair)
+
+    def step(self, dt=None):
+        ''' Шаг моделирования длиной dt мин. (по умолчанию MODELLING_STEP) '''
+        dt = dt or self.MODELLING_STEP
+        timed = metrics.enabled
+        if timed:
+            t0 = perf_counter()
+        self._step_counter[0] += 1
+        num = self.num_people.tolist()
+        dens = self.density.tolist()
+        waiting = parts = None
+        if self.skip_drained:
+            key = (self.zone_blocked.tobytes(), self.transit_blocked.tobytes())
+            if key != self._reach_key:
+                self._reach_key = key
+                self._reach = self.kernel.reach(self.zone_blocked.tolist(), self.transit_blocked.tolist())
+            reach, parts = self._reach
+            if self._occupied is None:
+                self._occupied = set(np.flatnonzero((self.num_people[:self.topo.nz] > 0) | (self.density > 0)).tolist())
+            waiting = {z for z in self._occupied if reach[z] and (num[z] > 0 or dens[z] > 0)}
+        if timed:
+            t1 = perf_counter()
+        pot, color, zvis, tvis, tflow, tcolor, touched = self.kernel.traverse(
+            num, dens, self.zone_blocked.tolist(), self.transit_blocked.tolist(),
+            dt, self.MIN_DENSIY, self.MAX_DENSIY, self._step_counter, waiting, parts, self.exits)
+        if timed:
+            t2 = perf_counter()
+        if self.skip_drained:
+            # Люди остаются только в затронутых зонах и в тех, до которых обход не дошёл
+            self._occupied = {z for z in touched if num[z] > 0 or dens[z] > 0} | \
+                             {z for z in self._occupied if not zvis[z] and (num[z] > 0 or dens[z] > 0)}
+        self._remaining = sum(num[z] for z in touched)
+        self.num_people[:] = num
+        self.density[:] = dens
+        self.potential[:] = pot
+        self.color[:] = color
+        self.zone_visited[:] = zvis
+        self.transit_visited[:] = tvis
+        self.transit_flow[:] = tflow
+        self.transit_color[:] = tcolor
+        self.time += dt
+        if timed:
+            metrics.add_time("step.reset", t1 - t0)
+            metrics.add_time("step.traverse", t2 - t1)
+            metrics.add_time("step.update", perf_counter() - t2)
+
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -307,22 +934,29 @@ if __name__ == "__main__":
     parser.add_argument('file', type=argparse.FileType('r'))  # file already opened by argparse
     args = parser.parse_args()
 
-    bim = json.load(args.file)
-    moving = Moving(bim)
-
-    for dens in (0.1, 0.2, 0.3):
-        szones = [(z, [0, ]) for z in moving.safety_zones]
-        for zone in moving.safety_zones:
-            zone["NumPeople"] = 0
-        moving.set_density(dens)
-        moving.set_people_by_density()
+    from BimEnsemble import EnsembleMoving
+    from BimCache import load_building
+    from BimRecorder import Recorder
+    bim, topology = load_building(args.file)
+    densities = (0.1, 0.2, 0.3)
+    moving = EnsembleMoving(bim, len(densities), topology)
+    moving.set_density(densities)
+    moving.set_people_by_density()
+    recorder = Recorder(fields=("exits",))
+    recorder.sample(moving)
+    moving.step()
+    steps = np.ones(len(densities), dtype=np.int64)
+    active = moving.people_remaining() > 0
+    while active.any():
+        recorder.record(moving)
         moving.step()
-        num_steps = 1
-        while sum([x["NumPeople"] for x in moving.zones.values() if x["IsVisited"]]) > 0:
-            for i in range(len(szones)):
-                szones[i][1].append(szones[i][0]["NumPeople"])
-            moving.step()
-            num_steps += 1
+        steps[active] += 1
+        active &= moving.people_remaining() > 0
+    exits = recorder["exits"]
+
+    for k, dens in enumerate(densities):
+        num_steps = steps[k]
+        szones = [(sz_id, exits[:num_steps, k, i].tolist()) for i, sz_id in enumerate(recorder.meta["exit_ids"])]
         x = [i*moving.MODELLING_STEP*60 for i in range(num_steps)]
         plt.figure()
         plt.margins(x=0, y=0)
@@ -330,8 +964,8 @@ if __name__ == "__main__":
         plt.xlabel('t, сек')
         plt.ylabel('N, кол-во человек в зоне безопасности')
         plt.grid()
-        for sz, sz_people in szones:
-            plt.plot(x, sz_people, label=sz["Output"][0])
+        for sz_id, sz_people in szones:
+            plt.plot(x, sz_people, label=sz_id)
         s = [sum(x) for x in zip(*(sz_people for sz, sz_people in szones))]
         plt.plot(x, s, label="Интегральная кривая")
         xi = 2.043
@@ -0,0 +1,176 @@
+import json
+import math
+import uuid
+
+
+class BimBuilder:
+    ''' Собирает BIM JSON в формате Level/BuildElement/Output/XY '''
+
+    def __init__(self, name="synthetic"):
+        self.name = name
+        self.levels = []
+        self._counter = 0
+
+    def _id(self):
+        self._counter += 1
+        return str(uuid.UUID(int=self._counter))
+
+    @staticmethod
+    def rect(x0, y0, x1, y1):
+        ''' Замкнутый прямоугольник в формате XY '''
+        return [{"points": [{"x": x, "y": y} for x, y in ((x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0))]}]
+
+    def add_level(self, z_level=0.0):
+        lvl = {"NameLevel": "Floor number %02d" % len(self.levels), "ZLevel": z_level, "BuildElement": []}
+        self.levels.append(lvl)
+        return lvl
+
+    def add_zone(self, lvl, x0, y0, x1, y1, sign="Room", size_z=3.0):
+        el = {"Name": "%s %d" % (sign, len(lvl["BuildElement"])), "Id": self._id(), "Sign": sign,
+              "SizeZ": size_z, "Output": [], "XY": self.rect(x0, y0, x1, y1)}
+        lvl["BuildElement"].append(el)
+        return el
+
+    def add_door(self, lvl, x0, y0, x1, y1, *zones, sign="DoorWayInt"):
+        el = {"Name": "%s %d" % (sign, len(lvl["BuildElement"])), "Id": self._id(), "Sign": sign,
+              "SizeZ": 0.0, "Output": [z["Id"] for z in zones], "XY": self.rect(x0, y0, x1, y1)}
+        for z in zones:
+            z["Output"].append(el["Id"])
+        lvl["BuildElement"].append(el)
+        return el
+
+    def bim(self):
+        return {"NameBuilding": self.name, "Level": self.levels}
+
+
+def add_stairs(b, floors, rect, door, attach, height=3.0):
+    ''' Лестница на всех этажах floors в прямоугольнике rect = (x0, y0, x1, y1): на каждом этаже -
+    зона Staircase, соединённая с помещением attach[n] этажа n дверью DoorWayInt в прямоугольнике door,
+    а соседние этажи соединены проёмом DoorWay между их лестничными зонами (проём относится
+    к нижнему этажу) '''
+    x0, y0, x1, y1 = rect
+    prev = None
+    for lvl, room in zip(floors, attach):
+        stair = b.add_zone(lvl, x0, y0, x1, y1, sign="Staircase", size_z=height)
+        b.add_door(lvl, *door, room, stair)
+        if prev is not None:
+            b.add_door(prev[0], x0, y0, x0 + 0.2, y1, prev[1], stair, sign="DoorWay")
+        prev = lvl, stair
+
+
+def _floors(b, levels, height=3.0):
+    return [b.add_level(n * height) for n in range(levels)] if levels > 1 else [b.add_level()]
+
+
+def corridor_building(rooms, room_w=4.0, room_d=5.0, corridor_w=2.0, door_w=1.0, levels=1):
+    ''' Коридор, разбитый на участки, с помещениями по обе стороны и выходами на обоих концах.
+    rooms - число боковых помещений на этаже, всего зон около 1.5*rooms на этаж.
+    При levels > 1 этажи одинаковые, выходы только на первом, концы коридоров соединены лестницами '''
+    b = BimBuilder("corridor_%d" % rooms if levels == 1 else "corridor_%dx%d" % (rooms, levels))
+    floors = _floors(b, levels)
+    segments = max(1, (rooms + 1) // 2)
+    y0, y1 = 0.0, corridor_w
+    ends = []
+    for n, lvl in enumerate(floors):
+        prev = first = None
+        for i in range(segments):
+            x0, x1 = i * room_w, (i + 1) * room_w
+            seg = b.add_zone(lvl, x0, y0, x1, y1)
+            if prev is None:
+                first = seg
+                if n == 0:
+                    b.add_door(lvl, x0 - 0.2, y0 + 0.5, x0, y0 + 0.5 + door_w, seg, sign="DoorWayOut")
+            else:
+                b.add_door(lvl, x0 - 0.1, y0, x0 + 0.1, y1, prev, seg, sign="DoorWay")
+            for side in range(2):
+                if 2 * i + side >= rooms:
+                    break
+                xm = (x0 + x1 - door_w) / 2
+                if side == 0:
+                    room = b.add_zone(lvl, x0, y1, x1, y1 + room_d)
+                    b.add_door(lvl, xm, y1 - 0.1, xm + door_w, y1 + 0.1, seg, room)
+                else:
+                    room = b.add_zone(lvl, x0, y0 - room_d, x1, y0)
+                    b.add_door(lvl, xm, y0 - 0.1, xm + door_w, y0 + 0.1, seg, room)
+            prev = seg
+        x1 = segments * room_w
+        if n == 0:
+            b.add_door(lvl, x1, y0 + 0.5, x1 + 0.2, y0 + 0.5 + door_w, prev, sign="DoorWayOut")
+        ends.append((first, prev))
+    if levels > 1:
+        x1 = segments * room_w
+        ym = (y0 + y1) / 2
+        add_stairs(b, floors, (-room_w, y0, 0.0, y1), (-0.1, ym - door_w / 2, 0.1, ym + door_w / 2), [first for first, _ in ends])
+        add_stairs(b, floors, (x1, y0, x1 + room_w, y1), (x1 - 0.1, ym - door_w / 2, x1 + 0.1, ym + door_w / 2), [last for _, last in ends])
+    return b.bim()
+
+
+def grid_building(nx, ny, levels=1, room=5.0, door_w=1.0, exits=4, stairs=2):
+    ''' Этажи-сетки nx * ny помещений, соседние помещения соединены дверями DoorWayInt.
+    На первом этаже exits выходов по периметру, этажи соединены stairs лестницами
+    вдоль левой стороны сетки. Элементов около 3 * nx * ny на этаж '''
+    b = BimBuilder("grid_%dx%dx%d" % (nx, ny, levels))
+    floors = _floors(b, levels)
+    grids = []
+    for n, lvl in enumerate(floors):
+        cells = [[b.add_zone(lvl, i * room, j * room, (i + 1) * room, (j + 1) * room) for j in range(ny)] for i in range(nx)]
+        for i in range(nx):
+            for j in range(ny):
+                x, y = (i + 1) * room, (j + 0.5) * room
+                if i + 1 < nx:
+                    b.add_door(lvl, x - 0.1, y - door_w / 2, x + 0.1, y + door_w / 2, cells[i][j], cells[i + 1][j])
+                x, y = (i + 0.5) * room, (j + 1) * room
+                if j + 1 < ny:
+                    b.add_door(lvl, x - door_w / 2, y - 0.1, x + door_w / 2, y + 0.1, cells[i][j], cells[i][j + 1])
+        grids.append(cells)
+    # Выходы равномерно по периметру первого этажа
+    perimeter = [(i, 0, 0) for i in range(nx)] + [(nx - 1, j, 1) for j in range(ny)] + \
+                [(i, ny - 1, 2) for i in reversed(range(nx))] + [(0, j, 3) for j in reversed(range(ny))]
+    for k in range(min(exits, len(perimeter))):
+        i, j, side = perimeter[k * len(perimeter) // exits]
+        cx, cy = (i + 0.5) * room, (j + 0.5) * room
+        x0, y0, x1, y1 = ((cx - door_w / 2, j * room - 0.2, cx + door_w / 2, j * room),
+                          ((i + 1) * room, cy - door_w / 2, (i + 1) * room + 0.2, cy + door_w / 2),
+                          (cx - door_w / 2, (j + 1) * room, cx + door_w / 2, (j + 1) * room + 0.2),
+                          (i * room - 0.2, cy - door_w / 2, i * room, cy + door_w / 2))[side]
+        b.add_door(floors[0], x0, y0, x1, y1, grids[0][i][j], sign="DoorWayOut")
+    if levels > 1:
+        for k in range(max(1, stairs)):
+            j = (2 * k + 1) * ny // (2 * max(1, stairs))
+            ym = (j + 0.5) * room
+            add_stairs(b, floors, (-room, j * room, 0.0, (j + 1) * room), (-0.1, ym - door_w / 2, 0.1, ym + door_w / 2),
+                       [cells[0][j] for cells in grids])
+    return b.bim()
+
+
+def sized_building(elements, kind="grid", levels=1):
+    ''' Здание примерно из elements элементов (зон и проёмов): от десятков до сотен тысяч '''
+    per_level = max(1, elements // levels)
+    if kind == "corridor":
+        # На боковое помещение приходится около 3 элементов (помещение, дверь, половина участка и проёма)
+        return corridor_building(max(1, round(per_level / 3)), levels=levels)
+    rooms = max(1, round(per_level / 3))
+    nx = max(1, round(math.sqrt(rooms)))
+    return grid_building(nx, max(1, round(rooms / nx)), levels=levels)
+
+
+def count_elements(bim):
+    return sum(len(lvl["BuildElement"]) for lvl in bim["Level"])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Generation of synthetic BIM JSON')
+    parser.add_argument('rooms', type=int, help='side rooms per floor for a corridor, rooms per floor for a grid')
+    parser.add_argument('file', type=argparse.FileType('w'))
+    parser.add_argument('--kind', choices=('corridor', 'grid'), default='corridor')
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--exits', type=int, default=4, help='exits of a grid building')
+    parser.add_argument('--stairs', type=int, default=2, help='staircases of a grid building')
+    args = parser.parse_args()
+    if args.kind == 'corridor':
+        bim = corridor_building(args.rooms, levels=args.levels)
+    else:
+        nx = max(1, round(math.sqrt(args.rooms)))
+        bim = grid_building(nx, max(1, round(args.rooms / nx)), args.levels, exits=args.exits, stairs=args.stairs)
+    json.dump(bim, args.file, indent=1)
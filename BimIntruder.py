@@ -1,13 +1,23 @@
+import copy
 import math
-from operator import itemgetter, truediv
-from EvacAttackShared import cntr_real, dict_peak
+from collections import deque
+from operator import itemgetter
+from EvacAttackShared import cntr_real
+
+
+def per_distance(people, distance):
+    ''' Люди на единицу расстояния. Лестничные зоны соседних этажей лежат одна над другой,
+    и расстояние между их центрами бывает нулевым: тогда люди достаются даром '''
+    if distance > 0:
+        return people / distance
+    return math.inf if people > 0 else 0.0
 
 
 class Intruder:
 
     def get_door(self, room1, room2):
         if room1 == room2:
-            print("Get_door: same room as arguments! "+room1["Name"])
+            print("Get_door: same room as arguments! "+room1.get("Name", room1["Id"]))
             return
         for door1 in room1["Output"]:
             for door2 in room2["Output"]:
@@ -19,16 +29,18 @@ class Intruder:
         return (self.get_el(room_id) for door_id in start_room["Output"] if self.get_el(door_id)['Sign'] in ('DoorWayInt', 'DoorWay') for room_id in self.get_el(door_id)["Output"] if room_id != start_room["Id"])
 
     def bfs(self, v, Q, visits):
-        ''' Проходимся по графу по ширине '''
-        if not (visits.get(v["Id"]) is None):
-            return
-        visits[v['Id']] = 0
-        for i in self.neighbours(v):  # Все смежные с v вершины
-            if visits.get(i['Id']) is None:
-                Q.append(i)
-                i["GLevel"] = v["GLevel"] + 1
+        ''' Проходимся по графу по ширине. Без рекурсии: на больших зданиях она упиралась в предел глубины '''
+        Q = deque(Q)
+        Q.appendleft(v)
         while Q:
-            self.bfs(Q.pop(0), Q, visits)
+            v = Q.popleft()
+            if not (visits.get(v["Id"]) is None):
+                continue
+            visits[v['Id']] = 0
+            for i in self.neighbours(v):  # Все смежные с v вершины
+                if visits.get(i['Id']) is None:
+                    Q.append(i)
+                    self.glevel[i["Id"]] = self.glevel[v["Id"]] + 1
 
     def get_el(self, el_id):
         ''' Находит элемент по Id '''
@@ -43,33 +55,80 @@ class Intruder:
         door = from_room if from_room["Sign"] == 'DoorWayOut' else self.get_door(from_room, to_room)  # для входа
         vis[door["Id"]] += 1
         vis[to_room["Id"]] += 1
-        eff = to_room['NumPeople']
+        eff = self.people_in(to_room)
         variants = [self.step(to_room, next_to_room, vis.copy(), curr_path + [to_room]) for next_to_room in self.step_variants(to_room, vis.copy(), curr_path + [to_room])]
         # Условия прекращения рекурсии
-        if not variants or vis[door["Id"]] >= 3 or to_room["GLevel"] == self.max_lvl:
+        if not variants or vis[door["Id"]] >= 3 or self.glevel[to_room["Id"]] == self.max_lvl:
             return curr_path + [to_room], eff
         # Выбираем самый эффективный вариант
         path, max_eff = max(variants, key=itemgetter(1))
         return path, max_eff + eff
 
-    def vision(self, room, vis, curr_path, lvl=0):
-        curr_room_dist = math.dist(cntr_real(curr_path[-1]), cntr_real(curr_path[-2]))
-        if lvl >= self.vision_lvl:
-            return room["NumPeople"], curr_room_dist
-        vis[room["Id"]] += 1
-        v = [self.vision(n, vis.copy(), curr_path + [n], lvl + 1) for n in self.neighbours(room) if vis[n["Id"]] == 0]
-        pep, dist = sum((p for p, d in v)), sum((d for p, d in v))
-        return pep + room["NumPeople"], dist + curr_room_dist
+    def search(self, from_room, to_room, vis, curr_path):
+        ''' То же, что step, для нарушителя типа 1 без перебора: его ходы идут только на следующий
+        уровень GLevel, поэтому граф ходов ациклический, и лучшее продолжение из помещения
+        не зависит от пути к нему. Продолжения считаются один раз в обратном порядке обхода,
+        ничьи разрешаются первым вариантом, как в max, суммы складываются в том же порядке.
+        Дверь не может встретиться на пути дважды, поэтому правило vis[дверь] >= 3 зависит
+        только от vis на входе '''
+        def stops(a, b):
+            door = a if a["Sign"] == 'DoorWayOut' else self.get_door(a, b)
+            return vis[door["Id"]] + 1 >= 3 or self.glevel[b["Id"]] == self.max_lvl
+
+        best = {}  # Id помещения -> (следующее помещение, эффективность пути от него) или None
+        stack = [to_room]
+        while stack:
+            room = stack[-1]
+            if room["Id"] in best:
+                stack.pop()
+                continue
+            variants = self.step_variants(room, vis, curr_path)
+            pending = [n for n in variants if n["Id"] not in best]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            choice = None
+            for n in variants:
+                eff = self.people_in(n)
+                if best[n["Id"]] is not None and not stops(room, n):
+                    eff = best[n["Id"]][1] + eff
+                if choice is None or eff > choice[1]:
+                    choice = (n, eff)
+            best[room["Id"]] = choice
+
+        path = curr_path + [to_room]
+        eff = self.people_in(to_room)
+        if best[to_room["Id"]] is None or stops(from_room, to_room):
+            return path, eff
+        eff = best[to_room["Id"]][1] + eff
+        room = to_room
+        while True:
+            nextp = best[room["Id"]][0]
+            path.append(nextp)
+            if best[nextp["Id"]] is None or stops(room, nextp):
+                return path, eff
+            room = nextp
+
+    def vision(self, room, vis, curr_path):
+        ''' Люди и расстояние, которые нарушитель видит из помещения room на vision_lvl помещений вперёд,
+        придя в него из curr_path[-2]. Считается через Lookahead '''
+        return self.lookahead.view(room, curr_path[-2], vis, self.vision_lvl)
+
+    def occupancy_changed(self):
+        ''' Люди в помещениях изменились: сбрасывает запомненные результаты обзора '''
+        self.lookahead.occupancy_changed()
 
     def step_variants(self, room, vis, curr_path):
         if self.intruder_type == 1:
-            return [n for n in self.neighbours(room) if n["GLevel"] == room["GLevel"] + 1 and n not in self.disabled_rooms]
+            glevel = self.glevel
+            return [n for n in self.neighbours(room) if glevel[n["Id"]] == glevel[room["Id"]] + 1 and n not in self.disabled_rooms]
         elif self.intruder_type in (2, 3):
             # Варианты перехода во все непосещённые помещения
             v = [n for n in self.neighbours(room) if vis[n["Id"]] == 0 and n not in self.disabled_rooms]
             if self.intruder_type == 3:
                 # Нарушитель типа 3 предпочтёт путь с наибольшим уроном за время
-                visible = [(truediv(*self.vision(n, vis.copy(), curr_path + [n])), n) for n in v]
+                visible = [(per_distance(*self.vision(n, vis.copy(), curr_path + [n])), n) for n in v]
             else:
                 # Нарушитель типа 2 предпочтёт путь с наибольшим уроном в принципе
                 visible = [(self.vision(n, vis.copy(), curr_path + [n])[0], n) for n in v]
@@ -79,7 +138,8 @@ class Intruder:
                     return [max_eff[1]]
                 else:
                     # выбираем высокоуровневые варианты
-                    hi_lev = dict_peak(v, "GLevel", True)  # [max(v, key=itemgetter("GLevel"))]
+                    top = max(self.glevel[n["Id"]] for n in v)
+                    hi_lev = [n for n in v if self.glevel[n["Id"]] == top]
                     # из них можно выбрать вариант с наиболее быстро преодолеваемыми дверными проёмами
                     # а пока выберем вариант с наибольшим возможным расстоянием (наименьшее кол-во дверей за расстояние)
                     return [max(((self.vision(n, vis.copy(), curr_path + [n])[1], n) for n in hi_lev), key=itemgetter(0))[1]]
@@ -93,51 +153,209 @@ class Intruder:
                     return [back]
             return []  # ???
 
-    def __init__(self, j, choosen_door, precalculate_path=False, intruder_type=1, intruder_speed=60, disabled_rooms=[]):
+    def __init__(self, j, choosen_door, precalculate_path=False, intruder_type=1, intruder_speed=60, disabled_rooms=[], levels=None,
+                 vision_lvl=3, vision_mode="paths", people_in=None, elements=None):
+        ''' levels - готовые GLevel {Id: уровень} от входа choosen_door (BimTopology.entry_glevels),
+        чтобы не обходить здание заново. vision_mode - режим обзора нарушителей типа 2 и 3, см. Lookahead.
+        people_in - функция помещение -> людей в нём, по умолчанию el["NumPeople"] из словарей BIM;
+        elements - готовый словарь {Id: элемент} здания (Building.elements).
+        Нарушитель не пишет в словари BIM: уровни обхода хранятся в self.glevel '''
         self.intruder_type = intruder_type
-        self.vision_lvl = 3
+        self.vision_lvl = vision_lvl
+        self.lookahead = Lookahead(self, vision_mode)
         self.j = j
-        self.bim_el = {e['Id']: e for lvl in self.j['Level'] for e in lvl['BuildElement']}
+        self.bim_el = elements if elements is not None else {e['Id']: e for lvl in self.j['Level'] for e in lvl['BuildElement']}
+        self.people_in = people_in or itemgetter("NumPeople")
         self.disabled_rooms = disabled_rooms
         top_door = self.get_out_doors()[choosen_door]
         top_room = self.get_el(top_door['Output'][0])
-        top_room["GLevel"] = 0
-        self.bfs(top_room, [], {})
-        self.max_lvl = max((e["GLevel"] for lvl in self.j['Level'] for e in lvl['BuildElement'] if e.get("GLevel")))
+        if levels is None:
+            self.glevel = {top_room["Id"]: 0}
+            self.bfs(top_room, [], {})
+        else:
+            self.glevel = levels
+        self.max_lvl = max((lvl for lvl in self.glevel.values() if lvl))
         self.bim_visits = {e['Id']: 0 for lvl in self.j['Level'] for e in lvl['BuildElement']}
         self.bim_curr_path = [top_door, top_room]
         self.bim_visits[top_door["Id"]] += 1
         self.bim_visits[top_room["Id"]] += 1
+        self.path_length = math.dist(cntr_real(top_door), cntr_real(top_room))  # длина bim_curr_path
         self.speed = intruder_speed
+        self.stuck = False  # на последнем шаге идти было некуда
         self.precalculate_path = precalculate_path
         if precalculate_path:
-            self.p_path = self.step(self.get_el(top_door["Id"]), top_room, self.bim_visits.copy(), [])[0][1:]
+            search = self.search if intruder_type == 1 else self.step
+            self.p_path = search(self.get_el(top_door["Id"]), top_room, self.bim_visits.copy(), [])[0][1:]
 
     def step_next(self):
+        self.occupancy_changed()  # со времени прошлого шага люди переместились
         if self.precalculate_path:
             nextp = self.p_path.pop(0) if self.p_path else None
         elif self.intruder_type==1:
             # Повторяем последний шаг и берём путь дальше
-            nextp, next_eff = self.step(*self.bim_curr_path[-2:], self.bim_visits.copy(), self.bim_curr_path.copy())
+            nextp, next_eff = self.search(*self.bim_curr_path[-2:], self.bim_visits.copy(), self.bim_curr_path.copy())
             if len(nextp) > len(self.bim_curr_path)+1:
                 nextp = nextp[len(self.bim_curr_path)+1]
             else:
                 nextp = None
         else:
-            nextp = self.step_variants(self.bim_curr_path[-1], self.bim_visits, self.bim_curr_path)[0]
+            variants = self.step_variants(self.bim_curr_path[-1], self.bim_visits, self.bim_curr_path)
+            nextp = variants[0] if variants else None  # из тупика без обратной двери идти некуда
         if nextp:
             self.bim_visits[nextp["Id"]] += 1
             self.bim_visits[self.get_door(self.bim_curr_path[-1], nextp)["Id"]] += 1
+            self.path_length += math.dist(cntr_real(self.bim_curr_path[-1]), cntr_real(nextp))
             self.bim_curr_path.append(nextp)
         else:
             pass # print("INTRUDER NO PATH")
+        self.stuck = not nextp
+
+    def path_exhausted(self):
+        ''' Путь пройден: заранее рассчитанный путь кончился, или на последнем шаге идти было некуда '''
+        return not self.p_path if self.precalculate_path else self.stuck
+
+    def snapshot(self):
+        ''' Изменяемое состояние: путь (по Id), посещения, длина пути, жертвы '''
+        state = {"path": [el["Id"] for el in self.bim_curr_path],
+                 "visits": self.bim_visits.copy(),
+                 "path_length": self.path_length,
+                 "victims": getattr(self, "victims", 0.0),
+                 "stuck": self.stuck}
+        if self.precalculate_path:
+            state["p_path"] = [el["Id"] for el in self.p_path]
+        return state
+
+    def restore(self, state):
+        ''' Возвращает состояние snapshot; элементы пути берутся из своего BIM по Id '''
+        self.bim_curr_path = [self.get_el(el_id) for el_id in state["path"]]
+        self.bim_visits = state["visits"].copy()
+        self.path_length = state["path_length"]
+        self.victims = state["victims"]
+        self.stuck = state["stuck"]
+        if self.precalculate_path:
+            self.p_path = [self.get_el(el_id) for el_id in state["p_path"]]
+        self.occupancy_changed()
+
+    def clone(self, j):
+        ''' Нарушитель в том же состоянии на копии здания j (элементы с теми же Id), без нового поиска пути '''
+        other = copy.copy(self)
+        if j is not self.j:
+            other.j = j
+            other.bim_el = {e['Id']: e for lvl in j['Level'] for e in lvl['BuildElement']}
+        other.lookahead = Lookahead(other, self.lookahead.mode)
+        other.restore(self.snapshot())
+        return other
 
     def path_len(self):
-        len_path = 0
-        for a, b in zip(self.bim_curr_path, self.bim_curr_path[1:]):
-            len_path += math.dist(cntr_real(a), cntr_real(b))
-        return len_path
+        ''' Длина пройденного пути, накапливается в step_next в том же порядке сложения '''
+        return self.path_length
+
+    def arrival_time(self):
+        ''' Время (мин.), когда нарушитель дойдёт до последнего помещения пути и сделает следующий шаг '''
+        return self.path_length / self.speed
 
     def get_out_doors(self):
         ''' Ищем входные двери'''
         return [el for lvl in self.j['Level'] for el in lvl['BuildElement'] if el['Sign'] == "DoorWayOut"]
+
+
+class Lookahead:
+    ''' Обзор нарушителя на depth помещений вперёд над смежностью помещений, которая строится
+    один раз (соседи в порядке Intruder.neighbours, расстояния между центрами).
+
+    mode "paths" - как прежний рекурсивный vision: люди и расстояния суммируются по всем путям
+    длины depth без повторных помещений, результат совпадает до бита. Дерево путей зависит
+    только от того, какие помещения рядом уже посещены, поэтому оно запоминается по маске
+    посещений, а люди пересчитываются только после occupancy_changed().
+    mode "horizon" - обход в ширину на depth помещений: каждое помещение считается один раз,
+    расстояние - сумма рёбер дерева обхода. Не растёт экспоненциально с depth '''
+
+    def __init__(self, intruder, mode="paths"):
+        if mode not in ("paths", "horizon"):
+            raise ValueError("Unknown vision mode: " + mode)
+        self.intruder = intruder
+        self.mode = mode
+        self.index = {}  # Id помещения -> номер
+        self.rooms = []
+        self.adj = []  # номер -> [(номер соседа, расстояние)], заполняется по мере надобности
+        self.balls = {}  # (номер, глубина) -> Id помещений в пределах глубины
+        self.views = {}  # (номер, Id предыдущего, глубина, маска) -> (дерево или помещения, расстояние)
+        self.people = {}  # тот же ключ -> люди
+
+    def occupancy_changed(self):
+        self.people.clear()
+
+    def _node(self, room):
+        i = self.index.get(room["Id"])
+        if i is None:
+            i = self.index[room["Id"]] = len(self.rooms)
+            self.rooms.append(room)
+            self.adj.append(None)
+        return i
+
+    def neighbours(self, i):
+        if self.adj[i] is None:
+            room = self.rooms[i]
+            c = cntr_real(room)
+            self.adj[i] = [(self._node(n), math.dist(cntr_real(n), c)) for n in self.intruder.neighbours(room)]
+        return self.adj[i]
+
+    def ball(self, i, depth):
+        key = (i, depth)
+        if key not in self.balls:
+            seen, layer = {i}, [i]
+            for _ in range(depth):
+                layer = [n for v in layer for n, d in self.neighbours(v) if n not in seen and not seen.add(n)]
+            self.balls[key] = [self.rooms[n]["Id"] for n in seen]
+        return self.balls[key]
+
+    def view(self, room, prev, vis, depth):
+        ''' (люди, расстояние) из room при входе из prev, vis - посещения {Id: количество} '''
+        i = self._node(room)
+        key = (i, prev["Id"], depth, tuple(vis[e] == 0 for e in self.ball(i, depth)))
+        view = self.views.get(key)
+        if view is None:
+            d = math.dist(cntr_real(room), cntr_real(prev))
+            if self.mode == "paths":
+                view = self.views[key] = self._paths(i, d, vis, set(), depth)
+            else:
+                view = self.views[key] = self._horizon(i, d, vis, depth)
+        people = self.people.get(key)
+        if people is None:
+            rooms = self.rooms
+            if self.mode == "paths":
+                people = self.people[key] = self._paths_people(view[0])
+            else:
+                people_in = self.intruder.people_in
+                people = self.people[key] = sum(people_in(rooms[n]) for n in view[0])
+        return people, view[1]
+
+    def _paths(self, i, d, vis, path, depth):
+        ''' Дерево путей (номер, поддеревья или None для листа) и расстояние, как в прежнем vision '''
+        if depth <= 0:
+            return (i, None), d
+        path.add(i)
+        v = [self._paths(n, dn, vis, path, depth - 1) for n, dn in self.neighbours(i)
+             if n not in path and vis[self.rooms[n]["Id"]] == 0]
+        path.discard(i)
+        return (i, [t for t, _ in v]), sum((dn for _, dn in v)) + d
+
+    def _paths_people(self, tree):
+        i, children = tree
+        if children is None:
+            return self.intruder.people_in(self.rooms[i])
+        return sum([self._paths_people(t) for t in children]) + self.intruder.people_in(self.rooms[i])
+
+    def _horizon(self, i, d, vis, depth):
+        seen, order, layer, dist = {i}, [i], [i], d
+        for _ in range(depth):
+            nxt = []
+            for v in layer:
+                for n, dn in self.neighbours(v):
+                    if n not in seen and vis[self.rooms[n]["Id"]] == 0:
+                        seen.add(n)
+                        nxt.append(n)
+                        dist += dn
+            order += nxt
+            layer = nxt
+        return order, dist
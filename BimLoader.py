@@ -0,0 +1,256 @@
+import codecs
+import gc
+import json
+import re
+import sys
+from array import array
+
+# Поля элемента, нужные модели; остальные (Name, описания и т.п.) при компактной загрузке отбрасываются
+ELEMENT_FIELDS = ("Id", "Sign", "Output", "ZLevel", "SizeZ")
+LEVEL_FIELDS = ("NameLevel", "ZLevel")
+BUILDING_FIELDS = ("NameBuilding",)
+CHUNK = 1 << 20  # символов, читаемых из файла за раз
+
+_space = re.compile(r'\s*')
+
+
+class JsonStream:
+    ''' Разбор JSON по частям: файл читается кусками по chunk, контейнеры верхних уровней
+    обходятся вручную (members, items), а листовые значения и небольшие объекты разбираются
+    json.JSONDecoder.raw_decode. В памяти - только текущий кусок текста.
+    digest - hashlib-объект, в который передаются все прочитанные байты (для ключа BimCache) '''
+
+    def __init__(self, f, chunk=CHUNK, digest=None):
+        self.f = f
+        self.chunk = chunk
+        self.digest = digest
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.scan = json.JSONDecoder().scan_once  # raw_decode без обёртки
+
+    def _fill(self, size):
+        data = self.f.read(size)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.digest is not None:
+            self.digest.update(data)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + self.text.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        ''' Следующий значимый символ ('' в конце файла) '''
+        while True:
+            self.pos = _space.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill(self.chunk):
+                return self.buf[self.pos:self.pos + 1]
+
+    def take(self, ch):
+        ''' Пропускает символ ch, если он следующий '''
+        if self.peek() == ch:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, ch):
+        if not self.take(ch):
+            raise ValueError("expected %r at %r" % (ch, self.buf[self.pos:self.pos + 40]))
+
+    def value(self):
+        ''' Следующее значение целиком. Значение, не поместившееся в буфер, дочитывается
+        кусками, каждый раз вдвое большими '''
+        self.peek()
+        size = self.chunk
+        while True:
+            try:
+                value, end = self.scan(self.buf, self.pos)
+                # число в конце буфера могло быть обрезано
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except (json.JSONDecodeError, StopIteration):
+                if self.eof:
+                    raise ValueError("invalid JSON at %r" % self.buf[self.pos:self.pos + 40]) from None
+            self._fill(size)
+            size *= 2
+
+    def members(self):
+        ''' Ключи объекта; значение каждого ключа должен прочитать вызывающий (value, items, members) '''
+        self.expect('{')
+        if self.take('}'):
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if not self.take(','):
+                self.expect('}')
+                return
+
+    def items(self):
+        ''' Элементы массива; каждый должен прочитать вызывающий '''
+        self.expect('[')
+        if self.take(']'):
+            return
+        while True:
+            yield
+            if not self.take(','):
+                self.expect(']')
+                return
+
+
+def pack_xy(xy):
+    ''' Многоугольники XY в массивы array('d') координат x0, y0, x1, y1, ... - ровно те точки,
+    по которым EvacAttackShared.Geometry считает центр, площадь и ширину '''
+    packed = []
+    for polygon in xy:
+        if "points" in polygon:
+            coords = [c for p in polygon["points"] for c in (p["x"], p["y"])]
+        else:
+            coords = [c for p in polygon[:-1] for c in p]
+        packed.append(array('d', coords))
+    return packed
+
+
+def unpack_xy(xy):
+    ''' Обратно в формат BIM JSON {"points": [{"x", "y"}, ...]} '''
+    return [{"points": [{"x": x, "y": y} for x, y in zip(p[::2], p[1::2])]} if isinstance(p, array) else p for p in xy]
+
+
+def compact_element(el, ids, keep=()):
+    ''' Элемент только с полями ELEMENT_FIELDS и keep, XY упакован, строки Id общие для всех ссылок (ids) '''
+    c = {"Id": ids.setdefault(el["Id"], el["Id"]), "Sign": sys.intern(el["Sign"]),
+         "Output": [ids.setdefault(o, o) for o in el.get("Output", ())]}
+    for name in ELEMENT_FIELDS[3:] + tuple(keep):
+        if name in el:
+            c[name] = el[name]
+    c["XY"] = pack_xy(el["XY"])
+    return c
+
+
+def load_compact(file, keep=(), chunk=CHUNK, digest=None):
+    ''' Читает BIM JSON (путь или открытый файл) по частям и оставляет только то, что нужно модели:
+    Id, Sign, Output, ZLevel, SizeZ и многоугольники в виде упакованных массивов (pack_xy).
+    keep - дополнительные поля элементов (например, "Name" для визуализации).
+    Результат - BIM той же структуры Level/BuildElement, его принимают Moving, ArrayMoving,
+    BimTopology и Intruder. digest - hashlib-объект для хэша содержимого файла '''
+    if not hasattr(file, "read"):
+        with open(file, 'rb') as f:
+            return load_compact(f, keep, chunk, digest)
+    stream = JsonStream(file, chunk, digest)
+    ids = {}
+    bim = {}
+    # Загруженные объекты не образуют циклов, а временные освобождаются счётчиком ссылок:
+    # сборщик мусора только обходил бы растущую кучу
+    collect = gc.isenabled()
+    gc.disable()
+    try:
+        _load_levels(stream, bim, ids, keep)
+    finally:
+        if collect:
+            gc.enable()
+    while digest is not None and stream._fill(chunk):
+        pass  # хэш - от всего файла
+    return bim
+
+
+def _load_levels(stream, bim, ids, keep):
+    for key in stream.members():
+        if key != "Level":
+            value = stream.value()
+            if key in BUILDING_FIELDS:
+                bim[key] = value
+            continue
+        bim["Level"] = levels = []
+        for _ in stream.items():
+            lvl = {}
+            for lkey in stream.members():
+                if lkey == "BuildElement":
+                    lvl["BuildElement"] = [compact_element(stream.value(), ids, keep) for _ in stream.items()]
+                else:
+                    value = stream.value()
+                    if lkey in LEVEL_FIELDS:
+                        lvl[lkey] = value
+            levels.append(lvl)
+
+
+def to_bim(bim):
+    ''' Компактный BIM в обычный BIM JSON (многоугольники - списками точек) '''
+    return dict(bim, Level=[dict(lvl, BuildElement=[dict(el, XY=unpack_xy(el["XY"])) for el in lvl["BuildElement"]])
+                            for lvl in bim["Level"]])
+
+
+def export(bim, out, source=None, chunk=CHUNK):
+    ''' Записывает компактный BIM как BIM JSON в открытый текстовый файл out, по элементу за раз.
+    source - исходный файл: тогда он читается заново и каждый его элемент записывается со всеми
+    исходными полями, поверх которых - поля модели (NumPeople, Density и т.п.) '''
+    dumps = json.dumps
+    if source is None:
+        out.write('{')
+        out.write(''.join('%s: %s, ' % (dumps(k), dumps(v)) for k, v in bim.items() if k != "Level"))
+        out.write('"Level": [')
+        for n, lvl in enumerate(bim["Level"]):
+            out.write(', {' if n else '{')
+            out.write(''.join('%s: %s, ' % (dumps(k), dumps(v)) for k, v in lvl.items() if k != "BuildElement"))
+            out.write('"BuildElement": [')
+            for i, el in enumerate(lvl["BuildElement"]):
+                out.write((', ' if i else '') + dumps(dict(el, XY=unpack_xy(el["XY"]))))
+            out.write(']}')
+        out.write(']}')
+        return
+    if not hasattr(source, "read"):
+        with open(source, 'rb') as f:
+            return export(bim, out, f, chunk)
+    elements = {el["Id"]: el for lvl in bim["Level"] for el in lvl["BuildElement"]}
+    stream = JsonStream(source, chunk)
+    out.write('{')
+    for n, key in enumerate(stream.members()):
+        out.write((', ' if n else '') + dumps(key) + ': ')
+        if key != "Level":
+            out.write(dumps(stream.value()))
+            continue
+        out.write('[')
+        for i, _ in enumerate(stream.items()):
+            out.write(', {' if i else '{')
+            for m, lkey in enumerate(stream.members()):
+                out.write((', ' if m else '') + dumps(lkey) + ': ')
+                if lkey != "BuildElement":
+                    out.write(dumps(stream.value()))
+                    continue
+                out.write('[')
+                for j, _ in enumerate(stream.items()):
+                    el = stream.value()
+                    state = elements.get(el["Id"], {})
+                    el.update((k, v) for k, v in state.items() if k != "XY")
+                    out.write((', ' if j else '') + dumps(el))
+                out.write(']')
+            out.write('}')
+        out.write(']')
+    out.write('}')
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import tracemalloc
+    parser = argparse.ArgumentParser(description='Compact loading of BIM JSON: time and peak memory against json.load')
+    parser.add_argument('file')
+    args = parser.parse_args()
+    def full():
+        with open(args.file, encoding='utf-8') as f:
+            return json.load(f)
+
+    for name, load in (("json.load", full), ("load_compact", lambda: load_compact(args.file))):
+        t = time.perf_counter()
+        bim = load()
+        t = time.perf_counter() - t
+        del bim
+        tracemalloc.start()
+        bim = load()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del bim
+        print("%-12s %8.3f s  kept %8.1f MB  peak %8.1f MB" % (name, t, size / 2 ** 20, peak / 2 ** 20))
@@ -0,0 +1,164 @@
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+log = logging.getLogger("evacattack")
+
+
+class Histogram:
+    ''' Гистограмма с границами корзин bounds (по возрастанию), последняя корзина - до бесконечности '''
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        ''' Оценка квантиля: верхняя граница корзины, в которую он попал '''
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds + [float("inf")], self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def report(self):
+        return {"bounds": self.bounds, "counts": self.counts, "sum": self.sum, "count": self.count,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+    def merge(self, report):
+        for i, n in enumerate(report["counts"]):
+            self.counts[i] += n
+        self.sum += report["sum"]
+        self.count += report["count"]
+
+
+# Границы корзин времени шага, сек.: от 10 мкс до ~40 с, вдвое каждая следующая
+LATENCY_BOUNDS = [1e-5 * 2 ** i for i in range(22)]
+
+
+class Metrics:
+    ''' Счётчики, суммарное время фаз и гистограммы шага. По умолчанию выключены: код модели
+    проверяет enabled один раз за шаг и без него ничего не замеряет. События (event) - редкие
+    нештатные ситуации вроде обрезки потока - считаются всегда и пишутся в журнал "evacattack".
+    Все изменения - под lock: метрики пишут потоки сервера '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(lambda: [0.0, 0])  # имя -> [сек., раз]
+        self.histograms = {}
+        self.events = defaultdict(int)
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers[name]
+            timer[0] += seconds
+            timer[1] += 1
+
+    def observe(self, name, value, bounds=LATENCY_BOUNDS):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram(bounds)
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        ''' Замер времени блока, если метрики включены '''
+        if not self.enabled:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t)
+
+    def event(self, name, *details):
+        ''' Нештатная ситуация: считается всегда, подробности - в журнал на уровне DEBUG '''
+        with self.lock:
+            self.events[name] += 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s %s", name, " ".join(map(str, details)))
+
+    def report(self, reset=False):
+        ''' Все метрики словарём (для JSON); reset - обнулить после чтения '''
+        with self.lock:
+            report = {"enabled": self.enabled,
+                      "counters": dict(self.counters),
+                      "timers": {name: {"seconds": s, "count": n} for name, (s, n) in self.timers.items()},
+                      "histograms": {name: h.report() for name, h in self.histograms.items()},
+                      "events": dict(self.events)}
+            if reset:
+                self._clear()  # под той же блокировкой: ничего не теряется между чтением и сбросом
+        return report
+
+    def merge(self, report):
+        ''' Прибавляет метрики report (например, из процесса пула) '''
+        with self.lock:
+            for name, n in report["counters"].items():
+                self.counters[name] += n
+            for name, n in report["events"].items():
+                self.events[name] += n
+            for name, t in report["timers"].items():
+                timer = self.timers[name]
+                timer[0] += t["seconds"]
+                timer[1] += t["count"]
+            for name, h in report["histograms"].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(h["bounds"])
+                self.histograms[name].merge(h)
+
+    def prometheus(self, prefix="evacattack"):
+        ''' Метрики в текстовом формате Prometheus '''
+        report = self.report()
+        lines = []
+
+        def name_of(name):
+            return prefix + "_" + name.replace(".", "_")
+
+        for name, n in sorted(report["counters"].items()):
+            lines += ["# TYPE %s_total counter" % name_of(name), "%s_total %d" % (name_of(name), n)]
+        for name, n in sorted(report["events"].items()):
+            lines += ["# TYPE %s_events_total counter" % name_of(name), "%s_events_total %d" % (name_of(name), n)]
+        for name, t in sorted(report["timers"].items()):
+            lines += ["# TYPE %s_seconds summary" % name_of(name),
+                      "%s_seconds_sum %r" % (name_of(name), t["seconds"]), "%s_seconds_count %d" % (name_of(name), t["count"])]
+        for name, h in sorted(report["histograms"].items()):
+            lines.append("# TYPE %s_seconds histogram" % name_of(name))
+            seen = 0
+            for bound, n in zip(h["bounds"] + ["+Inf"], h["counts"]):
+                seen += n
+                lines.append('%s_seconds_bucket{le="%s"} %d' % (name_of(name), bound if bound == "+Inf" else "%g" % bound, seen))
+            lines += ["%s_seconds_sum %r" % (name_of(name), h["sum"]), "%s_seconds_count %d" % (name_of(name), h["count"])]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
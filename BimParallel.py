@@ -0,0 +1,443 @@
+import math
+import multiprocessing
+import os
+import numpy as np
+from BimEvac import ArrayMoving
+from BimTopology import BimTopology, Building
+
+
+def _relabel(labels):
+    ''' Номера подобластей подряд с 0, без пустых '''
+    return np.unique(labels, return_inverse=True)[1].astype(np.int64)
+
+
+def by_level(topo, domains):
+    ''' Разбиение по этажам: подряд идущие Level, сгруппированные в domains подобластей примерно
+    с равным числом зон. Границы подобластей - проёмы между лестничными клетками соседних этажей '''
+    counts = np.bincount(topo.zone_level)
+    before = np.cumsum(counts) - counts
+    group = np.minimum(before * domains // max(topo.nz, 1), domains - 1)
+    return _relabel(group[topo.zone_level])
+
+
+def by_component(topo, domains):
+    ''' Разбиение по связным частям (например, отдельным корпусам площадки): части раскладываются
+    по domains подобластям, самая большая - в наименее загруженную. Границ между подобластями нет,
+    и ParallelMoving совпадает с ArrayMoving в точности '''
+    parent = list(range(topo.nz))
+
+    def find(v):
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+
+    for a, b in topo.transit_zones.tolist():
+        if a >= 0 and b >= 0:
+            parent[find(a)] = find(b)
+    _, part, sizes = np.unique([find(z) for z in range(topo.nz)], return_inverse=True, return_counts=True)
+    load = [0] * domains
+    label = np.empty(len(sizes), dtype=np.int64)
+    for c in np.argsort(-sizes, kind="stable").tolist():
+        d = load.index(min(load))
+        label[c] = d
+        load[d] += sizes[c]
+    return _relabel(label[part])
+
+
+PARTITIONS = {"level": by_level, "component": by_component}
+
+
+class Domain:
+    ''' Подобласть здания: зоны zones (номера в BimTopology здания, по возрастанию), проёмы хотя бы
+    с одной стороной в ней, своя BimTopology и BIM только из её элементов.
+
+    Проём на границе с другой подобластью становится в топологии подобласти выходом в безопасную
+    зону-призрак, которая стоит за зоной соседа (ghost_zone): её уровень - уровень этой зоны,
+    потенциал и вместимость на шаге приходят от соседа (ArrayKernel.traverse, exits). Внутренняя
+    сторона граничного проёма в transit_zones - первой, flow_sign переводит поток в знак здания '''
+
+    def __init__(self, building, zones):
+        topo = building.topology
+        self.zones = zones = np.asarray(zones, dtype=np.int64)
+        local = np.full(topo.nz, -1, dtype=np.int64)
+        local[zones] = np.arange(len(zones))
+        tz = topo.transit_zones
+        side = np.where(tz >= 0, local[np.maximum(tz, 0)], -1)
+        self.transits = transits = np.flatnonzero((side >= 0).any(axis=1))
+        ltz, inside = side[transits], side[transits] >= 0
+        boundary = (tz[transits] >= 0).all(axis=1) & ~inside.all(axis=1)
+        flip = boundary & ~inside[:, 0]
+        ltz[flip] = ltz[flip][:, ::-1]
+        sz = np.flatnonzero((topo.transit_sz_node[transits] >= 0) | boundary)
+        nz, nt, ns = len(zones), len(transits), len(sz)
+        ghost = boundary[sz]
+
+        gt = transits[sz[ghost]]
+        first = side[gt, 0] >= 0
+        self.ghost_nodes = nz + np.flatnonzero(ghost)
+        self.ghost_zone = np.where(first, tz[gt, 1], tz[gt, 0])
+        self.ghost_stair = topo.zone_sign[self.ghost_zone] == topo.STAIRCASE
+        self.flow_sign = np.ones(nt)
+        self.flow_sign[sz[ghost]] = np.where(first, 1.0, -1.0)
+        self.exit_nodes = nz + np.flatnonzero(~ghost)
+        self.exit_sz = topo.transit_sz_node[transits[sz[~ghost]]]  # узлы здания
+        self.exports = np.zeros(0, dtype=np.int64)  # зоны, за которыми стоят призраки соседей (ParallelMoving)
+
+        tlocal = np.full(topo.nt, -1, dtype=np.int64)
+        tlocal[transits] = np.arange(nt)
+        ptr = topo.node_outputs_ptr
+        counts = ptr[zones + 1] - ptr[zones]
+        offsets = np.repeat(ptr[zones] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        sz_zlevel = np.empty(ns)
+        sz_zlevel[~ghost] = topo.node_zlevel[self.exit_sz]
+        sz_zlevel[ghost] = topo.zone_zlevel[self.ghost_zone]
+        transit_sz_node = np.full(nt, -1, dtype=np.int64)
+        transit_sz_node[sz] = nz + np.arange(ns)
+        self.topology = BimTopology.from_arrays({
+            'zone_ids': np.array([topo.zone_ids[z] for z in zones.tolist()], dtype=str),
+            'transit_ids': np.array([topo.transit_ids[t] for t in transits.tolist()], dtype=str),
+            'zone_sign': topo.zone_sign[zones], 'zone_area': topo.zone_area[zones],
+            'zone_zlevel': topo.zone_zlevel[zones], 'zone_level': topo.zone_level[zones],
+            'zone_centroid': topo.zone_centroid[zones],
+            'transit_sign': topo.transit_sign[transits], 'transit_width': topo.transit_width[transits],
+            'transit_level': topo.transit_level[transits], 'transit_centroid': topo.transit_centroid[transits],
+            'transit_zones': ltz, 'sz_transit': sz, 'transit_sz_node': transit_sz_node,
+            'node_zlevel': np.concatenate((topo.zone_zlevel[zones], sz_zlevel)),
+            'node_outputs_ptr': np.concatenate(([0], np.cumsum(np.concatenate((counts, np.ones(ns, dtype=np.int64)))))),
+            'node_outputs': np.concatenate((tlocal[topo.node_outputs[offsets]], sz))})
+
+        levels = {}
+        for ids, nums in ((self.topology.zone_ids, topo.zone_level[zones]), (self.topology.transit_ids, topo.transit_level[transits])):
+            for el_id, n in zip(ids, nums.tolist()):
+                levels.setdefault(n, []).append(building.elements[el_id])
+        self.bim = {"Level": [dict({k: v for k, v in lvl.items() if k != "BuildElement"}, BuildElement=levels[n])
+                              for n, lvl in enumerate(building.bim["Level"]) if n in levels]}
+
+
+class DomainMoving(ArrayMoving):
+    ''' ArrayMoving одной подобласти. Люди, ушедшие за шаг в призраки, забирает ParallelMoving
+    и передаёт соседям: они появляются в зоне соседа перед его следующим шагом '''
+
+    def __init__(self, domain):
+        super().__init__(Building(domain.bim, domain.topology))
+        for node in domain.ghost_nodes[domain.ghost_stair].tolist():
+            self.kernel.is_stair[node] = True  # призрак стоит за лестничной клеткой
+        self.ghosts = domain.ghost_nodes
+        self.exports = np.searchsorted(domain.zones, domain.exports)
+        self.exits = ([0.0] * self.topo.ns, [math.inf] * self.topo.ns)
+
+    def load_state(self, num_people, density, zone_blocked, transit_blocked, time):
+        self.num_people[:] = num_people
+        self.density[:] = density
+        self.zone_blocked[:] = zone_blocked
+        self.transit_blocked[:] = transit_blocked
+        self.time = time
+        self._changed()
+
+    def advance(self, dt, inflow, seeds, limits):
+        ''' Шаг подобласти: inflow - люди, пришедшие от соседей в зоны exports, seeds и limits -
+        потенциалы и вместимости призраков. Возвращает людей, ушедших в призраки, потенциалы
+        и числа людей зон exports и остаток людей в подобласти '''
+        if inflow.any():
+            arrived = self.exports[inflow > 0]
+            self.num_people[arrived] += inflow[inflow > 0]
+            self.density[arrived] = self.num_people[arrived] / self.topo.zone_area[arrived]
+            if self._occupied is not None:
+                self._occupied.update(arrived.tolist())
+        pot, lim = self.exits
+        nz = self.topo.nz
+        for node, p, c in zip(self.ghosts.tolist(), seeds.tolist(), limits.tolist()):
+            pot[node - nz] = p
+            lim[node - nz] = c
+        self.step(dt)
+        out = self.num_people[self.ghosts]
+        self.num_people[self.ghosts] = 0.0
+        return out, self.potential[self.exports], self.num_people[self.exports], self.people_remaining()
+
+    def state(self):
+        return {name: getattr(self, name) for name in ("num_people", "density", "potential", "color", "zone_visited",
+                                                       "transit_flow", "transit_visited", "transit_color")}
+
+
+class _Group:
+    ''' Подобласти одного процесса: call вызывает метод DomainMoving у каждой со своими аргументами '''
+
+    def __init__(self, domains):
+        self.movings = [DomainMoving(d) for d in domains]
+
+    def call(self, name, args):
+        return [getattr(m, name)(*a) for m, a in zip(self.movings, args)]
+
+
+def _serve(conn, domains):
+    group = _Group(domains)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            reply = group.call(*message)
+        except Exception as e:
+            reply = e
+        conn.send(reply)
+    conn.close()
+
+
+class ParallelMoving(ArrayMoving):
+    ''' ArrayMoving, разбитый на подобласти (Domain), каждая из которых делает шаг в своём процессе.
+
+    partition(topology, domains) -> номер подобласти каждой зоны: by_level (по этажам),
+    by_component (по связным частям) или своя функция, например по группам лестниц.
+    domains - число подобластей (по умолчанию workers), workers - число процессов
+    (по умолчанию os.cpu_count(); при 1 подобласти считаются по очереди в этом процессе).
+
+    За шаг подобласти обмениваются только данными граничных проёмов: призрак в подобласти
+    получает потенциал и вместимость зоны соседа с прошлого шага, а люди, ушедшие в призрак,
+    появляются в зоне соседа на следующем шаге. Из-за этого запаздывания на один шаг результат
+    отличается от ArrayMoving; без границ (by_component на площадке из отдельных корпусов)
+    совпадает в точности. На зданиях BimGenerator по этажам (by_level) доля эвакуированных
+    в каждый момент расходится с ArrayMoving не больше чем на 1% людей, время эвакуации - не больше
+    чем на 2% (проверка - python BimParallel.py).
+
+    Состояние целиком (num_people, density, potential и т.п.) собирается из процессов только
+    по gather(); sync, state_bim, snapshot и изменения состояния собирают его сами. После
+    изменения извне (set_density, block_zone, restore ...) оно рассылается по подобластям
+    на следующем шаге. Процессы останавливает close() (или with) '''
+
+    def __init__(self, building, partition=by_level, domains=None, workers=None):
+        if not isinstance(building, Building):
+            building = Building(building)
+        self._dirty, self._stale = True, False
+        super().__init__(building)
+        topo = self.topo
+        self.workers = workers = workers or os.cpu_count() or 1
+        labels = np.asarray(partition(topo, domains or workers))
+        self.domains = [Domain(building, np.flatnonzero(labels == d)) for d in range(labels.max() + 1)]
+
+        # Граничные зоны по подобластям подряд; призраки всех подобластей подряд ссылаются на них
+        boundary = np.unique(np.concatenate([d.ghost_zone for d in self.domains]))
+        self.boundary = boundary[np.lexsort((boundary, labels[boundary]))]
+        position = np.full(topo.nz, -1, dtype=np.int64)
+        position[self.boundary] = np.arange(len(self.boundary))
+        self._ghost_b = np.concatenate([position[d.ghost_zone] for d in self.domains]).astype(np.int64)
+        self._ghost_split = np.cumsum([len(d.ghost_zone) for d in self.domains])[:-1]
+        self._export_split = np.cumsum(np.bincount(labels[self.boundary], minlength=len(self.domains)))[:-1]
+        for d, exports in zip(self.domains, np.split(self.boundary, self._export_split)):
+            d.exports = exports
+        self._inflow = np.zeros(len(self.boundary))
+        self._pot_b = np.zeros(len(self.boundary))
+        self._num_b = np.zeros(len(self.boundary))
+
+        self._conns = self._procs = self._local = None
+        if workers <= 1 or len(self.domains) == 1:
+            self._local = _Group(self.domains)
+        else:
+            self._groups = [[] for _ in range(min(workers, len(self.domains)))]
+            load = [0] * len(self._groups)
+            for i in np.argsort([-len(d.zones) for d in self.domains], kind="stable").tolist():
+                k = load.index(min(load))
+                self._groups[k].append(i)
+                load[k] += len(self.domains[i].zones)
+            ctx = multiprocessing.get_context()
+            self._conns, self._procs = [], []
+            for group in self._groups:
+                conn, child = ctx.Pipe()
+                proc = ctx.Process(target=_serve, args=(child, [self.domains[i] for i in group]), daemon=True)
+                proc.start()
+                child.close()
+                self._conns.append(conn)
+                self._procs.append(proc)
+
+    def _call(self, name, args):
+        ''' Метод DomainMoving у всех подобластей, args - по подобласти; ответы - по порядку подобластей '''
+        if self._local is not None:
+            return self._local.call(name, args)
+        for conn, group in zip(self._conns, self._groups):
+            conn.send((name, [args[i] for i in group]))
+        results = [None] * len(self.domains)
+        for conn, group in zip(self._conns, self._groups):
+            reply = conn.recv()
+            if isinstance(reply, Exception):
+                raise reply
+            for i, r in zip(group, reply):
+                results[i] = r
+        return results
+
+    def close(self):
+        if self._procs:
+            for conn in self._conns:
+                conn.send(None)
+            for proc in self._procs:
+                proc.join()
+        self._conns = self._procs = None
+        self._local = self._local or _Group(self.domains)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _changed(self):
+        super()._changed()
+        self._dirty, self._stale = True, False
+
+    def scatter(self):
+        ''' Рассылает состояние по подобластям. Начальные потенциалы призраков - от одного обхода
+        всего здания на копии состояния '''
+        nz = self.topo.nz
+        num, dens = self.num_people.tolist(), self.density.tolist()
+        zblocked, tblocked = self.zone_blocked.tolist(), self.transit_blocked.tolist()
+        states = []
+        for d in self.domains:
+            local = np.zeros(len(d.zones) + d.topology.ns)  # в призраках никого
+            local[:len(d.zones)] = self.num_people[d.zones]
+            local[d.exit_nodes] = self.num_people[d.exit_sz]
+            states.append((local, self.density[d.zones], self.zone_blocked[d.zones], self.transit_blocked[d.transits], self.time))
+        self._call("load_state", states)
+        pot = self.kernel.traverse(num, dens, zblocked, tblocked, self.MODELLING_STEP,
+                                   self.MIN_DENSIY, self.MAX_DENSIY, [0, 0, 0])[0]
+        self._pot_b = np.array(pot[:nz])[self.boundary]
+        self._num_b = self.num_people[self.boundary]
+        self._inflow[:] = 0.0
+        self._dirty = False
+
+    def gather(self):
+        ''' Собирает состояние подобластей в массивы здания. Люди, перешедшие границу на последнем
+        шаге, считаются уже в зонах соседей '''
+        if not self._stale:
+            return
+        topo = self.topo
+        self.transit_flow[:] = 0.0
+        self.transit_visited[:] = False
+        self.transit_color[:] = -1
+        for d, state in zip(self.domains, self._call("state", [()] * len(self.domains))):
+            nz = len(d.zones)
+            num = state["num_people"]
+            self.num_people[d.zones] = num[:nz]
+            self.num_people[d.exit_sz] = num[d.exit_nodes]
+            self.density[d.zones] = state["density"]
+            self.potential[d.zones] = state["potential"][:nz]
+            colors = np.full(d.topology.ns + 1, -1, dtype=np.int64)  # цвет -1 - последний элемент
+            colors[d.exit_nodes - nz] = d.exit_sz - topo.nz
+            self.color[d.zones] = colors[state["color"][:nz]]
+            self.zone_visited[d.zones] = state["zone_visited"]
+            self.transit_flow[d.transits] += state["transit_flow"] * d.flow_sign
+            self.transit_visited[d.transits] |= state["transit_visited"]
+            self.transit_color[d.transits] = np.maximum(self.transit_color[d.transits], colors[state["transit_color"]])
+        self.num_people[self.boundary] += self._inflow
+        self.density[self.boundary] = self.num_people[self.boundary] / topo.zone_area[self.boundary]
+        self._stale = False
+
+    def step(self, dt=None):
+        dt = dt or self.MODELLING_STEP
+        if self._dirty:
+            self.scatter()
+        self._stale = True
+        ghost_b = self._ghost_b
+        seeds = self._pot_b[ghost_b]
+        limits = self.MAX_DENSIY * self.topo.zone_area[self.boundary[ghost_b]] - (self._num_b + self._inflow)[ghost_b]
+        results = self._call("advance", list(zip([dt] * len(self.domains), np.split(self._inflow, self._export_split),
+                                                 np.split(seeds, self._ghost_split), np.split(limits, self._ghost_split))))
+        out, pot, num, remaining = zip(*results)
+        self._inflow = np.bincount(ghost_b, np.concatenate(out), len(self.boundary))
+        pot = np.concatenate(pot)
+        known = np.isfinite(pot)  # у пустых зон, до которых обход не дошёл, остаётся прошлый потенциал
+        self._pot_b[known] = pot[known]
+        self._num_b = np.concatenate(num)
+        self._remaining = sum(remaining) + self._inflow.sum().item()
+        self.time += dt
+
+    # Чтение и изменение состояния - по собранным массивам здания
+
+    def load(self):
+        self.gather()
+        super().load()
+
+    def sync(self):
+        self.gather()
+        super().sync()
+
+    def state_bim(self):
+        self.gather()
+        return super().state_bim()
+
+    def people_getter(self):
+        self.gather()
+        return super().people_getter()
+
+    def snapshot(self):
+        self.gather()
+        return super().snapshot()
+
+    def transit_speeds(self, pfv=None):
+        self.gather()
+        return super().transit_speeds(pfv)
+
+    def set_density(self, density):
+        self.gather()
+        super().set_density(density)
+
+    def set_people_by_density(self):
+        self.gather()
+        super().set_people_by_density()
+
+    def block_zone(self, zone_id, blocked=True):
+        self.gather()
+        super().block_zone(zone_id, blocked)
+        self._changed()
+
+    def take_people(self, zone_id):
+        self.gather()
+        people = super().take_people(zone_id)
+        self._changed()
+        return people
+
+    def people_remaining(self):
+        if self._remaining is None:
+            self.gather()
+        return super().people_remaining()
+
+
+def deviation(building, partition=by_level, domains=2, density=0.5, max_steps=100000):
+    ''' Расхождение ParallelMoving (в этом процессе) с ArrayMoving от одного начального состояния:
+    наибольшая разница долей эвакуированных за весь прогон и относительная разница времени эвакуации '''
+    serial = ArrayMoving(building)
+    parallel = ParallelMoving(building, partition, domains, workers=1)
+    curves = []
+    for moving in (serial, parallel):
+        moving.set_density(density)
+        moving.set_people_by_density()
+        total = moving.num_people[:moving.topo.nz].sum()
+        curve = []
+        while len(curve) < max_steps:
+            moving.step()
+            if moving is parallel:
+                moving.gather()
+            curve.append(moving.num_people[moving.topo.nz:].sum() / total)
+            if moving.people_remaining() <= 0:
+                break
+        curves.append(curve)
+    a, b = curves
+    n = max(len(a), len(b))
+    a, b = np.array(a + a[-1:] * (n - len(a))), np.array(b + b[-1:] * (n - len(b)))
+    return {"domains": len(parallel.domains), "steps": len(curves[0]), "parallel_steps": len(curves[1]),
+            "evacuated": np.abs(a - b).max().item(), "time": abs(len(curves[1]) - len(curves[0])) / len(curves[0])}
+
+
+if __name__ == "__main__":
+    import argparse
+    from BimGenerator import sized_building
+    parser = argparse.ArgumentParser(description='Deviation of the parallel engine from ArrayMoving on synthetic buildings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--kinds', nargs='+', choices=('corridor', 'grid'), default=['corridor', 'grid'])
+    parser.add_argument('--levels', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--partition', choices=sorted(PARTITIONS), default='level')
+    args = parser.parse_args()
+    for kind in args.kinds:
+        for lv in args.levels:
+            for size in args.sizes:
+                d = deviation(Building(sized_building(size, kind, lv)), PARTITIONS[args.partition], lv)
+                print("%-9s x%d %6d  domains %d  steps %6d / %6d  evacuated %.4f  time %.4f" %
+                      (kind, lv, size, d["domains"], d["steps"], d["parallel_steps"], d["evacuated"], d["time"]))
@@ -0,0 +1,195 @@
+import json
+import os
+import numpy as np
+
+# Поля, которые умеет записывать Recorder (кроме них всегда пишется номер вызова record - step)
+FIELDS = ("time", "zone_people", "zone_density", "transit_flow", "exits", "intruder_room", "victims")
+
+
+class Column:
+    ''' Растущий буфер строк одной формы. Без каталога spill буфер удваивается при заполнении,
+    с каталогом - заполненные chunk строк дописываются в сырой файл <spill>/<name>.bin,
+    и в памяти остаётся не больше chunk строк '''
+
+    def __init__(self, name, shape, dtype, capacity=1024, spill=None, chunk=65536):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.spill = spill
+        self.chunk = chunk
+        self.buf = np.empty((capacity if spill is None else min(capacity, chunk),) + self.shape, self.dtype)
+        self.n = 0  # строк в buf
+        self.spilled = 0  # строк в файле
+        if spill is not None:
+            open(self.path, 'wb').close()
+
+    @property
+    def path(self):
+        return os.path.join(self.spill, self.name + ".bin")
+
+    def __len__(self):
+        return self.spilled + self.n
+
+    def append(self, value):
+        if self.n == len(self.buf):
+            if self.spill is not None and self.n >= self.chunk:
+                self.flush()
+            else:
+                grown = np.empty((2 * len(self.buf),) + self.shape, self.dtype)
+                grown[:self.n] = self.buf[:self.n]
+                self.buf = grown
+        self.buf[self.n] = value
+        self.n += 1
+
+    def flush(self):
+        ''' Дописывает строки из памяти в файл (только с каталогом spill) '''
+        if self.spill is None or not self.n:
+            return
+        with open(self.path, 'ab') as f:
+            self.buf[:self.n].tofile(f)
+        self.spilled += self.n
+        self.n = 0
+
+    def array(self):
+        ''' Все записанные строки: массив в памяти или np.memmap файла (только для чтения) '''
+        if self.spill is None:
+            return self.buf[:self.n]
+        self.flush()
+        if not self.spilled:
+            return np.empty((0,) + self.shape, self.dtype)
+        return np.memmap(self.path, self.dtype, 'r', shape=(self.spilled,) + self.shape)
+
+
+class Recorder:
+    ''' Временные ряды прогона в столбцах NumPy.
+
+    Источник - Moving, ArrayMoving, EnsembleMoving (строка на шаг со всеми сценариями)
+    или EvacAttackModel/EvacAttackEnsemble (тогда доступны и поля нарушителя).
+    Записывается каждый every-й вызов record, например
+        model.run_until(building_empty, callbacks=[(1, recorder.record)])
+    spill - каталог, куда столбцы сбрасываются кусками по chunk строк, для очень длинных прогонов.
+    Результат сохраняется в .npz (save) или остаётся в каталоге spill (close), и читается load_record '''
+
+    def __init__(self, fields=("time", "zone_people", "transit_flow", "exits"), every=1, capacity=1024, spill=None, chunk=65536):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError("unknown fields: %s" % ", ".join(sorted(unknown)))
+        self.fields = tuple(fields)
+        self.every = every
+        self.capacity = capacity
+        self.spill = spill
+        self.chunk = chunk
+        self.columns = None
+        self.calls = 0
+        self.meta = {}
+        self._zone_index = None
+        if spill is not None:
+            os.makedirs(spill, exist_ok=True)
+
+    def record(self, source):
+        ''' Записывает строку каждый every-й вызов '''
+        self.calls += 1
+        if (self.calls - 1) % self.every == 0:
+            self.sample(source)
+
+    def sample(self, source):
+        ''' Записывает строку сейчас '''
+        model, moving = (source, source.moving) if hasattr(source, "moving") else (None, source)
+        values = {"step": self.calls}
+        values.update((name, self._value(name, model, moving)) for name in self.fields)
+        if self.columns is None:
+            self._start(model, moving, values)
+        for name, value in values.items():
+            self.columns[name].append(value)
+
+    def _start(self, model, moving, values):
+        topo = getattr(moving, "topo", None)
+        if topo is not None:
+            zone_ids, transit_ids = topo.zone_ids, topo.transit_ids
+            exit_ids = [topo.transit_ids[t] for t in topo.sz_transit]
+        else:
+            zone_ids, transit_ids = list(moving.zones), list(moving.transits)
+            exit_ids = [sz["Output"][0] for sz in moving.safety_zones]
+        self.meta = {"fields": list(self.fields), "every": self.every, "step": moving.MODELLING_STEP,
+                     "zone_ids": zone_ids, "transit_ids": transit_ids, "exit_ids": exit_ids}
+        self.columns = {}
+        for name, value in values.items():
+            value = np.asarray(value)
+            self.columns[name] = Column(name, value.shape, value.dtype, self.capacity, self.spill, self.chunk)
+
+    def _value(self, name, model, moving):
+        array = hasattr(moving, "num_people")
+        if name == "time":
+            return moving.time
+        if name == "zone_people":
+            return moving.num_people[..., :moving.topo.nz] if array else [z["NumPeople"] for z in moving.zones.values()]
+        if name == "zone_density":
+            return moving.density if array else [z["Density"] for z in moving.zones.values()]
+        if name == "transit_flow":
+            return moving.transit_flow if array else [t["NumPeople"] for t in moving.transits.values()]
+        if name == "exits":
+            return moving.num_people[..., moving.topo.nz:] if array else [sz["NumPeople"] for sz in moving.safety_zones]
+        if name == "victims":
+            if model is None:
+                return np.nan
+            victims = getattr(model, "victims", None)  # EvacAttackEnsemble
+            if victims is not None:
+                return victims
+            return model.intruder.victims if model.intruder else 0.0
+        if name == "intruder_room":
+            intruder = getattr(model, "intruder", None)
+            if intruder is None:
+                return -1
+            if self._zone_index is None:
+                topo = getattr(moving, "topo", None)
+                self._zone_index = topo.zone_index if topo is not None else {zid: i for i, zid in enumerate(moving.zones)}
+            return self._zone_index[intruder.bim_curr_path[-1]["Id"]]
+
+    def __len__(self):
+        return len(self.columns["step"]) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.columns[name].array()
+
+    def save(self, path):
+        ''' Записывает столбцы и описание в .npz '''
+        arrays = {name: column.array() for name, column in (self.columns or {}).items()}
+        np.savez(path, _meta=np.array(json.dumps(self.meta)), **arrays)
+
+    def close(self):
+        ''' Сбрасывает остаток столбцов в каталог spill и записывает описание meta.json '''
+        if self.spill is None:
+            return
+        meta = dict(self.meta, columns={name: {"shape": list(c.shape), "dtype": c.dtype.str, "rows": len(c)}
+                                        for name, c in (self.columns or {}).items()})
+        for column in (self.columns or {}).values():
+            column.flush()
+        with open(os.path.join(self.spill, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+
+class Record(dict):
+    ''' Записанные столбцы {поле: массив} с описанием прогона в meta '''
+
+    def __init__(self, columns, meta):
+        super().__init__(columns)
+        self.meta = meta
+
+    def zone(self, zone_id, field="zone_people"):
+        ''' Ряд одной зоны по Id '''
+        return self[field][..., self.meta["zone_ids"].index(zone_id)]
+
+
+def load_record(path):
+    ''' Читает запись Recorder: файл .npz (save) или каталог spill (close), из каталога - через np.memmap '''
+    if os.path.isdir(path):
+        with open(os.path.join(path, "meta.json"), encoding='utf-8') as f:
+            meta = json.load(f)
+        columns = {name: np.memmap(os.path.join(path, name + ".bin"), np.dtype(c["dtype"]), 'r',
+                                   shape=(c["rows"],) + tuple(c["shape"])) if c["rows"] else
+                   np.empty((0,) + tuple(c["shape"]), np.dtype(c["dtype"]))
+                   for name, c in meta.pop("columns").items()}
+        return Record(columns, meta)
+    with np.load(path, allow_pickle=False) as f:
+        meta = json.loads(f["_meta"].item())
+        return Record({name: f[name] for name in f.files if name != "_meta"}, meta)
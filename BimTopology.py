@@ -0,0 +1,177 @@
+from collections import deque
+import numpy as np
+from EvacAttackShared import room_area, door_width, cntr_real
+
+ZONE_SIGNS = ('Room', 'Staircase')
+TRANSIT_SIGNS = ('DoorWayInt', 'DoorWay', 'DoorWayOut')
+
+
+class BimTopology:
+    ''' Целочисленная топология здания: зоны, проёмы и безопасные зоны пронумерованы,
+    все неизменяемые величины хранятся в массивах NumPy.
+
+    Узлы графа: сначала зоны (0..nz-1), затем безопасные зоны (nz..nz+ns-1),
+    по одной на каждый DoorWayOut, в порядке обхода здания. '''
+
+    ROOM, STAIRCASE = range(2)
+    DOORWAYINT, DOORWAY, DOORWAYOUT = range(3)
+    # Массивы, из которых топология восстанавливается без разбора BIM (см. BimCache)
+    ARRAYS = ('zone_ids', 'transit_ids', 'zone_sign', 'zone_area', 'zone_zlevel', 'zone_level', 'zone_centroid',
+              'transit_sign', 'transit_width', 'transit_level', 'transit_centroid', 'transit_zones',
+              'sz_transit', 'transit_sz_node', 'node_zlevel', 'node_outputs_ptr', 'node_outputs')
+
+    def __init__(self, bim):
+        zones, transits = [], []
+        zlevels, tlevels = [], []
+        znums, tnums = [], []
+        for n, lvl in enumerate(bim['Level']):
+            for el in lvl['BuildElement']:
+                if el['Sign'] in ZONE_SIGNS:
+                    zones.append(el)
+                    zlevels.append(el.get("ZLevel", lvl["ZLevel"]))
+                    znums.append(n)
+                elif el['Sign'] in TRANSIT_SIGNS:
+                    transits.append(el)
+                    tlevels.append(el.get("ZLevel", lvl["ZLevel"]))
+                    tnums.append(n)
+
+        self.zone_ids = [z["Id"] for z in zones]
+        self.transit_ids = [t["Id"] for t in transits]
+        self._index()
+
+        self.zone_sign = np.array([ZONE_SIGNS.index(z['Sign']) for z in zones], dtype=np.int8)
+        self.zone_area = np.array([room_area(z) for z in zones], dtype=np.float64)
+        self.zone_zlevel = np.array(zlevels, dtype=np.float64)
+        self.zone_level = np.array(znums, dtype=np.int32)  # номер этажа в bim['Level']
+        self.zone_centroid = np.array([cntr_real(z) for z in zones], dtype=np.float64).reshape(-1, 2)
+
+        self.transit_sign = np.array([TRANSIT_SIGNS.index(t['Sign']) for t in transits], dtype=np.int8)
+        self.transit_width = np.array([door_width(t) for t in transits], dtype=np.float64)
+        self.transit_level = np.array(tnums, dtype=np.int32)
+        self.transit_centroid = np.array([cntr_real(t) for t in transits], dtype=np.float64).reshape(-1, 2)
+        # Зоны по обе стороны проёма в порядке Output, -1 если стороны нет
+        self.transit_zones = np.full((self.nt, 2), -1, dtype=np.int64)
+        for i, t in enumerate(transits):
+            for side, zid in enumerate(t["Output"][:2]):
+                self.transit_zones[i, side] = self.zone_index[zid]
+
+        # Безопасные зоны: по одной за каждым выходом
+        self.sz_transit = np.array([i for i, t in enumerate(transits) if t['Sign'] == 'DoorWayOut'], dtype=np.int64)
+        self.ns = len(self.sz_transit)
+        self.transit_sz_node = np.full(self.nt, -1, dtype=np.int64)
+        self.transit_sz_node[self.sz_transit] = self.nz + np.arange(self.ns)
+        self.node_zlevel = np.concatenate((self.zone_zlevel, np.array(tlevels, dtype=np.float64)[self.sz_transit]))
+
+        # Выходы узлов в формате CSR с сохранением порядка Output
+        outputs = [[self.transit_index[tid] for tid in z["Output"]] for z in zones]
+        outputs += [[t] for t in self.sz_transit.tolist()]
+        self.node_outputs_ptr = np.zeros(self.nz + self.ns + 1, dtype=np.int64)
+        self.node_outputs_ptr[1:] = np.cumsum([len(o) for o in outputs])
+        self.node_outputs = np.array([t for o in outputs for t in o], dtype=np.int64)
+        self._derive()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        ''' Топология из словаря массивов ARRAYS (например, np.load кэша) '''
+        topo = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(topo, name, arrays[name])
+        topo.zone_ids = topo.zone_ids.tolist()
+        topo.transit_ids = topo.transit_ids.tolist()
+        topo._index()
+        topo._derive()
+        if 'entry_levels' in arrays:
+            topo._entry_levels = arrays['entry_levels']
+        return topo
+
+    def to_arrays(self):
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        arrays['zone_ids'] = np.array(self.zone_ids, dtype=str)
+        arrays['transit_ids'] = np.array(self.transit_ids, dtype=str)
+        arrays['entry_levels'] = self.entry_levels()
+        return arrays
+
+    def _index(self):
+        self.zone_index = {zid: i for i, zid in enumerate(self.zone_ids)}
+        self.transit_index = {tid: i for i, tid in enumerate(self.transit_ids)}
+        self.nz, self.nt = len(self.zone_ids), len(self.transit_ids)
+
+    def _derive(self):
+        self.ns = len(self.sz_transit)
+        self.zone_num_outputs = np.diff(self.node_outputs_ptr)[:self.nz]
+        self._entry_levels = None
+
+    def outputs(self, node):
+        ''' Проёмы узла в порядке Output '''
+        return self.node_outputs[self.node_outputs_ptr[node]:self.node_outputs_ptr[node+1]]
+
+    def entry_levels(self):
+        ''' Уровни обхода в ширину (GLevel нарушителя) от каждого входа: массив (ns, nz),
+        -1 для недостижимых зон. Совпадает с Intruder.bfs, включая то, что уровень зоны
+        перезаписывается каждым соседом, поставившим её в очередь '''
+        if self._entry_levels is None:
+            passable = self.transit_sign != self.DOORWAYOUT
+            neighbours = [[z for t in self.outputs(r).tolist() if passable[t] for z in self.transit_zones[t].tolist() if z >= 0 and z != r]
+                          for r in range(self.nz)]
+            levels = np.full((self.ns, self.nz), -1, dtype=np.int32)
+            for i, t in enumerate(self.sz_transit.tolist()):
+                lvl = levels[i].tolist()
+                top = self.transit_zones[t, 0].item()
+                lvl[top] = 0
+                visited = [False] * self.nz
+                queue = deque([top])
+                while queue:
+                    v = queue.popleft()
+                    if visited[v]:
+                        continue
+                    visited[v] = True
+                    for n in neighbours[v]:
+                        if not visited[n]:
+                            queue.append(n)
+                            lvl[n] = lvl[v] + 1
+                levels[i] = lvl
+            self._entry_levels = levels
+        return self._entry_levels
+
+    def entry_glevels(self, door):
+        ''' {Id зоны: GLevel} для входа номер door (как Intruder(choosen_door=door)) '''
+        return {self.zone_ids[z]: lvl for z, lvl in enumerate(self.entry_levels()[door].tolist()) if lvl >= 0}
+
+
+class Building:
+    ''' Здание, общее для многих моделей: BIM JSON (только для чтения), BimTopology и элементы по Id.
+
+    Модели на Building (EvacAttackModel(building), ArrayMoving(building)) держат своё состояние
+    в массивах и ничего не пишут в словари BIM, поэтому одно здание можно отдать любому числу
+    потоков, а процессам - через fork, без копий. Массивы топологии делаются только для чтения '''
+
+    def __init__(self, bim, topology=None):
+        self.bim = bim
+        self.topology = topo = topology or BimTopology(bim)
+        for name in BimTopology.ARRAYS:
+            array = getattr(topo, name)
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        self.elements = {el["Id"]: el for lvl in bim['Level'] for el in lvl['BuildElement']}
+        self.zones = {zid: self.elements[zid] for zid in topo.zone_ids}
+        self.transits = {tid: self.elements[tid] for tid in topo.transit_ids}
+        self.lvlname = 'NameLevel' if bim['Level'][0].get('NameLevel') else 'Name'
+        self._glevels = {}
+        self.shared = {}  # неизменяемые производные объекты моделей (ArrayKernel и т.п.), создаются один раз
+
+    @classmethod
+    def load(cls, file, cache_dir=None, compact=False):
+        ''' Здание из файла через кэш топологии (BimCache.load_building) '''
+        from BimCache import load_building
+        return cls(*load_building(file, cache_dir, compact))
+
+    def __getstate__(self):
+        # производные объекты моделей не пересылаются в другие процессы, там они строятся заново
+        return dict(self.__dict__, shared={})
+
+    def entry_glevels(self, door):
+        ''' BimTopology.entry_glevels, посчитанные один раз на вход '''
+        levels = self._glevels.get(door)
+        if levels is None:
+            levels = self._glevels[door] = self.topology.entry_glevels(door)
+        return levels
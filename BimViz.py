@@ -1,8 +1,8 @@
 import tkinter
 from tkinter import filedialog
-import json
 from EvacAttackShared import points, is_el_on_lvl, point_in_polygon
-from EvacAttackModel import EvacAttackModel
+from EvacAttackModel import EvacAttackModel, building_empty, intruder_done
+from BimCache import load_building
 from pprint import pformat
 
 scale = 18
@@ -32,6 +32,7 @@ def visualization():
         moving, intruder = model.moving, model.intruder
         lastroom = intruder.bim_curr_path[-1] if intruder else None
         model.step()
+        moving.sync()
         if intruder and intruder.bim_curr_path[-1] != lastroom:
             intr_line(intruder.bim_curr_path[-2], intruder.bim_curr_path[-1])
             intr_lbl.config(text="Ущерб: "+str(int(intruder.victims)))
@@ -58,16 +59,16 @@ def visualization():
                 if e in moving.zones:
                     c.itemconfigure(cv_els["text"], text="{:6.2f}".format(moving.zones[e]["NumPeople"]))
                     c.itemconfigure(cv_els["polygon"], fill=moving.zones[e].get("Color"))
-        nop = sum([x["NumPeople"] for x in moving.zones.values() if x["IsVisited"]])
-        if intruder and intruder.precalculate_path and intruder.p_path:
+        if intruder and intruder.precalculate_path and not intruder_done(model):
             return
-        elif moving.active and nop > 0:
+        elif not building_empty(model):
             return
         nop_sz = sum(z["NumPeople"] for z in moving.safety_zones)
         tkinter.messagebox.showinfo("Визуализация окончена", f"Ущерб: {int(intruder.victims if intruder else 0)} чел. Длительность визуализации: {moving.time*60:.{5}} с. ({moving.time:.{5}} мин.)"
                                     f" В безопасной зоне {int(nop_sz)} человек")
         root.destroy()
 
+    model.moving.sync()
     root = tkinter.Tk()
     root.title("Визуализация")
     tkinter.Button(text="Шаг", command=vis_step).pack()
@@ -132,11 +133,10 @@ def visualization():
 filename = filedialog.askopenfilename(filetypes=(("BIM JSON", "*.json"),))
 if not filename:
     exit()
-with open(filename) as f:
-    j = json.load(f)
+j, topology = load_building(filename)
 
 
-model = EvacAttackModel(j)
+model = EvacAttackModel(j, topology=topology)
 dens = tkinter.simpledialog.askfloat("Плотность", "Задайте плотность, чел/м2", initialvalue=0.5, minvalue=0.0, maxvalue=1.0)
 if dens is None:
     exit()
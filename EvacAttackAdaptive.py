@@ -0,0 +1,129 @@
+import copy
+import math
+import time
+import numpy as np
+from EvacAttackModel import EvacAttackModel, building_empty, time_limit
+
+
+class AdaptiveStepper:
+    ''' Шаги EvacAttackModel (на ArrayMoving) переменной длины.
+
+    Длина следующего шага подбирается по последнему, меньшая из двух оценок:
+    tolerance - допустимая ошибка шага в людях: 0.5 * dt * наибольшее изменение потока через
+    проём (чел./мин) между двумя шагами, т.е. абсолютное число человек, а не доля;
+    max_share - наибольшая доля людей зоны, которая может уйти из неё или прийти в неё за шаг
+    (доля считается не меньше чем от min_people человек, чтобы почти пустые зоны не дробили шаг).
+    Шаг растёт и уменьшается не более чем вдвое, но не бывает меньше MODELLING_STEP и больше max_step.
+    Шаг не перескакивает такт фиксированного режима, на котором нарушитель переходит
+    в следующее помещение, а когда люди не двигаются, модель сразу переходит к этому такту '''
+
+    def __init__(self, model, tolerance=0.05, max_step=None, min_people=1.0, max_share=0.5):
+        self.model = model
+        moving = model.moving
+        self.tolerance = tolerance
+        self.min_step = moving.MODELLING_STEP
+        self.max_step = max_step or 50 * moving.MODELLING_STEP
+        self.min_people = min_people
+        self.max_share = max_share
+        self.rate = None
+        self.dt = self.min_step
+        self.quiet = False  # на последнем шаге никто не переместился
+        self.steps = 0
+
+    def next_event(self):
+        ''' Время такта фиксированного режима, на котором нарушитель перейдёт в следующее помещение '''
+        intruder = self.model.intruder
+        if intruder is None:
+            return math.inf
+        return (math.floor(intruder.arrival_time() / self.min_step) + 1) * self.min_step
+
+    def step(self):
+        moving = self.model.moving
+        nz = moving.topo.nz
+        dt = self.dt
+        until_event = self.next_event() - moving.time
+        if until_event <= 0:
+            until_event = math.inf  # путь нарушителя пройден
+        if self.quiet and math.isfinite(until_event):
+            dt = until_event  # людям идти некуда, ждём нарушителя
+        else:
+            dt = min(dt, until_event)
+        before = moving.num_people[:nz].copy()
+        self.model.step(dt)
+        self.steps += 1
+        rate = moving.transit_flow / dt  # чел./мин через каждый проём
+        change = np.abs(moving.num_people[:nz] - before)
+        self.quiet = not change.any()
+        if self.quiet:
+            self.dt = self.max_step
+        else:
+            # Ошибка явного шага растёт как dt * изменение потока, а доля зоны, уходящая за шаг, ограничена
+            err = 0.5 * dt * np.abs(rate - self.rate).max() if self.rate is not None else 0.0
+            rel = (change / np.maximum(before, self.min_people)).max()
+            factor = min(2.0, 0.9 * math.sqrt(self.tolerance / err) if err > 0 else 2.0, self.max_share / rel if rel > 0 else 2.0)
+            self.dt = min(self.max_step, max(self.min_step, dt * max(0.5, factor)))
+            # Зона с плотностью не больше MIN_DENSIY отдаёт всех людей за один шаг любой длины,
+            # поэтому пока такие люди есть, шаг должен быть как в фиксированном режиме
+            dens = moving.density
+            if ((dens > 0) & (dens <= moving.MIN_DENSIY)).any():
+                self.dt = self.min_step
+        self.rate = rate
+        return dt
+
+
+def _run(bim, density, intruder, tolerance, max_step, max_time):
+    ''' Прогон до конца эвакуации: (время шагов, эвакуировано к этому времени, жертвы, шагов, сек.) '''
+    model = EvacAttackModel(copy.deepcopy(bim), compiled=True)
+    moving = model.moving
+    moving.set_density(density)
+    moving.set_people_by_density()
+    if intruder:
+        door, intruder_type, speed = intruder
+        model.set_intruder(door, intruder_type == 1, intruder_type, speed)
+    stepper = AdaptiveStepper(model, tolerance, max_step) if tolerance else None
+    times, evacuated = [0.0], [0.0]
+
+    def record(model):
+        times.append(moving.time)
+        evacuated.append(moving.num_people[moving.topo.nz:].sum().item())
+
+    t = time.perf_counter()
+    model.run_until(building_empty, time_limit(max_time), callbacks=[(1, record)], step=stepper.step if stepper else None)
+    t = time.perf_counter() - t
+    victims = model.intruder.victims if model.intruder else 0.0
+    return np.array(times), np.array(evacuated), victims, len(times) - 1, t
+
+
+def validate(bim, density=0.3, intruder=None, tolerance=0.05, max_step=None, max_time=60.0):
+    ''' Сравнивает кривые прихода людей в безопасные зоны адаптивного и фиксированного режимов.
+    intruder - (дверь, тип, скорость) или None. Возвращает словарь с отчётом '''
+    ft, fe, fv, fs, fsec = _run(bim, density, intruder, None, None, max_time)
+    at, ae, av, as_, asec = _run(bim, density, intruder, tolerance, max_step, max_time)
+    total = max(fe[-1], 1e-9)
+    curve_err = np.abs(np.interp(ft, at, ae) - fe).max()
+    return {"tolerance": tolerance,
+            "fixed_steps": fs, "adaptive_steps": as_, "step_ratio": fs / as_,
+            "fixed_sec": fsec, "adaptive_sec": asec,
+            "fixed_end_time": ft[-1] * 60, "adaptive_end_time": at[-1] * 60,
+            "evacuated_fixed": fe[-1], "evacuated_adaptive": ae[-1],
+            "curve_max_error": curve_err, "curve_max_error_rel": curve_err / total,
+            "victims_fixed": fv, "victims_adaptive": av}
+
+
+if __name__ == "__main__":
+    import argparse
+    from BimCache import load_building
+    parser = argparse.ArgumentParser(description='Validation of adaptive stepping against the fixed step')
+    parser.add_argument('file')
+    parser.add_argument('--density', type=float, default=0.3)
+    parser.add_argument('--intruder', type=int, nargs=3, metavar=('DOOR', 'TYPE', 'SPEED'), default=None)
+    parser.add_argument('--tolerance', type=float, nargs='+', default=[0.02, 0.05, 0.1])
+    parser.add_argument('--max-step', type=float, default=None, help='max step, min')
+    args = parser.parse_args()
+    bim, _ = load_building(args.file)
+    for tol in args.tolerance:
+        r = validate(bim, args.density, args.intruder, tol, args.max_step)
+        print("tolerance {tolerance}: steps {fixed_steps} -> {adaptive_steps} ({step_ratio:.1f}x), "
+              "end {fixed_end_time:.1f} -> {adaptive_end_time:.1f} s, "
+              "arrival curve max error {curve_max_error:.2f} people ({curve_max_error_rel:.2%}), "
+              "victims {victims_fixed:.2f} -> {victims_adaptive:.2f}".format(**r))
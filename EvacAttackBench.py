@@ -0,0 +1,257 @@
+import copy
+import http.client
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from BimEvac import Moving, ArrayMoving
+from BimGenerator import corridor_building, sized_building, count_elements
+from BimTopology import BimTopology, Building
+from BimCache import compile_building, content_hash
+from BimMetrics import metrics
+from BimParallel import ParallelMoving, PARTITIONS
+from EvacAttackModel import EvacAttackModel, building_empty
+
+# Направление улучшения по единице измерения: для остальных единиц (сек.) лучше меньше
+HIGHER_IS_BETTER = {"steps/s"}
+
+
+def bench_step(engine, bim, density=0.5, steps=50):
+    ''' Среднее время одного шага Moving.step, сек., и число зон '''
+    moving = engine(bim)
+    moving.set_density(density)
+    moving.set_people_by_density()
+    moving.step()
+    t = time.perf_counter()
+    for _ in range(steps):
+        moving.step()
+    return (time.perf_counter() - t) / steps, len(moving.zones)
+
+
+def step_scaling(sizes=(10, 100, 1000, 5000), engines=(Moving, ArrayMoving), steps=50):
+    ''' Время шага в зависимости от числа зон '''
+    for rooms in sizes:
+        for engine in engines:
+            dt, nz = bench_step(engine, corridor_building(rooms), steps=steps)
+            print(f"{engine.__name__:12} zones {nz:7d}  {dt*1e3:9.3f} ms/step  {dt/nz*1e6:7.3f} us/zone")
+
+
+def bench_parallel(bim, workers=(1, 2, 4), partition="level", density=0.5, steps=20):
+    ''' Шагов в секунду ArrayMoving и ParallelMoving с каждым числом процессов из workers
+    (подобластей - столько же, сколько процессов): {"serial": ..., число процессов: ...} '''
+    building = Building(bim)
+    result = {"serial": 1.0 / bench_step(ArrayMoving, building, density, steps)[0]}
+    for n in workers:
+        with ParallelMoving(building, PARTITIONS[partition], n, n) as moving:
+            result[n] = 1.0 / bench_step(lambda _: moving, building, density, steps)[0]
+    return result
+
+
+def parallel_scaling(sizes=(10000, 100000), kind="grid", levels=8, workers=(1, 2, 4, 8), partition="level", steps=20):
+    ''' Ускорение ParallelMoving относительно ArrayMoving в зависимости от числа процессов '''
+    for size in sizes:
+        bim = sized_building(size, kind, levels)
+        rates = bench_parallel(bim, workers, partition, steps=steps)
+        serial = rates.pop("serial")
+        print(f"{kind} x{levels} {count_elements(bim):7d} el.  serial {serial:9.2f} steps/s")
+        for n, rate in rates.items():
+            print(f"{'':24} workers {n:3d}  {rate:9.2f} steps/s  speedup {rate / serial:5.2f}")
+
+
+def _timed(fn, repeat=1):
+    ''' Наименьшее время вызова fn из repeat и результат последнего вызова '''
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+def bench_construction(bim, repeat=3):
+    ''' Время построения: топологии, движков, модели и загрузки топологии через кэш (холодный и тёплый) '''
+    result = {}
+    result["topology"], topo = _timed(lambda: BimTopology(bim), repeat)
+    copies = iter([copy.deepcopy(bim) for _ in range(repeat)])  # Moving пишет в словари BIM
+    result["moving"], _ = _timed(lambda: Moving(next(copies)), repeat)
+    result["array_moving"], _ = _timed(lambda: ArrayMoving(bim, topo), repeat)
+    result["model"], _ = _timed(lambda: EvacAttackModel(bim, topology=topo), repeat)
+    digest = content_hash(json.dumps(bim, sort_keys=True).encode("utf-8"))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        result["cache_cold"], _ = _timed(lambda: compile_building(bim, digest, cache_dir))
+        result["cache_warm"], _ = _timed(lambda: compile_building(bim, digest, cache_dir), repeat)
+    return result
+
+
+def bench_intruder(bim, topo, intruder_type, density=0.5, max_steps=2000, door=0, speed=60):
+    ''' Время выбора пути нарушителем: расчёт при появлении (путь заранее для типа 1,
+    обзор для типов 2 и 3) и среднее время одного перехода в следующее помещение, сек. '''
+    was_enabled = metrics.enabled
+    metrics.enable()
+    metrics.reset()
+    try:
+        model = EvacAttackModel(copy.deepcopy(bim), topology=topo)
+        model.moving.set_density(density)
+        model.moving.set_people_by_density()
+        model.set_intruder(door, intruder_type == 1, intruder_type, speed)
+        model.run_until(building_empty, max_steps=max_steps)
+        timers = metrics.report(reset=True)["timers"]
+    finally:
+        metrics.enable(was_enabled)
+    search = timers.get("intruder.search", {"seconds": 0.0, "count": 0})
+    return {"setup": timers["intruder.setup"]["seconds"],
+            "move": search["seconds"] / search["count"] if search["count"] else 0.0}
+
+
+def bench_server(bim, requests=50, density=0.5):
+    ''' Задержки запросов к серверу на localhost (EvacAttackServer): шаг, полное состояние,
+    разностное состояние и двоичный формат. Возвращает {запрос: (p50, p99)}, сек. '''
+    import EvacAttackServer
+    from http.server import ThreadingHTTPServer
+
+    class Quiet(EvacAttackServer.Server):
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Quiet)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    pool = EvacAttackServer.pool
+    sid = pool.create(pool.add_building(bim), density)
+    port = httpd.server_address[1]
+
+    def request(method, path, body=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        t = time.perf_counter()
+        conn.request(method, path, body=body and json.dumps(body), headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        t = time.perf_counter() - t
+        conn.close()
+        if response.status != 200:
+            raise RuntimeError("%s %s: HTTP %d" % (method, path, response.status))
+        return t
+
+    queries = {"step": ("POST", "/sessions/%s/step" % sid, {"steps": 1}),
+               "state": ("GET", "/sessions/%s" % sid, None),
+               "state_since": ("GET", None, None),  # с предыдущего шага, путь - после шагов
+               "state_binary": ("GET", "/sessions/%s?format=binary" % sid, None)}
+    result = {}
+    try:
+        for name, (method, path, body) in queries.items():
+            if name == "state_since":
+                path = "/sessions/%s?since=%d" % (sid, max(0, pool.get(sid).model.steps - 1))
+            times = sorted(request(method, path, body) for _ in range(requests))
+            result[name] = (statistics.median(times), times[min(len(times) - 1, int(0.99 * len(times)))])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        pool.delete(sid)
+    return result
+
+
+def run_suite(sizes=(10, 100, 1000, 10000), kinds=("corridor", "grid"), levels=(1, 3), steps=20,
+              intruder_types=(1, 2, 3), intruder_max=2000, server=True, server_max=10000, parallel=(), out=sys.stdout):
+    ''' Замеры на синтетических зданиях BimGenerator.sized_building всех сочетаний размера, вида и этажности.
+    Нарушители и сервер замеряются на зданиях не больше intruder_max и server_max элементов,
+    ParallelMoving по этажам - с каждым числом процессов из parallel.
+    Возвращает строки {"kind", "levels", "size", "elements", "metric", "value", "unit"} '''
+    rows = []
+
+    def add(case, metric, value, unit="s"):
+        row = dict(case, metric=metric, value=value, unit=unit)
+        rows.append(row)
+        if out:
+            shown = "%12.1f" % value if unit == "steps/s" else "%9.3f ms" % (value * 1e3)
+            print("%-9s x%d %7d el.  %-22s %s %s" % (case["kind"], case["levels"], case["elements"], metric, shown,
+                                                       unit if unit != "s" else ""), file=out)
+
+    for kind in kinds:
+        for lv in levels:
+            for size in sizes:
+                bim = sized_building(size, kind, lv)
+                case = {"kind": kind, "levels": lv, "size": size, "elements": count_elements(bim)}
+                built = bench_construction(bim)
+                for name, seconds in built.items():
+                    add(case, "build." + name, seconds)
+                for engine in (Moving, ArrayMoving):
+                    dt, _ = bench_step(engine, copy.deepcopy(bim), steps=steps)
+                    add(case, "step." + engine.__name__, 1.0 / dt, "steps/s")
+                if parallel and lv > 1:
+                    rates = bench_parallel(bim, parallel, steps=steps)
+                    for n in parallel:
+                        add(case, "step.ParallelMoving.%d" % n, rates[n], "steps/s")
+                if case["elements"] <= intruder_max:
+                    topo = BimTopology(bim)
+                    for intruder_type in intruder_types:
+                        found = bench_intruder(bim, topo, intruder_type)
+                        add(case, "intruder%d.setup" % intruder_type, found["setup"])
+                        add(case, "intruder%d.move" % intruder_type, found["move"])
+                if server and case["elements"] <= server_max:
+                    for name, (p50, p99) in bench_server(bim).items():
+                        add(case, "server.%s.p50" % name, p50)
+                        add(case, "server.%s.p99" % name, p99)
+    return rows
+
+
+def regressions(rows, baseline, tolerance=0.25, slack=1e-3):
+    ''' Замеры rows, ставшие хуже baseline (строки прежнего run_suite) больше чем на долю tolerance:
+    список (строка, прежнее значение). Времена, выросшие меньше чем на slack сек., и хвосты p99
+    (слишком шумные на одной машине) не считаются '''
+    before = {(r["kind"], r["levels"], r["size"], r["metric"]): r["value"] for r in baseline}
+    worse = []
+    for r in rows:
+        old = before.get((r["kind"], r["levels"], r["size"], r["metric"]))
+        if old is None or old <= 0 or r["metric"].endswith(".p99"):
+            continue
+        if r["unit"] in HIGHER_IS_BETTER:
+            slower = r["value"] < old / (1 + tolerance)
+        else:
+            slower = r["value"] > old * (1 + tolerance) and r["value"] - old > slack
+        if slower:
+            worse.append((r, old))
+    return worse
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark of evacuation modelling on synthetic buildings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='elements per building')
+    parser.add_argument('--kinds', nargs='+', choices=('corridor', 'grid'), default=['corridor', 'grid'])
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--intruder-types', type=int, nargs='*', default=[1, 2, 3])
+    parser.add_argument('--intruder-max', type=int, default=2000, help='largest building for intruder timings, elements')
+    parser.add_argument('--server-max', type=int, default=10000, help='largest building for server timings, elements')
+    parser.add_argument('--no-server', action='store_true')
+    parser.add_argument('--parallel', type=int, nargs='*', default=[], help='worker counts for ParallelMoving on multi-level buildings')
+    parser.add_argument('--json', type=argparse.FileType('w'), help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--slack', type=float, default=1e-3, help='ignored growth of timings, s')
+    parser.add_argument('--scaling', action='store_true', help='only the old step scaling table on corridors')
+    parser.add_argument('--speedup', action='store_true',
+                        help='only the speedup of ParallelMoving by worker count (--parallel, default 1 2 4 8)')
+    args = parser.parse_args()
+    if args.scaling:
+        step_scaling(args.sizes, steps=args.steps)
+        sys.exit()
+    if args.speedup:
+        for kind in args.kinds:
+            for lv in args.levels:
+                parallel_scaling(args.sizes, kind, lv, args.parallel or (1, 2, 4, 8), steps=args.steps)
+        sys.exit()
+    rows = run_suite(args.sizes, args.kinds, args.levels, args.steps, args.intruder_types, args.intruder_max,
+                     not args.no_server, args.server_max, args.parallel)
+    if args.json:
+        json.dump(rows, args.json, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            worse = regressions(rows, json.load(f), args.tolerance, args.slack)
+        for r, old in worse:
+            print("REGRESSION %s x%d %d el. %s: %g -> %g %s" % (r["kind"], r["levels"], r["size"], r["metric"],
+                                                                  old, r["value"], r["unit"]), file=sys.stderr)
+        if worse:
+            sys.exit(1)
@@ -0,0 +1,145 @@
+import json
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from BimTopology import Building
+from EvacAttackModel import intruder_done
+from EvacAttackSweep import run_model
+
+DOOR_FIELDS = ("door", "id", "victims", "intruder_type", "speed", "density", "runs", "cut")
+
+
+class Cutoff:
+    ''' Условие остановки: прогон уже не может дать больше жертв, чем threshold.value
+    (multiprocessing.Value, который обновляет rank_doors). Жертв в конце прогона не больше,
+    чем сейчас плюс все люди, ещё остающиеся в зонах здания. Проверяется раз в every шагов '''
+
+    def __init__(self, threshold, every=20):
+        self.threshold = threshold
+        self.every = every
+        self.cut = False
+
+    def __call__(self, model):
+        if model.steps % self.every:
+            return False
+        moving = model.moving
+        bound = model.intruder.victims + moving.num_people[:moving.topo.nz].sum().item()
+        self.cut = bound <= self.threshold.value
+        return self.cut
+
+
+def door_order(topology):
+    ''' Входы по убыванию грубой оценки опасности: площадь зон, делённая на число помещений до них
+    от входа (BimTopology.entry_levels). Опасные входы считаются первыми, чтобы порог отсечения
+    вырос раньше '''
+    levels = topology.entry_levels()
+    score = ((levels >= 0) * topology.zone_area / (1.0 + levels)).sum(axis=1)
+    return sorted(range(topology.ns), key=lambda d: -score[d])
+
+
+def door_runs(building, intruder_types=(1, 2, 3), speeds=(60,), densities=(0.5,), doors=None):
+    ''' Прогоны всех сочетаний: сначала более плотные и быстрые сценарии, внутри - входы по door_order '''
+    doors = door_order(building.topology) if doors is None else list(doors)
+    scenarios = sorted(product(intruder_types, speeds, densities), key=lambda s: (-s[2], -s[1], s[0]))
+    return [{"door": door, "intruder_type": t, "speed": s, "density": d} for t, s, d in scenarios for door in doors]
+
+
+_worker = {}
+
+
+def _init_worker(building, threshold):
+    _worker.update(building=building, threshold=threshold)
+
+
+def run_door(run, building=None, threshold=None, max_steps=None, every=20):
+    ''' Один прогон run_model с нарушителем у входа run["door"]. Для заранее рассчитанного пути
+    (тип 1) прогон заканчивается, когда путь пройден: жертв больше не будет. threshold - порог
+    отсечения (Cutoff) или None. Возвращает run с жертвами, числом шагов и признаком отсечения cut
+    (тогда victims - оценка снизу) '''
+    building = building or _worker["building"]
+    if threshold is None:
+        threshold = _worker.get("threshold")
+    stop = Cutoff(threshold, every) if threshold is not None else None
+    conditions = [stop] if stop else []
+    if run["intruder_type"] == 1:
+        conditions.append(intruder_done)
+    model, steps = run_model(run, building, *conditions, max_steps=max_steps)
+    return dict(run, victims=model.intruder.victims, steps=steps, cut=bool(stop and stop.cut))
+
+
+def rank_doors(building, intruder_types=(1, 2, 3), speeds=(60,), densities=(0.5,), doors=None, top=None,
+               workers=None, max_steps=None, every=20, verbose=False):
+    ''' Все входы (DoorWayOut, номера как в Intruder(choosen_door=...)) по убыванию жертв в худшем
+    из сценариев intruder_types x speeds x densities. Прогоны идут в пуле из workers процессов
+    (workers=1 - в текущем), здание с топологией и уровнями обхода от входов разбирается один раз.
+
+    top=k - нужны только k самых опасных входов: прогон останавливается, как только он не может
+    дать больше жертв, чем k-й вход по уже законченным прогонам (Cutoff). Первые k строк при этом
+    точные, у остальных victims может быть оценкой снизу (cut - число отсечённых прогонов).
+    Возвращает (строки по входам с полями DOOR_FIELDS, строки всех прогонов) '''
+    if not isinstance(building, Building):
+        building = Building(building)
+    topo = building.topology
+    for door in range(topo.ns):
+        building.entry_glevels(door)  # уровни обхода - один раз, до копирования здания в процессы
+    runs = door_runs(building, intruder_types, speeds, densities, doors)
+    threshold = multiprocessing.Value('d', -math.inf) if top else None
+    best, results = {}, []
+
+    def finished(row):
+        results.append(row)
+        door = row["door"]
+        if door not in best or row["victims"] > best[door]["victims"]:
+            best[door] = row
+        if threshold is not None and len(best) >= top:
+            threshold.value = sorted((r["victims"] for r in best.values()), reverse=True)[top - 1]
+        if verbose:
+            print(len(results), "/", len(runs), row)
+
+    if workers == 1:
+        for run in runs:
+            finished(run_door(run, building, threshold, max_steps, every))
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(building, threshold)) as pool:
+            futures = [pool.submit(run_door, run, None, None, max_steps, every) for run in runs]
+            for future in as_completed(futures):
+                finished(future.result())
+
+    ranking = []
+    for door, row in best.items():
+        own = [r for r in results if r["door"] == door]
+        ranking.append({"door": door, "id": topo.transit_ids[topo.sz_transit[door]], "victims": row["victims"],
+                        "intruder_type": row["intruder_type"], "speed": row["speed"], "density": row["density"],
+                        "runs": len(own), "cut": sum(r["cut"] for r in own)})
+    ranking.sort(key=lambda r: (-r["victims"], r["door"]))
+    return ranking, results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Rank the entrances (DoorWayOut) of a building by intruder victims')
+    parser.add_argument('file', help='BIM JSON')
+    parser.add_argument('--types', type=int, nargs='+', default=[1, 2, 3], help='intruder types')
+    parser.add_argument('--speeds', type=float, nargs='+', default=[60], help='intruder speeds, m/min')
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--doors', type=int, nargs='+', default=None, help='door numbers (default all)')
+    parser.add_argument('--top', type=int, default=None, help='only the k most dangerous doors are exact, other runs are cut early')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=None)
+    parser.add_argument('--every', type=int, default=20, help='steps between cutoff checks')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--compact', action='store_true', help='load the building with BimLoader.load_compact')
+    parser.add_argument('--json', type=argparse.FileType('w'), help='write ranking and runs as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    ranking, runs = rank_doors(Building.load(args.file, args.cache_dir, args.compact), args.types, args.speeds,
+                               args.densities, args.doors, args.top, args.workers, args.max_steps, args.every, args.verbose)
+    print("%4s %-38s %10s %4s %6s %7s %5s %4s" % ("door", "id", "victims", "type", "speed", "density", "runs", "cut"))
+    for n, r in enumerate(ranking):
+        if args.top and n == args.top:
+            print("-" * 84)
+        print("%4d %-38s %10.2f %4d %6g %7g %5d %4d" % (r["door"], r["id"], r["victims"], r["intruder_type"],
+                                                      r["speed"], r["density"], r["runs"], r["cut"]))
+    if args.json:
+        json.dump({"ranking": ranking, "runs": runs}, args.json, indent=1)
@@ -1,34 +1,204 @@
-from BimEvac import Moving
+import math
+import time
+import numpy as np
+from BimEvac import Moving, ArrayMoving
+from BimTopology import Building
+from BimEnsemble import EnsembleMoving
 from BimIntruder import Intruder
+from EvacAttackShared import cntr_real, state_copy
+from BimMetrics import metrics
+
+
+def building_empty(model):
+    ''' Условие остановки: в здании никого не осталось (до первого шага не выполняется) '''
+    return model.steps > 0 and (not model.moving.active or model.moving.people_remaining() <= 0)
+
+
+def intruder_done(model):
+    ''' Условие остановки: нарушителю идти дальше некуда (или его нет) '''
+    return model.intruder is None or model.intruder.path_exhausted()
+
+
+def time_limit(minutes):
+    ''' Условие остановки: модельное время дошло до minutes, мин. '''
+    return lambda model: model.moving.time >= minutes
+
 
 class EvacAttackModel:
-    def __init__(self, json_bim):
-        self.bim = json_bim
-        self.moving = Moving(json_bim)
+    def __init__(self, json_bim, compiled=False, topology=None):
+        ''' topology - BimTopology здания (BimCache.load_building): модель будет на ArrayMoving,
+        а уровни нарушителя берутся из неё без обхода здания.
+        Вместо BIM можно передать BimTopology.Building: модель на ArrayMoving не изменяет словари
+        здания (люди для нарушителя берутся из массивов), и одно здание годится для любого числа
+        моделей и потоков без копий. BIM с состоянием такой модели - moving.state_bim() '''
+        self.building = json_bim if isinstance(json_bim, Building) else None
+        if self.building is not None:
+            self.bim = self.building.bim
+            self.topology = self.building.topology
+            self.moving = ArrayMoving(self.building)
+        else:
+            self.bim = json_bim
+            self.topology = topology
+            self.moving = ArrayMoving(json_bim, topology) if compiled or topology else Moving(json_bim)
         self.moving.active = True
         self.intruder = None
+        self.steps = 0
         
     def set_intruder(self, door, precalculate_path, intruder_type, intruder_speed):
-        self.intruder = Intruder(self.bim, door, precalculate_path, intruder_type, intruder_speed)
+        if self.building is not None:
+            with metrics.timer("intruder.setup"):
+                self.intruder = Intruder(self.bim, door, precalculate_path, intruder_type, intruder_speed,
+                                         levels=self.building.entry_glevels(door), people_in=self.moving.people_getter(),
+                                         elements=self.building.elements)
+        else:
+            self.moving.sync()  # нарушитель выбирает путь по людям в словарях BIM
+            levels = self.topology.entry_glevels(door) if self.topology else None
+            with metrics.timer("intruder.setup"):
+                self.intruder = Intruder(self.bim, door, precalculate_path, intruder_type, intruder_speed, levels=levels)
         i_room = self.intruder.bim_curr_path[-1]["Id"]
-        self.intruder.victims = self.moving.zones[i_room]["NumPeople"]
-        self.moving.zones[i_room]["NumPeople"] = 0
-        self.moving.zones[i_room]["Density"] = 0
-        self.moving.zones[i_room]["IsBlocked"] = True
+        self.intruder.victims = self.moving.take_people(i_room)
+        self.moving.block_zone(i_room)
         
-    def step(self):
+    def step(self, dt=None):
+        ''' dt - длина шага, мин., отличная от MODELLING_STEP (только для ArrayMoving, см. EvacAttackAdaptive) '''
+        timed = metrics.enabled
+        if timed:
+            t0 = time.perf_counter()
         if self.moving.active:
-            self.moving.step()
+            self.moving.step(dt) if dt else self.moving.step()
         else:
-            self.moving.time += self.moving.MODELLING_STEP
-        if self.intruder and self.intruder.path_len()/self.intruder.speed < self.moving.time:
+            self.moving.time += dt or self.moving.MODELLING_STEP
+        self.steps += 1
+        if self.intruder and self.intruder.arrival_time() < self.moving.time:
             i_room = self.intruder.bim_curr_path[-1]["Id"]
-            self.moving.zones[i_room]["IsBlocked"] = False
+            self.moving.block_zone(i_room, False)
+            self._show_people()
+            if timed:
+                t1 = time.perf_counter()
             self.intruder.step_next()
+            if timed:
+                metrics.add_time("intruder.search", time.perf_counter() - t1)
+                metrics.count("intruder_moves")
             i_room = self.intruder.bim_curr_path[-1]["Id"]
-            self.moving.zones[i_room]["IsBlocked"] = True
-            self.intruder.victims += self.moving.zones[i_room]["NumPeople"]
-            self.moving.zones[i_room]["NumPeople"] = 0
-            self.moving.zones[i_room]["Density"] = 0
+            self.moving.block_zone(i_room)
+            self.intruder.victims += self.moving.take_people(i_room)
+        if timed:
+            metrics.count("steps")
+            metrics.observe("step.latency", time.perf_counter() - t0)
+
+    def _show_people(self):
+        ''' Даёт нарушителю текущих людей: словари BIM или, на общем здании, массивы модели '''
+        if self.building is not None:
+            self.intruder.people_in = self.moving.people_getter()
+        else:
+            self.moving.sync()
+
+    def snapshot(self):
+        ''' Изменяемое состояние модели: люди, блокировки, путь и посещения нарушителя, время.
+        Геометрия и топология не копируются '''
+        return {"moving": self.moving.snapshot(),
+                "intruder": self.intruder.snapshot() if self.intruder else None,
+                "steps": self.steps}
+
+    def restore(self, state):
+        ''' Возвращает модель в состояние snapshot. Нарушитель восстанавливается, только если
+        он был задан у модели и в snapshot (set_intruder после restore задаёт нового) '''
+        self.moving.restore(state["moving"])
+        if self.intruder and state["intruder"]:
+            self.intruder.restore(state["intruder"])
+            if self.building is not None:
+                self._show_people()
+        elif state["intruder"] is None:
+            self.intruder = None
+        self.steps = state["steps"]
+
+    def fork(self):
+        ''' Независимая копия модели в текущем состоянии. Геометрия BIM и топология общие,
+        копируются только словари элементов (на общем здании - и они не копируются) и массивы состояния '''
+        moving = self.moving
+        if self.building is not None:
+            model = EvacAttackModel(self.building)
+        else:
+            topology = moving.topo if isinstance(moving, ArrayMoving) else None
+            model = EvacAttackModel(state_copy(self.bim), topology=topology)
+            model.topology = self.topology
+        model.moving.active = moving.active
+        if self.intruder:
+            model.intruder = self.intruder.clone(model.bim)
+        model.restore(self.snapshot())
+        return model
+
+    def run_until(self, *conditions, max_steps=None, callbacks=(), step=None):
+        ''' Шагает, пока не выполнится одно из условий conditions (функции от модели:
+        building_empty, intruder_done, time_limit(...) или свои) или не будет сделано max_steps шагов.
+        callbacks - пары (k, функция от модели), функция вызывается после каждого k-го шага модели.
+        step - функция шага вместо self.step, например AdaptiveStepper(model).step.
+        Без условий и max_steps шагает до опустевшего здания. Возвращает число сделанных шагов '''
+        if not conditions and max_steps is None:
+            conditions = (building_empty,)
+        step = step or self.step
+        callbacks = [(int(k), fn) for k, fn in callbacks]
+        done = 0
+        while max_steps is None or done < max_steps:
+            if any(stop(self) for stop in conditions):
+                break
+            step()
+            done += 1
+            for k, fn in callbacks:
+                if self.steps % k == 0:
+                    fn(self)
+        return done
 
+    def run_for(self, n, *conditions, callbacks=(), step=None):
+        ''' n шагов (меньше, если раньше выполнится одно из условий conditions) '''
+        return self.run_until(*conditions, max_steps=n, callbacks=callbacks, step=step)
 
+
+class EvacAttackEnsemble:
+    ''' K сценариев EvacAttackModel на одном здании, шагающих вместе (BimEnsemble.EnsembleMoving).
+    Нарушитель сценария задаётся заранее рассчитанным путём (precalculate_path=True),
+    который превращается в расписание входа в помещения '''
+
+    def __init__(self, json_bim, k, topology=None):
+        self.bim = json_bim
+        self.moving = EnsembleMoving(json_bim, k, topology)
+        self.victims = np.zeros(k)
+        self._paths = [None] * k  # номера зон пути нарушителя и длина пути до каждой из них
+        self._pos = np.zeros(k, dtype=np.int64)
+        self._speed = np.ones(k)
+        self._next_arrival = np.full(k, np.inf)
+
+    def set_intruder(self, k, door, intruder_type, intruder_speed):
+        # путь выбирается по людям сценария k, словари BIM не нужны
+        values, index = self.moving.num_people[k].tolist(), self.moving.topo.zone_index
+        intruder = Intruder(self.bim, door, True, intruder_type, intruder_speed, levels=self.moving.topo.entry_glevels(door),
+                            people_in=lambda el: values[index[el["Id"]]])
+        path = intruder.bim_curr_path + intruder.p_path
+        lengths, len_path = [], 0
+        for a, b in zip(path, path[1:]):
+            len_path += math.dist(cntr_real(a), cntr_real(b))
+            lengths.append(len_path)
+        rooms = [self.moving.topo.zone_index[el["Id"]] for el in path[1:]]
+        self._paths[k] = (rooms, lengths)
+        self._pos[k] = 0
+        self._speed[k] = intruder_speed
+        self._next_arrival[k] = lengths[0] / intruder_speed
+        i_room = path[1]["Id"]
+        self.victims[k] = self.moving.take_people(k, i_room)
+        self.moving.block_zone(k, i_room)
+
+    def step(self):
+        self.moving.step()
+        for k in np.flatnonzero(self._next_arrival < self.moving.time):
+            rooms, lengths = self._paths[k]
+            pos = self._pos[k]
+            self.moving.zone_blocked[k, rooms[pos]] = False
+            if pos + 1 < len(rooms):
+                pos = self._pos[k] = pos + 1
+                self._next_arrival[k] = lengths[pos] / self._speed[k]
+            else:
+                self._next_arrival[k] = np.inf  # путь пройден, нарушитель остаётся на месте
+            self.moving.zone_blocked[k, rooms[pos]] = True
+            self.victims[k] += self.moving.take_people(k, self.moving.topo.zone_ids[rooms[pos]])
+            self.moving.num_people[k, rooms[pos]] = 0
+            self.moving.density[k, rooms[pos]] = 0
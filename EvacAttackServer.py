@@ -1,51 +1,633 @@
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from sys import argv
-from EvacAttackModel import EvacAttackModel
+from collections import OrderedDict
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, CancelledError, wait
+import multiprocessing
+from EvacAttackModel import EvacAttackModel, building_empty, intruder_done, time_limit
+from EvacAttackSweep import run_model
+from BimCache import compile_building, content_hash
+from BimTopology import Building
+from BimMetrics import metrics
 import json
+import struct
+import numpy as np
+from urllib.parse import parse_qs
+
+CONDITIONS = {"empty": building_empty, "intruder": intruder_done}
+BINARY_HEADER = struct.Struct("<4sqqdddiiii")
+STREAM_TIMEOUT = 60  # сек. ожидания медленного клиента потока
+MAX_WAIT = 60  # сек., дольше long polling задания не ждёт
+CANCEL_CHECK = 50  # через сколько шагов задание проверяет, не отменено ли оно
+
+
+class Session:
+    ''' Модель одного клиента. Шаги и чтение состояния идут под lock.
+
+    Для разностных ответов хранится номер шага, на котором у каждой зоны (NumPeople, Density,
+    IsBlocked) и проёма (поток) последний раз изменилось значение: ответ "с шага N" содержит
+    только элементы, изменённые после N '''
+
+    def __init__(self, building, model):
+        self.building = building
+        self.model = model
+        self.lock = threading.Lock()
+        self.created = self.last_used = time.time()
+        moving = model.moving
+        self.zone_changed = np.zeros(moving.topo.nz, dtype=np.int64)
+        self.transit_changed = np.zeros(moving.topo.nt, dtype=np.int64)
+        self._last = self._values()
+
+    def _values(self):
+        moving = self.model.moving
+        return (moving.num_people[:moving.topo.nz].copy(), moving.density.copy(),
+                moving.zone_blocked.copy(), moving.transit_flow.copy())
+
+    def track(self):
+        ''' Отмечает элементы, изменившиеся со времени прошлого вызова. Вызывается под lock после шагов '''
+        num, dens, blocked, flow = values = self._values()
+        last_num, last_dens, last_blocked, last_flow = self._last
+        self.zone_changed[(num != last_num) | (dens != last_dens) | (blocked != last_blocked)] = self.model.steps
+        self.transit_changed[flow != last_flow] = self.model.steps
+        self._last = values
+
+    def state(self, since=None):
+        ''' Динамическое состояние модели (без геометрии, её отдаёт GET /buildings/<ключ>).
+        Массивы идут в порядке zone_ids и transit_ids, которые есть в полном ответе (since=None);
+        в ответе с шага since - только изменённые после него элементы с их номерами '''
+        model, topo = self.model, self.model.moving.topo
+        zones, transits = self.changed(since)
+        state = self._header()
+        if since is None:
+            state["zone_ids"] = topo.zone_ids
+            state["transit_ids"] = topo.transit_ids
+        else:
+            state["since"] = since
+            state["zones"] = zones.tolist()
+            state["transits"] = transits.tolist()
+        moving = model.moving
+        state["num_people"] = moving.num_people[zones].tolist()
+        state["density"] = moving.density[zones].tolist()
+        state["blocked"] = moving.zone_blocked[zones].tolist()
+        state["flow"] = moving.transit_flow[transits].tolist()
+        state["exits"] = moving.num_people[topo.nz:].tolist()
+        return state
+
+    def changed(self, since=None):
+        ''' Номера зон и проёмов, изменённых после шага since (все при since=None) '''
+        if since is None:
+            return np.arange(self.zone_changed.size), np.arange(self.transit_changed.size)
+        return np.flatnonzero(self.zone_changed > since), np.flatnonzero(self.transit_changed > since)
+
+    def _header(self):
+        model = self.model
+        intruder = model.intruder
+        return {"building": self.building,
+                "time": model.moving.time * 60,
+                "steps": model.steps,
+                "people_remaining": float(model.moving.people_remaining()),
+                "victims": intruder.victims if intruder else None,
+                "intruder": intruder.bim_curr_path[-1]["Id"] if intruder else None,
+                "intruder_path_length": intruder.path_length if intruder else None}
+
+    def state_binary(self, since=None):
+        ''' Состояние в упакованном виде (little-endian):
+        заголовок BINARY_HEADER - сигнатура b"EAS1", шаг, шаг since (-1 - полное состояние),
+        время (с), людей в здании, жертвы, номер зоны нарушителя (-1 - нет нарушителя),
+        число зон nzc, число проёмов ntc, число безопасных зон ns;
+        затем int32[nzc] номера зон, float64[nzc] NumPeople, float64[nzc] Density, uint8[nzc] IsBlocked,
+        int32[ntc] номера проёмов, float64[ntc] поток, float64[ns] людей в безопасных зонах '''
+        model = self.model
+        moving, topo, intruder = model.moving, model.moving.topo, model.intruder
+        zones, transits = self.changed(since)
+        room = topo.zone_index.get(intruder.bim_curr_path[-1]["Id"], -1) if intruder else -1
+        header = BINARY_HEADER.pack(b"EAS1", model.steps, -1 if since is None else since, moving.time * 60,
+                                    float(moving.people_remaining()), intruder.victims if intruder else 0.0,
+                                    room, zones.size, transits.size, topo.ns)
+        return b"".join((header, zones.astype("<i4").tobytes(), moving.num_people[zones].astype("<f8").tobytes(),
+                         moving.density[zones].astype("<f8").tobytes(), moving.zone_blocked[zones].astype("u1").tobytes(),
+                         transits.astype("<i4").tobytes(), moving.transit_flow[transits].astype("<f8").tobytes(),
+                         moving.num_people[topo.nz:].astype("<f8").tobytes()))
+
+
+class NoSuchBuilding(KeyError):
+    ''' Здание с таким ключом не зарегистрировано (отличает 404 по зданию от 404 по сессии) '''
+
+
+class SessionPool:
+    ''' Модели клиентов по id сессии. Здания разбираются один раз и хранятся по sha256 JSON
+    (BimTopology.Building), модели сессий их не изменяют и работают на одном здании без копий. Когда сессий больше max_sessions, вытесняются
+    давно не использовавшиеся свободные модели; max_idle - сек. без обращений, после которых
+    сессия удаляется (None - без ограничения) '''
+
+    def __init__(self, max_sessions=64, max_idle=None):
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.buildings = {}  # sha256 -> Building
+        self.sessions = OrderedDict()  # от давно использованных к недавним
+        self.lock = threading.Lock()
+        self.default_building = None  # здание и плотность модели прежнего протокола (POST /)
+        self.default_density = 0.5
+
+    def add_building(self, bim=None, data=None, file=None):
+        ''' Регистрирует здание (JSON-объект, байты JSON или путь) и возвращает его ключ '''
+        if file is not None:
+            with open(file, 'rb') as f:
+                data = f.read()
+        if data is None:
+            data = json.dumps(bim, sort_keys=True).encode("utf-8")
+        key = content_hash(data)
+        with self.lock:
+            if key in self.buildings:
+                return key
+        bim = json.loads(data) if bim is None else bim
+        building = Building(bim, compile_building(bim, key))
+        with self.lock:
+            self.buildings.setdefault(key, building)
+        return key
+
+    def building(self, key):
+        ''' Здание по ключу add_building, NoSuchBuilding - если его нет '''
+        with self.lock:
+            if key not in self.buildings:
+                raise NoSuchBuilding(key)
+            return self.buildings[key]
+
+    def create(self, building=None, density=None, intruder=None, sid=None):
+        ''' Новая сессия на здании building (ключ add_building, по умолчанию - здание сервера).
+        intruder - {"door", "type", "speed"} или None. sid - id вместо случайного (сессия
+        с таким id заменяется). Возвращает id сессии '''
+        building = building or self.default_building
+        model = EvacAttackModel(self.building(building))
+        if density is not None:
+            model.moving.set_density(density)
+            model.moving.set_people_by_density()
+        if intruder:
+            intruder_type = int(intruder.get("type", 1))
+            model.set_intruder(int(intruder.get("door", 0)), intruder.get("precalculate", intruder_type == 1),
+                               intruder_type, float(intruder.get("speed", 60)))
+        session = Session(building, model)
+        sid = sid or uuid.uuid4().hex
+        with self.lock:
+            self.sessions.pop(sid, None)
+            self._evict(self.max_sessions - 1)
+            self.sessions[sid] = session
+        return sid
+
+    def get(self, sid):
+        with self.lock:
+            self._evict(self.max_sessions)
+            session = self.sessions[sid]
+            self.sessions.move_to_end(sid)
+            session.last_used = time.time()
+        return session
+
+    def delete(self, sid):
+        with self.lock:
+            del self.sessions[sid]
+
+    def list(self):
+        with self.lock:
+            return [{"id": sid, "building": s.building, "idle": time.time() - s.last_used} for sid, s in self.sessions.items()]
+
+    def _evict(self, keep):
+        ''' Удаляет просроченные сессии и давно не использованные, пока их больше keep.
+        Занятые (шагающие) модели не вытесняются. Вызывается под self.lock '''
+        now = time.time()
+        for sid, s in list(self.sessions.items()):
+            expired = self.max_idle is not None and now - s.last_used > self.max_idle
+            if (expired or len(self.sessions) > keep) and not s.lock.locked():
+                del self.sessions[sid]
+        if len(self.sessions) > keep:
+            raise OverflowError("all %d sessions are busy" % len(self.sessions))
+
+
+_job_buildings = {}  # здания в процессе пула заданий, по ключу
+
+
+def _init_job_worker(buildings):
+    global _job_buildings
+    _job_buildings = buildings
+
+
+def run_job(job_id, run, max_steps, cancelled, building=None):
+    ''' Задание в процессе пула: прогон до конца эвакуации и его итоги. Здание - building
+    или переданное процессу один раз при запуске (_init_job_worker) по ключу run["building"].
+    cancelled - общий с сервером словарь отменённых заданий '''
+    building = building or _job_buildings[run["building"]]
+
+    def stop(model):
+        return model.steps % CANCEL_CHECK == 0 and job_id in cancelled
+
+    model, steps = run_model(run, building, stop, max_steps=max_steps)
+    if job_id in cancelled:
+        raise CancelledError()
+    moving = model.moving
+    topo = moving.topo
+    return {"victims": model.intruder.victims,
+            "evacuated": moving.num_people[topo.nz:].sum().item(),
+            "remaining": float(moving.people_remaining()),
+            "time": moving.time * 60,
+            "steps": steps,
+            "exits": {topo.transit_ids[t]: n for t, n in zip(topo.sz_transit, moving.num_people[topo.nz:].tolist())},
+            "intruder_path": [el["Id"] for el in model.intruder.bim_curr_path]}
+
+
+class JobQueue:
+    ''' Прогоны сценариев целиком в пуле из workers процессов, чтобы долгий счёт не занимал
+    потоки сервера. В очереди ждут не больше max_pending заданий, итоги хранятся для
+    max_jobs последних заданий. Пул создаётся при первом задании.
+
+    Здания передаются процессам пула один раз, при их запуске, а задание несёт только ключ
+    здания. Для здания, загруженного после запуска пула, создаётся новый пул со всеми зданиями,
+    прежний досчитывает свои задания и закрывается '''
+
+    def __init__(self, sessions, workers=None, max_pending=256, max_jobs=1024):
+        self.sessions = sessions
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()  # id -> (сценарий, Future)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_buildings = ()  # ключи зданий, переданных процессам пула
+        self.executor_futures = []  # незаконченные задания текущего пула
+        self.retired = []  # прежние пулы, досчитывающие задания: (пул, их задания)
+        self.cancelled = None
+
+    def _start(self, building):
+        ''' Пул, процессы которого знают здание building. Вызывается под self.lock '''
+        if self.executor is None:
+            self.manager = multiprocessing.Manager()
+            self.cancelled = self.manager.dict()
+        if building not in self.executor_buildings:
+            with self.sessions.lock:
+                buildings = dict(self.sessions.buildings)
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.retired.append((self.executor, self.executor_futures))
+                self.executor_futures = []
+            self.executor = ProcessPoolExecutor(self.workers, initializer=_init_job_worker, initargs=(buildings,))
+            self.executor_buildings = set(buildings)
+
+    def _forget(self, job_id):
+        ''' Убирает задание из словаря отменённых (задание закончено или удалено) '''
+        try:
+            self.cancelled.pop(job_id, None)
+        except (OSError, EOFError):
+            pass  # менеджер уже остановлен вместе с сервером
+
+    def submit(self, message):
+        ''' message - {"building", "density", "door", "intruder_type", "speed", "max_steps"},
+        по умолчанию здание сервера, плотность 0.5, вход 0, нарушитель типа 1 со скоростью 60 '''
+        building = message.get("building") or self.sessions.default_building
+        self.sessions.building(building)  # NoSuchBuilding до постановки в очередь
+        run = {"building": building,
+               "density": float(message.get("density", 0.5)),
+               "door": int(message.get("door", 0)),
+               "intruder_type": int(message.get("intruder_type", 1)),
+               "speed": float(message.get("speed", 60))}
+        max_steps = message.get("max_steps")
+        max_steps = int(max_steps) if max_steps is not None else None
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            if sum(not f.done() for _, f in self.jobs.values()) >= self.max_pending:
+                raise OverflowError("job queue is full")
+            self._start(building)
+            future = self.executor.submit(run_job, job_id, run, max_steps, self.cancelled)
+            future.add_done_callback(lambda _: self._forget(job_id))
+            self.jobs[job_id] = (run, future)
+            self.executor_futures = [f for f in self.executor_futures if not f.done()] + [future]
+            for old in [k for k, (_, f) in self.jobs.items() if f.done()][:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[old]
+                self._forget(old)
+            self.retired = [(e, fs) for e, fs in self.retired if not all(f.done() for f in fs)]
+        return job_id
+
+    def status(self, job_id, timeout=None):
+        ''' Состояние задания; timeout - сек. ожидания завершения (long polling) '''
+        with self.lock:
+            run, future = self.jobs[job_id]
+        if timeout:
+            wait([future], timeout)
+        job = {"id": job_id, "run": run}
+        if future.cancelled():
+            job["status"] = "cancelled"
+        elif not future.done():
+            job["status"] = "cancelling" if job_id in self.cancelled else "running" if future.running() else "queued"
+        elif isinstance(future.exception(), CancelledError):
+            job["status"] = "cancelled"
+        elif future.exception() is not None:
+            job["status"], job["error"] = "failed", repr(future.exception())
+        else:
+            job["status"], job["result"] = "done", future.result()
+        return job
+
+    def cancel(self, job_id):
+        ''' Ждущее задание снимается с очереди, идущее останавливается в течение CANCEL_CHECK шагов '''
+        with self.lock:
+            _, future = self.jobs[job_id]
+            if not future.cancel() and not future.done():
+                self.cancelled[job_id] = True
+        return self.status(job_id)
+
+    def list(self):
+        with self.lock:
+            ids = list(self.jobs)
+        return [self.status(job_id) for job_id in ids]
+
+    def shutdown(self):
+        if self.executor is not None:
+            for executor, _ in self.retired:
+                executor.shutdown(cancel_futures=True)
+            self.executor.shutdown(cancel_futures=True)
+            self.manager.shutdown()
+
+
+pool = SessionPool()
+jobs = JobQueue(pool)
+
 
 class Server(BaseHTTPRequestHandler):
-    def _set_headers(self):
-        self.send_response(200)
+    ''' POST /buildings          - BIM JSON здания, ответ {"building": ключ}
+        POST /sessions           - {"building": ключ, "density": 0.5, "intruder": {"door": 0, "type": 1, "speed": 60}},
+                                   все поля необязательны, ответ {"id": id сессии}
+        GET /sessions            - список сессий
+        GET /buildings/<ключ>    - BIM JSON здания (геометрия), не меняется - клиент может его кэшировать
+        GET /sessions/<id>       - состояние модели (Session.state), ?since=N - только изменённое после
+                                   шага N, ?format=binary - упакованные массивы (Session.state_binary)
+        GET /sessions/<id>/bim   - полный BIM JSON модели с текущими NumPeople, Density и т.д.
+        POST /sessions/<id>/step - {"steps": n} или {"until": ["empty", "intruder"], "time": мин., "max_steps": n},
+                                   и "since", "format" как у GET; ответ - состояние модели
+        POST /jobs               - {"building", "density", "door", "intruder_type", "speed", "max_steps"},
+                                   прогон сценария до конца в пуле процессов, ответ {"id": id задания}
+        GET /jobs                - список заданий
+        GET /jobs/<id>           - состояние и итоги задания, ?wait=сек. - ждать завершения (long polling)
+        DELETE /jobs/<id>        - отменить задание
+        GET /metrics             - метрики шагов моделей сессий (BimMetrics) в формате Prometheus,
+                                   ?format=json - словарём; замеры включаются ключом --metrics
+        GET /sessions/<id>/stream - шагает модель и отдаёт кадры состояния потоком: ?every=k шагов или
+                                   ?interval=t сек. модельного времени, ?format=sse (по умолчанию NDJSON),
+                                   until, time, max_steps как у step, ?delta=0 - кадры с полным состоянием.
+                                   Параметры можно передать и телом POST /sessions/<id>/stream
+        DELETE /sessions/<id>
+        POST /                   - прежний протокол: {"step": ...} шагает общую модель сервера,
+                                   {"Level": ...} заменяет её моделью загруженного здания '''
+
+    def _set_headers(self, code=200):
+        self.send_response(code)
         self.send_header('Content-type', 'application/json')
         self.end_headers()
-        
+
+    def _reply(self, obj, code=200):
+        self._set_headers(code)
+        self.wfile.write(json.dumps(obj).encode("utf-8"))
+
+    def _reply_state(self, session, params):
+        ''' Ответ состоянием сессии, вызывается под session.lock '''
+        since = params.get("since")
+        since = None if since is None else int(since)
+        if params.get("format") == "binary":
+            body = session.state_binary(since)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.send_header('Content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._reply(session.state(since))
+
+    def _error(self, code, message):
+        self._reply({"error": message}, code)
+
+    def _body(self):
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _route(self):
+        return [p for p in self.path.split('?')[0].split('/') if p]
+
+    def _query(self):
+        return {k: v[-1] for k, v in parse_qs(self.path.partition('?')[2]).items()}
+
     def do_HEAD(self):
         self._set_headers()
 
+    def do_GET(self):
+        parts = self._route()
+        try:
+            if parts == ["sessions"]:
+                return self._reply(pool.list())
+            if parts == ["jobs"]:
+                return self._reply(jobs.list())
+            if parts == ["metrics"]:
+                return self._metrics(self._query())
+            if len(parts) == 2 and parts[0] == "jobs":
+                return self._reply(jobs.status(parts[1], min(float(self._query().get("wait", 0)), MAX_WAIT)))
+            if len(parts) == 2 and parts[0] == "buildings":
+                return self._building(parts[1])
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "stream":
+                return self._stream(pool.get(parts[1]), self._query())
+            if len(parts) in (2, 3) and parts[0] == "sessions":
+                session = pool.get(parts[1])
+                with session.lock:
+                    if parts[2:] == ["bim"]:
+                        return self._reply(session.model.moving.state_bim())
+                    if len(parts) == 2:
+                        return self._reply_state(session, self._query())
+        except NoSuchBuilding as e:
+            return self._error(404, "no such building: %s" % e.args[0])
+        except KeyError:
+            return self._error(404, "no such session")
+        except ValueError as e:
+            return self._error(400, str(e))
+        self._error(404, "not found")
+
+    def _metrics(self, params):
+        if params.get("format") == "json":
+            return self._reply(dict(metrics.report(), sessions=len(pool.sessions)))
+        body = (metrics.prometheus() + "# TYPE evacattack_sessions gauge\nevacattack_sessions %d\n" % len(pool.sessions)).encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _building(self, key):
+        etag = '"%s"' % key
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps(pool.building(key).bim).encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')  # ключ - хэш содержимого
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        parts = self._route()
+        try:
+            if len(parts) == 2 and parts[0] == "jobs":
+                return self._reply(jobs.cancel(parts[1]))
+            if len(parts) == 2 and parts[0] == "sessions":
+                pool.delete(parts[1])
+                return self._reply({"deleted": parts[1]})
+        except KeyError:
+            return self._error(404, "not found")
+        self._error(404, "not found")
+
     def do_POST(self):
         # refuse to receive non-json content
         if self.headers.get('content-type') != 'application/json':
             self.send_response(400)
             self.end_headers()
             return
+        data = self._body()
+        try:
+            message = json.loads(data) if data else {}
+        except ValueError:
+            return self._error(400, "invalid JSON")
+        parts = self._route()
+        try:
+            if parts == ["buildings"]:
+                try:
+                    return self._reply({"building": pool.add_building(data=data)})
+                except (KeyError, TypeError, IndexError) as e:
+                    return self._error(400, "invalid building: %s" % e)
+            if parts == ["jobs"]:
+                return self._reply({"id": jobs.submit(message)})
+            if parts == ["sessions"]:
+                sid = pool.create(message.get("building"), message.get("density"), message.get("intruder"))
+                return self._reply({"id": sid})
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "step":
+                return self._step(pool.get(parts[1]), message)
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "stream":
+                return self._stream(pool.get(parts[1]), dict(self._query(), **message))
+            if not parts:
+                return self._legacy(message, data)
+        except NoSuchBuilding as e:
+            return self._error(404, "no such building: %s" % e.args[0])
+        except KeyError as e:
+            return self._error(404, "not found: %s" % e)
+        except OverflowError as e:
+            return self._error(503, str(e))
+        except (TypeError, ValueError, IndexError) as e:
+            return self._error(400, str(e))
+        self._error(404, "not found")
+
+    def _conditions(self, message):
+        until = message.get("until", ())
+        until = until.split(",") if isinstance(until, str) else until
+        unknown = set(until) - CONDITIONS.keys()
+        if unknown:
+            raise ValueError("unknown stop conditions: %s" % ", ".join(sorted(unknown)))
+        conditions = [CONDITIONS[c] for c in until]
+        if "time" in message:
+            conditions.append(time_limit(float(message["time"])))
+        return conditions
+
+    def _step(self, session, message):
+        conditions = self._conditions(message)
+        with session.lock:
+            if conditions:
+                session.model.run_until(*conditions, max_steps=message.get("max_steps"))
+            else:
+                session.model.run_for(int(message.get("steps", 1)))
+            session.track()
+            self._reply_state(session, dict(self._query(), **message))
 
-        length = int(self.headers.get('content-length'))
-        message = json.loads(self.rfile.read(length))
+    def _stream(self, session, params):
+        ''' Прогон модели с отправкой кадров по мере счёта. Кадры пишутся в сокет из того же потока,
+        что шагает модель, поэтому медленный клиент притормаживает модель (TCP не принимает
+        больше, чем клиент успевает прочитать); клиент, не читающий STREAM_TIMEOUT сек., отключается.
+        Пока идёт поток, остальные запросы к этой сессии ждут '''
+        conditions = self._conditions(params) or [building_empty]
+        every = int(params.get("every", 1))
+        interval = params.get("interval")
+        interval = float(interval) / 60 if interval is not None else None  # сек. -> мин.
+        max_steps = params.get("max_steps")
+        max_steps = int(max_steps) if max_steps is not None else None
+        delta = str(params.get("delta", "1")).lower() not in ("0", "false", "no")
+        sse = params.get("format") == "sse"
+        if every < 1 or (interval is not None and interval <= 0):
+            raise ValueError("frame interval must be positive")
+
+        with session.lock:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream' if sse else 'application/x-ndjson')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.connection.settimeout(STREAM_TIMEOUT)
+            model = session.model
+            last = [None, model.moving.time]  # шаг и время последнего кадра
+
+            def frame(model, event="state"):
+                session.track()
+                state = session.state(last[0] if delta else None)
+                last[0], last[1] = model.steps, model.moving.time
+                data = json.dumps(state)
+                self.wfile.write(("event: %s\nid: %d\ndata: %s\n\n" % (event, model.steps, data) if sse else data + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+            def tick(model):
+                if interval is None or model.moving.time - last[1] >= interval - 1e-12:
+                    frame(model)
+
+            try:
+                frame(model)
+                model.run_until(*conditions, max_steps=max_steps, callbacks=[(1 if interval else every, tick)])
+                frame(model, "end")
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                self.close_connection = True  # клиент ушёл, модель остаётся на последнем шаге
+
+    def _legacy(self, message, data):
         if "Level" in message:
-            model.override = message
-        if "step" in message:
-            model.step()
-        
-        self._set_headers()
-        self.wfile.write(json.dumps(model.bim).encode("utf-8"))
+            pool.default_building = pool.add_building(data=data)
+            pool.create(density=pool.default_density, sid="default")
+        try:
+            session = pool.get("default")
+        except KeyError:  # вытеснена или ещё не создана
+            pool.create(density=pool.default_density, sid="default")
+            session = pool.get("default")
+        with session.lock:
+            if "step" in message:
+                session.model.step()
+                session.track()
+            self._reply(session.model.moving.state_bim())
+
 
 def run(server_class=ThreadingHTTPServer, handler_class=Server, port=8008):
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
-    
+
     print('Starting httpd on port %d...' % port)
     httpd.serve_forever()
-    
-
-if len(argv) == 3:
-    with open(argv[1]) as f:
-        j = json.load(f)
-    model = EvacAttackModel(j)
-    model.moving.set_density(0.5)
-    model.moving.set_people_by_density()
-    run(port=int(argv[2]))
-else:
-    print("File name and port needed")
-    print('Test: curl --data "{\"step\":\"True\"}" --header "Content-Type: application/json" http://localhost:8008')
-   
-        
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Evacuation attack modelling server',
+                                     epilog='Test: curl --data "{\\"step\\":\\"True\\"}" --header "Content-Type: application/json" http://localhost:8008')
+    parser.add_argument('file', help='building served by default')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--density', type=float, default=0.5, help='density of the default model')
+    parser.add_argument('--max-sessions', type=int, default=64)
+    parser.add_argument('--max-idle', type=float, default=None, help='seconds before an idle session is dropped')
+    parser.add_argument('--workers', type=int, default=None, help='processes for /jobs')
+    parser.add_argument('--metrics', action='store_true', help='collect step metrics for /metrics')
+    args = parser.parse_args()
+    metrics.enable(args.metrics)
+    pool.max_sessions, pool.max_idle = args.max_sessions, args.max_idle
+    jobs.workers = args.workers
+    pool.default_building = pool.add_building(file=args.file)
+    pool.default_density = args.density
+    pool.create(density=args.density, sid="default")
+    try:
+        run(port=args.port)
+    finally:
+        jobs.shutdown()
@@ -1,21 +1,80 @@
 import math
+import threading
+from array import array
 from operator import itemgetter
 
+
+class Geometry:
+    ''' Геометрия элемента BIM, посчитанная один раз: многоугольник, центр, площадь, ширина проёма.
+    xy - объект el["XY"], по которому посчитано: если XY заменён, геометрия считается заново.
+    Многоугольник - {"points": [{"x", "y"}, ...]}, список пар с повтором первой точки в конце
+    или упакованный array('d') x0, y0, x1, y1, ... (BimLoader.pack_xy) '''
+    __slots__ = ('xy', 'points', 'centroid', 'area', 'width')
+
+    def __init__(self, el):
+        self.xy = el["XY"]
+        if isinstance(self.xy[0], array):
+            xy = list(zip(self.xy[0][::2], self.xy[0][1::2]))
+        elif "points" in self.xy[0]:
+            xy = [(p["x"], p["y"]) for p in self.xy[0]["points"]]
+        else:
+            xy = self.xy[0][:-1]
+        self.points = xy
+        self.centroid = sum((x for x, y in xy)) / len(xy), sum((y for x, y in xy)) / len(xy)
+        self.area = math.fabs(0.5*sum((x1*y2-x2*y1 for (x1,y1),(x2,y2) in zip(xy, xy[1:]+xy[:1]))))
+        self.width = max((math.dist(p1, p2) for p1, p2 in zip(xy, xy[1:]+xy[:1])), default=0.0)
+
+
+# id(el["XY"]) -> Geometry. Ключ - сам объект XY, а не Id: здания с одинаковыми Id не вытесняют
+# друг друга, а копии state_copy (XY общий) находят готовую геометрию. Geometry держит ссылку
+# на XY, поэтому id не может достаться другому объекту, пока запись жива. Записей не больше
+# GEOMETRY_LIMIT: старейшие вытесняются, и кэш не растёт со всеми зданиями, загруженными сервером.
+# Чтение без блокировки, запись и вытеснение - под _geometry_lock (потоки сервера)
+GEOMETRY_LIMIT = 1 << 18
+_geometry = {}
+_geometry_lock = threading.Lock()
+
+
+def geometry(el):
+    xy = el["XY"]
+    g = _geometry.get(id(xy))
+    if g is None or g.xy is not xy:
+        g = Geometry(el)
+        with _geometry_lock:
+            while len(_geometry) >= GEOMETRY_LIMIT:
+                del _geometry[next(iter(_geometry))]
+            _geometry[id(xy)] = g
+    return g
+
+
+def invalidate_geometry(el=None):
+    ''' Сбрасывает геометрию элемента (или всех элементов), если XY изменён на месте '''
+    with _geometry_lock:
+        if el is None:
+            _geometry.clear()
+        else:
+            _geometry.pop(id(el["XY"]), None)
+
+
+def state_copy(bim):
+    ''' Копия BIM для отдельной модели того же здания: уровни и элементы - новые словари,
+    а XY, Output и прочие вложенные значения общие (модели их не изменяют) '''
+    return dict(bim, Level=[dict(lvl, BuildElement=[dict(el) for el in lvl['BuildElement']]) for lvl in bim['Level']])
+
+
 def points(el):
-    if "points" in el["XY"][0]:
-        return [(xy["x"], xy["y"]) for xy in el["XY"][0]["points"]]
-    else:
-        return el["XY"][0][:-1]
+    return list(geometry(el).points)
 
 def cntr_real(el):
     ''' Центр в координатах здания '''
-    xy = points(el)
-    return sum((x for x, y in xy)) / len(xy), sum((y for x, y in xy)) / len(xy)
+    return geometry(el).centroid
 
 def room_area(el):
-    # print(xy)
-    xy = points(el)
-    return math.fabs(0.5*sum((x1*y2-x2*y1 for (x1,y1),(x2,y2) in zip(xy, xy[1:]+xy[:1]))))
+    return geometry(el).area
+
+def door_width(el):
+    ''' Ширина проёма как наибольшая из сторон многоугольника '''
+    return geometry(el).width
 
 def is_el_on_lvl(el, lvl):
     ''' Принадлежит ли элемент этажу '''
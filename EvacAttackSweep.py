@@ -0,0 +1,247 @@
+import csv
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from EvacAttackModel import EvacAttackModel, building_empty
+from BimTopology import Building
+from BimMetrics import metrics, log
+
+KEY_FIELDS = ("building", "door", "intruder_type", "speed", "density")
+FIELDS = KEY_FIELDS + ("victims", "evacuated", "time", "steps")
+
+
+def run_key(run):
+    ''' Ключ прогона для возобновления: значения приводятся к типам, чтобы строки из CSV совпадали '''
+    return (str(run["building"]), int(run["door"]), int(run["intruder_type"]), float(run["speed"]), float(run["density"]))
+
+
+def load_buildings(grid):
+    ''' Разбирает здания сетки один раз: {путь: BimTopology.Building}, общие для всех прогонов.
+    При "compact": true в сетке здания читаются без лишних полей (BimLoader.load_compact) '''
+    return {path: Building.load(path, compact=grid.get("compact", False)) for path in grid["buildings"]}
+
+
+def expand_grid(grid, bims):
+    ''' Декларативная сетка -> список прогонов.
+    grid = {"buildings": {путь: [двери] или null} или [пути],
+            "doors": [двери] или null (все входы, если у здания двери не заданы),
+            "intruder_types": [...], "speeds": [...], "densities": [...],
+            "compact": false} '''
+    buildings = grid["buildings"]
+    if not isinstance(buildings, dict):
+        buildings = dict.fromkeys(buildings)
+    runs = []
+    for path, doors in buildings.items():
+        doors = doors if doors is not None else grid.get("doors")
+        ns = bims[path].topology.ns
+        if doors is None:
+            doors = range(ns)
+        wrong = [door for door in doors if not 0 <= door < ns]
+        if wrong:
+            raise ValueError("%s: no entrance %s, the building has %d (0..%d)" % (path, wrong, ns, ns - 1))
+        for door, intruder_type, speed, density in product(doors, grid["intruder_types"], grid["speeds"], grid["densities"]):
+            runs.append({"building": path, "door": door, "intruder_type": intruder_type, "speed": speed, "density": density})
+    return runs
+
+
+_worker_bims = {}
+
+
+def _init_worker(bims, with_metrics=False):
+    global _worker_bims
+    _worker_bims = bims
+    metrics.enable(with_metrics)
+
+
+def run_model(run, building, *conditions, max_steps=None):
+    ''' Один прогон на свежей модели до опустевшего здания (или одного из условий conditions).
+    Модель не изменяет building, копии здания не нужны. Возвращает модель и число шагов '''
+    model = EvacAttackModel(building)
+    moving = model.moving
+    moving.set_density(run["density"])
+    moving.set_people_by_density()
+    model.set_intruder(run["door"], run["intruder_type"] == 1, run["intruder_type"], run["speed"])
+    steps = model.run_until(building_empty, *conditions, max_steps=max_steps)
+    return model, steps
+
+
+def run_one(run, bims=None, max_steps=None):
+    ''' Один прогон на свежей модели. Возвращает строку результата '''
+    model, steps = run_model(run, (bims or _worker_bims)[run["building"]], max_steps=max_steps)
+    moving = model.moving
+    evacuated = moving.num_people[moving.topo.nz:].sum().item()
+    row = dict(run, victims=model.intruder.victims, evacuated=evacuated, time=moving.time * 60, steps=steps)
+    if metrics.enabled:
+        row["_metrics"] = metrics.report(reset=True)  # сводятся в run_sweep
+    return row
+
+
+class CsvResults:
+    ''' Результаты в CSV: строка дописывается сразу после окончания прогона '''
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.done = set()
+        if resume and os.path.exists(path):
+            self._recover()
+        new = not os.path.exists(path) or not resume
+        self.f = open(path, 'w' if new else 'a', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.f, FIELDS)
+        if new:
+            self.writer.writeheader()
+            self.f.flush()
+
+    def _recover(self):
+        ''' Считывает завершённые прогоны и отрезает недописанную при падении строку '''
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        with open(self.path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    self.done.add(run_key(row))
+                except (TypeError, ValueError):
+                    pass
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.f.flush()
+        self.done.add(run_key(row))
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetResults:
+    ''' Результаты в Parquet (нужен pyarrow): каталог из файлов part-NNNNN.parquet.
+    Пачка строк записывается отдельным файлом, как только в ней batch строк или с записи
+    прошлой пачки прошло interval сек.: при падении теряются лишь последние прогоны '''
+
+    def __init__(self, path, resume=True, batch=8, interval=10.0):
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.flushed = time.monotonic()
+        self.rows = []
+        self.done = set()
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(p for p in os.listdir(path) if p.startswith("part-") and p.endswith(".parquet"))
+        if not resume:
+            for p in parts:
+                os.remove(os.path.join(path, p))
+            parts = []
+        for p in parts:
+            self.done.update(map(run_key, pq.read_table(os.path.join(path, p), columns=list(KEY_FIELDS)).to_pylist()))
+        self.part = len(parts)
+
+    def write(self, row):
+        self.rows.append(row)
+        self.done.add(run_key(row))
+        if len(self.rows) >= self.batch or time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if not self.rows:
+            return
+        import pyarrow as pa
+        name = os.path.join(self.path, "part-%05d.parquet" % self.part)
+        self.pq.write_table(pa.Table.from_pylist(self.rows), name + ".tmp")
+        os.replace(name + ".tmp", name)  # недописанный файл не попадёт в результаты
+        self.part += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def check_output(path):
+    ''' Проверка до запуска прогонов: для .parquet нужен pyarrow '''
+    if path.endswith(".parquet") and importlib.util.find_spec("pyarrow") is None:
+        raise RuntimeError("%s: Parquet output needs pyarrow (pip install pyarrow), or write .csv" % path)
+
+
+def open_results(path, resume=True):
+    check_output(path)
+    return ParquetResults(path, resume) if path.endswith(".parquet") else CsvResults(path, resume)
+
+
+def run_sweep(grid, out, workers=None, resume=True, max_steps=None, verbose=True, metrics_out=None):
+    ''' Прогоняет сетку grid в пуле процессов, результаты пишутся в out (.csv или .parquet)
+    по мере завершения прогонов. Уже посчитанные прогоны из out пропускаются.
+    Упавший прогон пишется в журнал "evacattack" и не прерывает остальные; в out он не попадает
+    и при возобновлении считается заново. Возвращает список упавших (прогон, исключение).
+    workers=1 - без пула, в текущем процессе. metrics_out - JSON, куда в конце записываются
+    метрики всех прогонов (BimMetrics) '''
+    check_output(out)
+    bims = load_buildings(grid)
+    runs = expand_grid(grid, bims)
+    enabled = metrics.enabled
+    metrics.enable(enabled or bool(metrics_out))
+    results = open_results(out, resume)
+    runs = [r for r in runs if run_key(r) not in results.done]
+    if verbose:
+        print("Runs to do: %d, already done: %d" % (len(runs), len(results.done)))
+    failed = []
+
+    def finished(i, run, result):
+        try:
+            row = result()
+        except Exception as e:
+            log.error("run %s failed: %r", run, e)
+            failed.append((run, e))
+            if verbose:
+                print(i, "FAILED", run, repr(e))
+            return
+        _merge_metrics(row)
+        results.write(row)
+        if verbose:
+            print(i, row)
+
+    try:
+        if workers == 1:
+            for i, r in enumerate(runs, 1):
+                finished(i, r, lambda: run_one(r, bims, max_steps))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(bims, metrics.enabled)) as pool:
+                futures = {pool.submit(run_one, r, None, max_steps): r for r in runs}
+                for i, future in enumerate(as_completed(futures), 1):
+                    finished(i, futures[future], future.result)
+    finally:
+        results.close()  # в том числе недописанная пачка Parquet
+        metrics.enable(enabled)
+        if metrics_out:
+            with open(metrics_out, 'w', encoding='utf-8') as f:
+                json.dump(metrics.report(), f, indent=1)
+    return failed
+
+
+def _merge_metrics(row):
+    ''' Метрики прогона (из процесса пула или текущего) добавляются к метрикам этого процесса '''
+    report = row.pop("_metrics", None)
+    if report is not None:
+        metrics.merge(report)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Parallel sweep of evacuation attack modelling')
+    parser.add_argument('grid', type=argparse.FileType('r'), help='JSON with buildings, doors, intruder_types, speeds, densities')
+    parser.add_argument('out', help='results .csv or .parquet')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=None)
+    parser.add_argument('--no-resume', action='store_true', help='start over instead of skipping finished runs')
+    parser.add_argument('--metrics', default=None, help='write step metrics of all runs to this JSON file')
+    args = parser.parse_args()
+    try:
+        check_output(args.out)
+    except RuntimeError as e:
+        parser.error(str(e))
+    run_sweep(json.load(args.grid), args.out, args.workers, not args.no_resume, args.max_steps, metrics_out=args.metrics)